@@ -0,0 +1,291 @@
+"""
+Benchmark harness for merge_engine.merge_pdfs_hybrid.
+
+Generates synthetic fixtures locally (nothing large is checked in), runs every
+engine path over them and writes machine-readable JSON, so runs from two commits
+can be compared:
+
+    python benchmarks/bench_engine.py --out before.json
+    git checkout <other commit>
+    python benchmarks/bench_engine.py --out after.json --compare before.json
+
+Each case runs in a fresh interpreter, so the reported peak RSS belongs to that
+case alone. Requires PyMuPDF and Pillow (the fixtures are built with them).
+"""
+import sys
+import json
+import os
+import time
+import shutil
+import argparse
+import platform
+import subprocess
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Fixture sizes at --scale 1.0
+TEXT_PAGES = 2000
+SCAN_PAGES = 40
+SMALL_FILES = 1000
+ANNOTATED_PAGES = 200
+ANNOTATION_PATHS = 40
+ANNOTATION_POINTS = 200
+BATCH_GROUPS = 100
+BATCH_GROUP_PAGES = 10
+
+LOREM = ("Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor "
+         "incididunt ut labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud.")
+
+def _scaled(n, scale):
+    return max(1, int(round(n * scale)))
+
+def _make_text_pdf(path, pages, label="Page"):
+    import fitz
+    doc = fitz.open()
+    for i in range(pages):
+        page = doc.new_page(width=612, height=792)
+        page.insert_text((72, 72), f"{label} {i + 1}", fontsize=18)
+        page.insert_textbox(fitz.Rect(72, 100, 540, 720), (LOREM + "\n") * 12, fontsize=10)
+    doc.save(path, garbage=3, deflate=True)
+    doc.close()
+
+def _make_scan_pdf(path, pages):
+    """Letter pages each holding a distinct ~300 DPI noisy RGB 'scan'."""
+    import io
+    import fitz
+    from PIL import Image
+    doc = fitz.open()
+    size = (2550, 3300)
+    for i in range(pages):
+        bands = [Image.effect_noise(size, 40 + 10 * ((i + c) % 3)) for c in range(3)]
+        img = Image.merge("RGB", bands)
+        buf = io.BytesIO()
+        img.save(buf, format="JPEG", quality=90)
+        page = doc.new_page(width=612, height=792)
+        page.insert_image(page.rect, stream=buf.getvalue())
+    doc.save(path, garbage=3, deflate=True)
+    doc.close()
+
+def _annotation_overlay(items):
+    nodes = []
+    for n in range(ANNOTATION_PATHS):
+        nodes.append({
+            'type': 'PATH', 'color': '#d02020', 'thickness': 2,
+            'points': [{'x': 20 + k * 2.5, 'y': 20 + n * 18 + (k % 9)} for k in range(ANNOTATION_POINTS)],
+        })
+    nodes.append({'type': 'SHAPE', 'shapeType': 'ARROW', 'x': 50, 'y': 600, 'endX': 300, 'endY': 700, 'color': '#2020d0', 'thickness': 3})
+    nodes.append({'type': 'SHAPE', 'shapeType': 'RECTANGLE', 'x': 320, 'y': 600, 'endX': 560, 'endY': 760,
+                  'color': '#2020d0', 'fillColor': '#ffff00', 'fillOpacity': 40})
+    nodes.append({'type': 'TEXT', 'text': 'Reviewed\nbenchmark', 'x': 360, 'y': 40, 'color': '#000000'})
+    return {item['id']: {'pageWidth': 612, 'pageHeight': 792, 'nodes': nodes} for item in items}
+
+def build_fixtures(fixture_dir, scale):
+    """Creates every fixture under `fixture_dir` (reused when already present) and returns the scenarios."""
+    os.makedirs(fixture_dir, exist_ok=True)
+
+    def fixture(name, builder, *args):
+        path = os.path.join(fixture_dir, name)
+        if not os.path.exists(path):
+            print(f"Generating {name}...", file=sys.stderr)
+            builder(path, *args)
+        return path
+
+    text_pages = _scaled(TEXT_PAGES, scale)
+    text = fixture(f"text_{text_pages}.pdf", _make_text_pdf, text_pages)
+    scan_pages = _scaled(SCAN_PAGES, scale)
+    scans = fixture(f"scans_{scan_pages}.pdf", _make_scan_pdf, scan_pages)
+
+    small_dir = os.path.join(fixture_dir, "small")
+    os.makedirs(small_dir, exist_ok=True)
+    small = [os.path.join(small_dir, f"small_{i:05d}.pdf") for i in range(_scaled(SMALL_FILES, scale))]
+    if not all(os.path.exists(p) for p in small):
+        print(f"Generating {len(small)} small files...", file=sys.stderr)
+        for i, path in enumerate(small):
+            _make_text_pdf(path, 1, f"File {i}")
+
+    batch_groups = _scaled(BATCH_GROUPS, scale)
+
+    def pages_of(path, count, prefix, parent=None):
+        return [{'path': path, 'originalIndex': i, 'rot': 0, 'id': f"{prefix}{i}",
+                 'parentName': parent or os.path.basename(path)} for i in range(count)]
+
+    annotated = pages_of(text, min(text_pages, _scaled(ANNOTATED_PAGES, scale)), "ann")
+    batch = []
+    for g in range(batch_groups):
+        start = (g * BATCH_GROUP_PAGES) % max(1, text_pages - BATCH_GROUP_PAGES)
+        batch.extend({**item, 'originalIndex': start + item['originalIndex'], 'id': f"g{g}p{item['originalIndex']}"}
+                     for item in pages_of(text, min(BATCH_GROUP_PAGES, text_pages), f"g{g}p", f"Group {g:04d}.pdf"))
+
+    return {
+        'text': {'items': pages_of(text, text_pages, "t")},
+        'scans': {'items': pages_of(scans, scan_pages, "s")},
+        'many_files': {'items': [pages_of(p, 1, f"f{i}_")[0] for i, p in enumerate(small)]},
+        'annotations': {'items': annotated, 'annotationOverlay': _annotation_overlay(annotated)},
+        'batch': {'items': batch, 'batch': True},
+    }
+
+# (scenario, engine path, exportOptions, resizeToFit)
+CASES = [
+    ('text', 'plain', {}, False),
+    ('text', 'resizeToFit', {}, True),
+    ('text', 'pypdf', {'engine': 'pypdf'}, False),
+    ('text', 'pypdf+resizeToFit', {'engine': 'pypdf'}, True),
+    ('scans', 'plain', {}, False),
+    ('scans', 'optimize', {'optimize': True, 'imageCache': False}, False),
+    ('many_files', 'plain', {}, False),
+    ('many_files', 'dedupe', {'dedupe': True}, False),
+    ('annotations', 'annotations', {}, False),
+    ('batch', 'serial', {'mode': 'batch', 'workers': 1}, False),
+    ('batch', 'workers', {'mode': 'batch', 'workers': 0}, False),
+]
+
+def run_case(case):
+    """Child-process entry point: runs one export and prints its measurements as JSON."""
+    sys.path.insert(0, ROOT)
+    import merge_engine
+
+    started = time.perf_counter()
+    report = merge_engine.merge_pdfs_hybrid(case['payload'])
+    seconds = time.perf_counter() - started
+
+    out = case['payload']['outputPath']
+    files = [os.path.join(out, f) for f in os.listdir(out)] if os.path.isdir(out) else [out]
+    peak = merge_engine._peak_rss_bytes()
+    if merge_engine.resource is not None:
+        # Batch workers run in child processes; report the largest one if it beat us
+        children = merge_engine.resource.getrusage(merge_engine.resource.RUSAGE_CHILDREN).ru_maxrss
+        peak = max(peak or 0, children if sys.platform == 'darwin' else children * 1024)
+    print(json.dumps({
+        'seconds': seconds,
+        'peakRssBytes': peak,
+        'outputBytes': sum(os.path.getsize(f) for f in files if os.path.isfile(f)),
+        'errors': len((report or {}).get('errors', [])),
+    }))
+
+def _input_bytes(items):
+    return sum(os.path.getsize(p) for p in {item['path'] for item in items})
+
+def run_suite(scenarios, work_dir, repeat, selected):
+    results = []
+    for scenario, path, options, fit in CASES:
+        if selected and scenario not in selected:
+            continue
+        spec = scenarios[scenario]
+        out_dir = os.path.join(work_dir, "out")
+        payload = {
+            'items': spec['items'],
+            'outputPath': os.path.join(out_dir, scenario) if spec.get('batch') else os.path.join(out_dir, f"{scenario}_{path}.pdf"),
+            'resizeToFit': fit,
+            'exportOptions': options,
+            'annotationOverlay': spec.get('annotationOverlay'),
+        }
+        case_file = os.path.join(work_dir, "case.json")
+        with open(case_file, 'w', encoding='utf-8') as f:
+            json.dump({'payload': payload}, f)
+
+        runs = []
+        for _ in range(repeat):
+            shutil.rmtree(out_dir, ignore_errors=True)
+            os.makedirs(out_dir)
+            proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--run-case', case_file],
+                                  capture_output=True, text=True)
+            if proc.returncode != 0:
+                print(f"{scenario}/{path} failed:\n{proc.stderr}", file=sys.stderr)
+                break
+            runs.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+        if not runs:
+            results.append({'scenario': scenario, 'path': path, 'failed': True})
+            continue
+
+        best = min(runs, key=lambda r: r['seconds'])
+        pages = len(spec['items'])
+        mb_in = _input_bytes(spec['items']) / (1024 * 1024)
+        result = {
+            'scenario': scenario,
+            'path': path,
+            'pages': pages,
+            'inputMB': round(mb_in, 2),
+            'seconds': round(best['seconds'], 4),
+            'pagesPerSec': round(pages / best['seconds'], 1),
+            'mbPerSec': round(mb_in / best['seconds'], 2),
+            'peakRssMB': round(max(r['peakRssBytes'] or 0 for r in runs) / (1024 * 1024), 1),
+            'outputMB': round(best['outputBytes'] / (1024 * 1024), 2),
+            'errors': best['errors'],
+        }
+        results.append(result)
+        print(f"{scenario:12} {path:18} {result['pagesPerSec']:>9} pages/s {result['mbPerSec']:>8} MB/s "
+              f"{result['peakRssMB']:>8} MB peak", file=sys.stderr)
+    return results
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def compare(results, baseline_path):
+    """Prints the change in throughput and peak memory against an earlier results file."""
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = {(r['scenario'], r['path']): r for r in json.load(f)['results'] if not r.get('failed')}
+    for r in results:
+        old = baseline.get((r['scenario'], r['path']))
+        if r.get('failed') or old is None:
+            continue
+        speed = (r['pagesPerSec'] / old['pagesPerSec'] - 1) * 100 if old['pagesPerSec'] else 0
+        memory = (r['peakRssMB'] / old['peakRssMB'] - 1) * 100 if old['peakRssMB'] else 0
+        print(f"{r['scenario']:12} {r['path']:18} throughput {speed:+7.1f}%  peak memory {memory:+7.1f}%", file=sys.stderr)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Combine+ merge engine.")
+    parser.add_argument('--out', help="write results JSON here (default: stdout)")
+    parser.add_argument('--scale', type=float, default=1.0, help="fixture size multiplier, e.g. 0.1 for a quick run")
+    parser.add_argument('--repeat', type=int, default=1, help="runs per case; the fastest is reported")
+    parser.add_argument('--scenario', action='append', help="only run this scenario (repeatable)")
+    parser.add_argument('--fixtures', help="fixture directory to build/reuse (default: a temp dir, removed afterwards)")
+    parser.add_argument('--compare', help="earlier results JSON to compare against")
+    parser.add_argument('--run-case', help=argparse.SUPPRESS)
+    parser.add_argument('--build-fixtures', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_case:
+        with open(args.run_case, 'r', encoding='utf-8') as f:
+            run_case(json.load(f))
+        return
+    if args.build_fixtures:
+        print(json.dumps(build_fixtures(args.build_fixtures, args.scale)))
+        return
+
+    work_dir = tempfile.mkdtemp(prefix="combine-bench-")
+    fixture_dir = args.fixtures or os.path.join(work_dir, "fixtures")
+    try:
+        # Built in a child too: on Linux the peak RSS of a parent survives into the
+        # processes it spawns, and generating the scans is the biggest allocation here
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--build-fixtures', fixture_dir,
+                               '--scale', str(args.scale)], stdout=subprocess.PIPE, text=True, check=True)
+        scenarios = json.loads(proc.stdout.strip().splitlines()[-1])
+        results = run_suite(scenarios, work_dir, max(1, args.repeat), args.scenario)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    doc = {
+        'commit': _git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'scale': args.scale,
+        'results': results,
+    }
+    text = json.dumps(doc, indent=2)
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == "__main__":
+    main()
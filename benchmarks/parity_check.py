@@ -0,0 +1,153 @@
+"""
+Output parity check between the fitz-native engine and the pypdf fallback.
+
+Builds small fixtures covering mixed page sizes, /Rotate values, offset crop boxes,
+shared images, raster image items and annotation overlays, exports each through
+both engines (exportOptions.engine = 'fitz' / 'pypdf') and compares page count,
+displayed page size and rendered pixels page by page:
+
+    python benchmarks/parity_check.py [--dpi 36] [--tolerance 1.0]
+
+Exits non-zero when any page differs. Requires PyMuPDF and Pillow.
+"""
+import sys
+import os
+import io
+import json
+import shutil
+import argparse
+import tempfile
+
+import fitz
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import merge_engine  # noqa: E402
+
+def build_fixtures(fixture_dir):
+    """Returns {name: path} for the fixture PDFs/images written into `fixture_dir`."""
+    paths = {}
+
+    doc = fitz.open()
+    for i, (w, h, rot) in enumerate([(612, 792, 0), (842, 595, 0), (595, 842, 90), (300, 500, 270),
+                                     (1224, 792, 180), (400, 400, 0)]):
+        page = doc.new_page(width=w, height=h)
+        page.insert_text((30, 50), f"Mixed page {i} {w}x{h} rot {rot}", fontsize=14)
+        page.draw_rect(fitz.Rect(20, h - 120, 160, h - 20), color=(1, 0, 0), fill=(1, 0.8, 0.8))
+        page.insert_link({"kind": fitz.LINK_URI, "from": fitz.Rect(30, 60, 200, 80), "uri": "https://example.com"})
+        if i == 5:
+            page.set_cropbox(fitz.Rect(40, 30, 360, 380))
+        page.set_rotation(rot)
+    paths['mixed'] = os.path.join(fixture_dir, "mixed.pdf")
+    doc.save(paths['mixed'])
+    doc.close()
+
+    img = Image.merge("RGB", [Image.effect_noise((1800, 2400), 30 + 10 * c) for c in range(3)])
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=90)
+    doc = fitz.open()
+    for i in range(3):
+        page = doc.new_page(width=612, height=792)
+        page.insert_image(fitz.Rect(36, 36, 576, 756), stream=buf.getvalue())
+        page.insert_text((40, 30), f"Scan {i}", fontsize=12)
+    paths['scan'] = os.path.join(fixture_dir, "scan.pdf")
+    doc.save(paths['scan'], deflate=True)
+    doc.close()
+
+    paths['photo'] = os.path.join(fixture_dir, "photo.png")
+    Image.linear_gradient("L").resize((640, 480)).convert("RGB").save(paths['photo'])
+    return paths
+
+def build_items(paths):
+    items = []
+    for i in range(6):
+        items.append({'path': paths['mixed'], 'originalIndex': i, 'rot': 0, 'id': f"m{i}", 'parentName': 'Mixed.pdf'})
+    for i, rot in enumerate([90, 180, 270, -90]):
+        items.append({'path': paths['mixed'], 'originalIndex': i, 'rot': rot, 'id': f"r{i}", 'parentName': 'Mixed.pdf'})
+    for i in (2, 0, 1, 0):
+        items.append({'path': paths['scan'], 'originalIndex': i, 'rot': 0, 'id': f"s{i}{len(items)}", 'parentName': 'Scan.pdf'})
+    items.append({'path': paths['photo'], 'type': 'img', 'originalIndex': 0, 'rot': 90, 'id': 'p0', 'parentName': 'Photo.pdf'})
+    return items
+
+def build_overlay(items):
+    nodes = [
+        {'type': 'PATH', 'points': [{'x': 40 + k * 3, 'y': 120 + (k % 11) * 2} for k in range(80)], 'color': '#0050ff', 'thickness': 3},
+        {'type': 'SHAPE', 'shapeType': 'ARROW', 'x': 60, 'y': 300, 'endX': 250, 'endY': 380, 'color': '#00a000', 'thickness': 2},
+        {'type': 'SHAPE', 'shapeType': 'ELLIPSE', 'x': 300, 'y': 200, 'endX': 420, 'endY': 300, 'color': '#a000a0', 'fillColor': '#ffe0ff'},
+        {'type': 'TEXT', 'text': 'Parity\ncheck', 'x': 200, 'y': 60, 'rotation': 20, 'color': '#202020'},
+    ]
+    return {item['id']: {'pageWidth': 612, 'pageHeight': 792, 'nodes': nodes} for item in items[::3]}
+
+CASES = [
+    ('plain', {}, False, False),
+    ('resizeToFit', {}, True, False),
+    ('annotations', {}, False, True),
+    ('resizeToFit+annotations', {}, True, True),
+    ('optimize', {'optimize': True, 'imageCache': False, 'targetDpi': 72, 'triggerDpi': 100}, False, False),
+]
+
+def compare(path_a, path_b, dpi, tolerance):
+    """Returns a list of human-readable differences between two PDFs."""
+    problems = []
+    a, b = fitz.open(path_a), fitz.open(path_b)
+    try:
+        if len(a) != len(b):
+            return [f"page count {len(a)} != {len(b)}"]
+        for i in range(len(a)):
+            ra, rb = a[i].rect, b[i].rect
+            if abs(ra.width - rb.width) > 0.5 or abs(ra.height - rb.height) > 0.5:
+                problems.append(f"page {i}: size {ra.width:.1f}x{ra.height:.1f} != {rb.width:.1f}x{rb.height:.1f}")
+                continue
+            pa = a[i].get_pixmap(dpi=dpi, colorspace=fitz.csRGB, alpha=False)
+            pb = b[i].get_pixmap(dpi=dpi, colorspace=fitz.csRGB, alpha=False)
+            if (pa.width, pa.height) != (pb.width, pb.height):
+                problems.append(f"page {i}: raster size differs")
+                continue
+            diff = sum(abs(x - y) for x, y in zip(pa.samples, pb.samples)) / len(pa.samples)
+            if diff > tolerance:
+                problems.append(f"page {i}: mean pixel difference {diff:.2f}")
+    finally:
+        a.close()
+        b.close()
+    return problems
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare the fitz and pypdf export engines.")
+    parser.add_argument('--dpi', type=int, default=36, help="render resolution for the pixel comparison")
+    parser.add_argument('--tolerance', type=float, default=1.0, help="allowed mean absolute pixel difference per page")
+    args = parser.parse_args(argv)
+
+    work_dir = tempfile.mkdtemp(prefix="combine-parity-")
+    results = []
+    try:
+        paths = build_fixtures(work_dir)
+        items = build_items(paths)
+        overlay = build_overlay(items)
+        for name, options, fit, annotate in CASES:
+            outputs = {}
+            for engine in ('fitz', 'pypdf'):
+                out = os.path.join(work_dir, f"{name}_{engine}.pdf")
+                report = merge_engine.merge_pdfs_hybrid({
+                    'items': items,
+                    'outputPath': out,
+                    'resizeToFit': fit,
+                    'exportOptions': {**options, 'engine': engine},
+                    'annotationOverlay': overlay if annotate else None,
+                })
+                if report.get('errors'):
+                    print(f"{name}/{engine} reported errors: {report['errors']}", file=sys.stderr)
+                outputs[engine] = out
+            problems = compare(outputs['fitz'], outputs['pypdf'], args.dpi, args.tolerance)
+            results.append({'case': name, 'ok': not problems, 'problems': problems})
+            print(f"{name:26} {'OK' if not problems else 'DIFFERS'}", file=sys.stderr)
+            for problem in problems:
+                print(f"    {problem}", file=sys.stderr)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(json.dumps({'results': results}, indent=2))
+    return 0 if all(r['ok'] for r in results) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,6 +6,7 @@ let pendingFiles = [];
 let fs = null;
 let path = null;
 let os = null;
+const engineThumbListeners = new Map(); // requestKey -> callback for thumbnails streamed by the engine
 
 try {
     if (typeof require !== 'undefined') {
@@ -25,6 +26,21 @@ try {
                 pendingFiles.push(...filePaths);
             }
         });
+
+        // Thumbnail chunks streamed by the engine while a render-thumbnails request runs
+        ipcRenderer.on('thumbnails-chunk', (event, { requestKey, thumbnails }) => {
+            const deliver = engineThumbListeners.get(requestKey);
+            if (deliver) deliver(thumbnails);
+        });
+
+        // Live export progress streamed from the merge engine
+        ipcRenderer.on('export-progress', (event, progress) => {
+            const mainExportBtn = document.getElementById('export-btn');
+            if (!mainExportBtn || mainExportBtn.dataset.busy !== 'export' || !progress.pages) return;
+            const pct = Math.min(100, Math.round((progress.page / progress.pages) * 100));
+            mainExportBtn.title = `${progress.stage}: page ${progress.page} of ${progress.pages} (click to cancel)`;
+            mainExportBtn.innerHTML = `<i class="fas fa-spinner fa-spin"></i> ${pct}%`;
+        });
     }
 } catch (e) {
     console.log("Environment: Browser Preview (No Node/Electron)");
@@ -951,7 +967,31 @@ document.addEventListener('DOMContentLoaded', () => {
     }
 
     // --- EXPORT LOGIC ---
-    window.exportPdf = function () {
+    // While an export runs the main export button turns into its Cancel action.
+    const setExportBusy = (busy) => {
+        const mainExportBtn = document.getElementById('export-btn');
+        mainExportBtn.dataset.busy = busy ? 'export' : '';
+        mainExportBtn.title = busy ? 'Exporting (click to cancel)' : 'Export PDF (Ctrl+S)';
+        mainExportBtn.innerHTML = busy
+            ? '<i class="fas fa-spinner fa-spin"></i>'
+            : '<i class="fas fa-download transition-transform duration-300 hover:scale-110"></i>';
+    };
+
+    window.cancelExport = async function () {
+        const mainExportBtn = document.getElementById('export-btn');
+        if (mainExportBtn.dataset.busy !== 'export') return;
+        if (!await ipcRenderer.invoke('cancel-export')) return;
+        mainExportBtn.dataset.busy = 'cancelling';
+        mainExportBtn.title = 'Cancelling export...';
+        mainExportBtn.innerHTML = '<i class="fas fa-spinner fa-spin"></i> Cancel';
+    };
+
+    window.exportPdf = function (cancelIfBusy = false) {
+        const busy = document.getElementById('export-btn').dataset.busy;
+        if (busy) {
+            if (cancelIfBusy) window.cancelExport();
+            return;
+        }
         if (state.items.length === 0) return;
 
         // Show modal instead of instant export
@@ -1006,7 +1046,13 @@ document.addEventListener('DOMContentLoaded', () => {
             format: document.getElementById('export-format')?.value || 'pdf',
             optimize: document.getElementById('export-optimize-chk').checked,
             triggerDpi: parseInt(document.getElementById('opt-trigger-dpi').value) || 300,
-            targetDpi: parseInt(document.getElementById('opt-target-dpi').value) || 150
+            targetDpi: parseInt(document.getElementById('opt-target-dpi').value) || 150,
+            printSafe: document.getElementById('print-safe-chk')?.checked || false,
+            // Decimal megabytes: the stricter reading of an upload portal's limit
+            splitMaxBytes: Math.round((parseFloat(document.getElementById('split-max-mb')?.value) || 0) * 1000 * 1000),
+            // Batch mode exports the files in parallel, one engine process per core at most
+            workers: Math.max(1, Math.min(navigator.hardwareConcurrency || 1, state.items.length)),
+            incremental: document.getElementById('incremental-chk')?.checked || false // Re-exports to the same path only rebuild changed pages
         };
 
         if (isElectron) {
@@ -1065,9 +1111,7 @@ document.addEventListener('DOMContentLoaded', () => {
                 closeExportModal();
 
                 // Show a spinning overall status in the UI
-                const mainExportBtn = document.getElementById('export-btn');
-                mainExportBtn.innerHTML = '<i class="fas fa-spinner fa-spin"></i>';
-                mainExportBtn.disabled = true;
+                setExportBusy(true);
 
                 const result = await ipcRenderer.invoke('merge-files', {
                     items: exportList,
@@ -1078,7 +1122,9 @@ document.addEventListener('DOMContentLoaded', () => {
                     annotationOverlay: annotationOverlays // pass annotation image overlays to backend
                 });
 
-                if (result.success) {
+                if (result.success && result.report && result.report.cancelled) {
+                    showMessageModal('Export Cancelled', 'The export was cancelled before it finished.', false);
+                } else if (result.success) {
                     let hasIssues = false;
                     let msg = '';
                     if (result.failedFiles && result.failedFiles.length > 0) {
@@ -1098,14 +1144,11 @@ document.addEventListener('DOMContentLoaded', () => {
                 }
                 else showMessageModal('Error', result.error, true);
 
-                mainExportBtn.innerHTML = '<i class="fas fa-download transition-transform duration-300 hover:scale-110"></i>';
-                mainExportBtn.disabled = false;
+                setExportBusy(false);
 
             } catch (e) {
                 showMessageModal('Export Error', e.message, true);
-                const mainExportBtn = document.getElementById('export-btn');
-                mainExportBtn.innerHTML = '<i class="fas fa-download transition-transform duration-300 hover:scale-110"></i>';
-                mainExportBtn.disabled = false;
+                setExportBusy(false);
             } finally {
                 btn.innerHTML = originalBtnText;
                 btn.disabled = false;
@@ -2177,6 +2220,40 @@ document.addEventListener('DOMContentLoaded', () => {
 
         // FIX: Use a stable worker queue model to prevent resource overload.
         const CONCURRENT_LIMIT = 2; // A safer limit to avoid crashing the browser renderer.
+        const ENGINE_THUMB_SIZE = 1500; // Same resolution as the pdf.js path below
+
+        // In Electron the engine renders every pending page of a document in one request,
+        // so its worker pool is used, and streams each rendered chunk back as it finishes;
+        // pdf.js below stays the fallback when that is unavailable.
+        const enginePages = {};
+        const engineThumbnail = (url, pageIdx, rot) => {
+            if (!isElectron) return Promise.resolve(null);
+            const pageKey = (idx) => `${url}|${rot}|${idx}`;
+            if (!enginePages[pageKey(pageIdx)]) {
+                const pages = new Set([pageIdx]);
+                for (const c of canvasesToProcess) {
+                    const idx = parseInt(c.dataset.pageIndex);
+                    if (c.dataset.url !== url || (findPageObject(c.dataset.id)?.rot || 0) !== rot) continue;
+                    if (!enginePages[pageKey(idx)]) pages.add(idx);
+                }
+                const waiting = new Map();
+                pages.forEach(idx => { enginePages[pageKey(idx)] = new Promise(resolve => waiting.set(idx, resolve)); });
+                const deliver = (thumbnails) => thumbnails.forEach(t => {
+                    const resolve = waiting.get(t.pageIndex);
+                    if (resolve) { waiting.delete(t.pageIndex); resolve(t); }
+                });
+                const requestKey = `${pageKey(pageIdx)}|${Date.now()}`;
+                engineThumbListeners.set(requestKey, deliver);
+                ipcRenderer.invoke('render-thumbnails', { filePath: url, pages: [...pages], maxSize: ENGINE_THUMB_SIZE, rotation: rot, requestKey })
+                    .then(res => { if (res && res.success) deliver(res.thumbnails); })
+                    .catch(() => { })
+                    .finally(() => {
+                        engineThumbListeners.delete(requestKey);
+                        waiting.forEach(resolve => resolve(null)); // Left to pdf.js
+                    });
+            }
+            return enginePages[pageKey(pageIdx)];
+        };
 
         const worker = async () => {
             while (canvasesToProcess.length > 0) {
@@ -2189,33 +2266,45 @@ document.addEventListener('DOMContentLoaded', () => {
                 const pageId = canvas.dataset.id;
 
                 try {
-                    let pdfDoc = pdfDocCache[url];
-                    if (!pdfDoc) {
-                        const loadingTask = pdfjsLib.getDocument(url);
-                        pdfDoc = await loadingTask.promise;
-                        pdfDocCache[url] = pdfDoc;
-                    }
-                    const page = await pdfDoc.getPage(pageIdx + 1);
-                    const viewport = page.getViewport({ scale: 1 });
-                    const MAX_DIMENSION = 1500;
-                    const scale = Math.min(MAX_DIMENSION / viewport.width, MAX_DIMENSION / viewport.height, 3);
                     const pageObjRot = findPageObject(pageId)?.rot || 0;
-                    const totalRot = (page.rotate + pageObjRot) % 360;
-                    const rotatedViewport = page.getViewport({ scale: scale, rotation: totalRot });
-                    canvas.width = rotatedViewport.width; canvas.height = rotatedViewport.height;
-                    const context = canvas.getContext('2d');
-                    context.fillStyle = '#FFFFFF'; context.fillRect(0, 0, canvas.width, canvas.height);
-
-                    // FIX: Add a timeout to prevent a single bad page from hanging the entire render queue.
-                    const renderPromise = page.render({
-                        canvasContext: context,
-                        viewport: rotatedViewport,
-                        renderInteractiveForms: true // Enable rendering of annotations and forms
-                    }).promise;
-                    const timeoutPromise = new Promise((_, reject) =>
-                        setTimeout(() => reject(new Error('Render timed out after 10 seconds')), 10000)
-                    );
-                    await Promise.race([renderPromise, timeoutPromise]);
+                    const thumb = await engineThumbnail(url, pageIdx, pageObjRot);
+                    let context;
+                    if (thumb) {
+                        const img = new Image();
+                        img.src = URL.createObjectURL(new Blob([thumb.data], { type: 'image/png' }));
+                        await new Promise((resolve, reject) => { img.onload = resolve; img.onerror = reject; });
+                        URL.revokeObjectURL(img.src);
+                        canvas.width = thumb.width; canvas.height = thumb.height;
+                        context = canvas.getContext('2d');
+                        context.drawImage(img, 0, 0);
+                    } else {
+                        let pdfDoc = pdfDocCache[url];
+                        if (!pdfDoc) {
+                            const loadingTask = pdfjsLib.getDocument(url);
+                            pdfDoc = await loadingTask.promise;
+                            pdfDocCache[url] = pdfDoc;
+                        }
+                        const page = await pdfDoc.getPage(pageIdx + 1);
+                        const viewport = page.getViewport({ scale: 1 });
+                        const MAX_DIMENSION = 1500;
+                        const scale = Math.min(MAX_DIMENSION / viewport.width, MAX_DIMENSION / viewport.height, 3);
+                        const totalRot = (page.rotate + pageObjRot) % 360;
+                        const rotatedViewport = page.getViewport({ scale: scale, rotation: totalRot });
+                        canvas.width = rotatedViewport.width; canvas.height = rotatedViewport.height;
+                        context = canvas.getContext('2d');
+                        context.fillStyle = '#FFFFFF'; context.fillRect(0, 0, canvas.width, canvas.height);
+
+                        // FIX: Add a timeout to prevent a single bad page from hanging the entire render queue.
+                        const renderPromise = page.render({
+                            canvasContext: context,
+                            viewport: rotatedViewport,
+                            renderInteractiveForms: true // Enable rendering of annotations and forms
+                        }).promise;
+                        const timeoutPromise = new Promise((_, reject) =>
+                            setTimeout(() => reject(new Error('Render timed out after 10 seconds')), 10000)
+                        );
+                        await Promise.race([renderPromise, timeoutPromise]);
+                    }
 
                     const pageObj = findPageObject(pageId);
 
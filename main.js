@@ -1,7 +1,7 @@
 const { app, BrowserWindow, ipcMain, dialog, shell } = require('electron');
 const path = require('path');
 const fs = require('fs');
-const { execFile } = require('child_process');
+const { execFile, spawn } = require('child_process');
 const sharp = require('sharp');
 const { Jimp } = require('jimp');
 const PDFDocumentKit = require('pdfkit');
@@ -97,26 +97,192 @@ ipcMain.handle('save-file-dialog', async (event, options = {}) => {
     }
 });
 
+// Image formats merge_engine.py embeds itself; SVG and AVIF still go through PDFKit
+const ENGINE_IMAGE_EXTS = ['.jpg', '.jpeg', '.png', '.webp', '.tif', '.tiff', '.bmp', '.gif'];
+
+// Path Logic: Use EXE in production, PY in development
+function getEngineCommand(extraArgs) {
+    if (app.isPackaged) {
+        return { cmd: path.join(process.resourcesPath, 'bin', 'merge_engine.exe'), args: extraArgs };
+    }
+    return { cmd: 'python', args: [path.resolve(app.getAppPath(), 'merge_engine.py'), ...extraArgs] };
+}
+
+// One-shot engine run: a fresh interpreter per export (fallback path).
+function runEngineOnce(payloadFilePath) {
+    const { cmd, args } = getEngineCommand([payloadFilePath]);
+    return new Promise((resolve) => {
+        execFile(cmd, args, { maxBuffer: 1024 * 1024 * 50 }, (error, stdout, stderr) => {
+            if (stdout) {
+                try {
+                    return resolve(JSON.parse(stdout.trim()));
+                } catch (e) {
+                    if (!error) return resolve({ success: false, error: "Engine output error: " + stdout.substring(0, 100) });
+                }
+            }
+
+            if (error) return resolve({ success: false, error: stderr || error.message });
+            resolve({ success: false, error: "Engine produced no output" });
+        });
+    });
+}
+
+// Long-lived engines (merge_engine.py --serve) that keep pypdf/fitz/PIL imported
+// between exports. Requests are JSON lines tagged with an id. A daemon answers one
+// request at a time, so exports, viewer pages and grid thumbnails run on separate
+// instances ("lanes"): a long export must not freeze the viewer or the page grid.
+const engineDaemons = {}; // lane -> { proc, pending: Map(id -> { resolve, reject, onEvent }) }
+let engineRequestId = 0;
+
+// A render request that goes this long without an answer or a progress event is
+// abandoned and its lane restarted.
+const RENDER_TIMEOUT_MS = 30000;
+
+function getEngineDaemon(lane) {
+    if (engineDaemons[lane]) return engineDaemons[lane];
+
+    const { cmd, args } = getEngineCommand(['--serve']);
+    const proc = spawn(cmd, args, { stdio: ['pipe', 'pipe', 'pipe'], windowsHide: true });
+    let buffer = '';
+    let stderrTail = '';
+    const daemon = { proc, pending: new Map() };
+
+    proc.stdout.setEncoding('utf8');
+    proc.stdout.on('data', (chunk) => {
+        buffer += chunk;
+        let nl;
+        while ((nl = buffer.indexOf('\n')) >= 0) {
+            const line = buffer.slice(0, nl).trim();
+            buffer = buffer.slice(nl + 1);
+            if (!line) continue;
+            let msg;
+            try { msg = JSON.parse(line); } catch (e) { continue; } // Ignore library chatter
+            const pending = daemon.pending.get(msg.id);
+            if (!pending) continue;
+            if (msg.event) {
+                if (pending.onEvent) pending.onEvent(msg);
+                continue;
+            }
+            daemon.pending.delete(msg.id);
+            pending.resolve(msg);
+        }
+    });
+    proc.stderr.on('data', (chunk) => { stderrTail = (stderrTail + chunk).slice(-4000); });
+    proc.stdin.on('error', () => { });
+
+    const fail = (err) => {
+        if (engineDaemons[lane] === daemon) delete engineDaemons[lane];
+        for (const pending of daemon.pending.values()) pending.reject(new Error(stderrTail || err.message));
+        daemon.pending.clear();
+    };
+    proc.on('error', fail);
+    proc.on('exit', (code) => fail(new Error(`Engine exited with code ${code}`)));
+
+    engineDaemons[lane] = daemon;
+    return daemon;
+}
+
+// `request` carries either { payloadPath } (large jobs) or { payload } (small requests).
+// With `timeoutMs`, a request that goes that long without a response or a progress
+// event is rejected and its lane is killed, so the next request starts on a fresh
+// daemon instead of queueing behind it.
+function runEngineDaemon(op, request, onEvent, { lane = 'export', timeoutMs = 0 } = {}) {
+    return new Promise((resolve, reject) => {
+        let daemon;
+        try { daemon = getEngineDaemon(lane); } catch (e) { return reject(e); }
+        const id = ++engineRequestId;
+        let timer = null;
+        const arm = () => {
+            if (!timeoutMs) return;
+            clearTimeout(timer);
+            timer = setTimeout(() => {
+                daemon.pending.delete(id);
+                reject(new Error(`Engine ${op} timed out after ${timeoutMs / 1000}s`));
+                try { daemon.proc.kill(); } catch (e) { }
+            }, timeoutMs);
+        };
+        arm();
+        daemon.pending.set(id, {
+            resolve: (msg) => { clearTimeout(timer); resolve(msg); },
+            reject: (err) => { clearTimeout(timer); reject(err); },
+            onEvent: (msg) => { arm(); if (onEvent) onEvent(msg); }
+        });
+        daemon.proc.stdin.write(JSON.stringify({ id, op, ...request }) + '\n');
+    });
+}
+
+const RENDER_LANE = { lane: 'render', timeoutMs: RENDER_TIMEOUT_MS };
+// Whole-document thumbnail runs get their own lane so viewer pages never wait behind them
+const THUMBNAIL_LANE = { lane: 'thumbnails', timeoutMs: RENDER_TIMEOUT_MS };
+
+async function runEngine(payloadFilePath, onProgress) {
+    try {
+        const { id, ...result } = await runEngineDaemon('merge', { payloadPath: payloadFilePath }, onProgress);
+        return result;
+    } catch (e) {
+        console.error("Engine daemon unavailable, falling back to one-shot run:", e.message);
+        return runEngineOnce(payloadFilePath);
+    }
+}
+
+// Streamed engine payload: a header line with the job options, then one JSON record per
+// item, per annotated page and per annotation node, so the job is never built as one
+// giant string. Freehand points are packed as base64 little-endian float32 x,y pairs.
+async function writeEnginePayload(filePath, { items, annotationOverlay, ...job }) {
+    const out = fs.createWriteStream(filePath, { encoding: 'utf8' });
+    const failed = new Promise((_, reject) => out.on('error', reject));
+    const write = (record) => out.write(JSON.stringify(record) + '\n') ? null
+        : Promise.race([new Promise((resolve) => out.once('drain', resolve)), failed]);
+
+    await write({ format: 'combine-ndjson/1', ...job });
+    for (const item of items) await write({ item });
+    for (const [id, overlay] of Object.entries(annotationOverlay || {})) {
+        const { nodes, dataUrl, ...page } = overlay || {}; // dataUrl is the UI preview, unused by the engine
+        await write({ overlay: id, ...page });
+        for (const node of nodes || []) {
+            if (!Array.isArray(node.points) || node.points.length === 0) {
+                await write({ node });
+                continue;
+            }
+            const { points, ...rest } = node;
+            const packed = new Float32Array(points.length * 2);
+            points.forEach((p, i) => { packed[2 * i] = p.x; packed[2 * i + 1] = p.y; });
+            await write({ node: { ...rest, packedPoints: Buffer.from(packed.buffer).toString('base64') } });
+        }
+    }
+    await Promise.race([new Promise((resolve) => out.end(resolve)), failed]);
+}
+
+// The engine polls this flag file between pages; creating it cancels the export.
+let activeCancelFile = null;
+
+ipcMain.handle('cancel-export', async () => {
+    if (!activeCancelFile) return false;
+    try { fs.writeFileSync(activeCancelFile, ''); } catch (e) { return false; }
+    return true;
+});
+
 ipcMain.handle('merge-files', async (event, data) => {
-    const { items, outputPath, resizeToFit, metadata, exportOptions, annotationOverlay } = data;
+    const { items, outputPath, resizeToFit, metadata, annotationOverlay } = data;
     const tempDir = path.join(app.getPath('temp'), 'combine-plus-temp');
     if (!fs.existsSync(tempDir)) fs.mkdirSync(tempDir);
 
+    const cancelFile = path.join(tempDir, `cancel_${Date.now()}_${Math.random().toString(36).substr(2, 5)}.flag`);
+    const exportOptions = { ...(data.exportOptions || {}), cancelFile };
+    activeCancelFile = cancelFile;
+
     const processedItems = [];
     const failedFiles = [];
 
-    // Path Logic: Use EXE in production, PY in development
-    const isPackaged = app.isPackaged;
-    const enginePath = isPackaged
-        ? path.join(process.resourcesPath, 'bin', 'merge_engine.exe')
-        : path.resolve(app.getAppPath(), 'merge_engine.py');
-
     try {
         for (const item of items) {
             const ext = path.extname(item.path).toLowerCase();
             const isImage = item.type === 'img' || /\.(jpg|jpeg|png|webp|svg|tif|tiff|avif|bmp|gif)$/i.test(item.path);
 
-            if (isImage) {
+            if (isImage && ENGINE_IMAGE_EXTS.includes(ext)) {
+                // Raster formats are embedded by the engine directly (no temp PDF)
+                processedItems.push({ path: item.path, type: 'img', originalIndex: 0, rot: item.rot || 0, id: item.id, parentName: item.parentName });
+            } else if (isImage) {
                 try {
                     const tempPdfPath = path.join(tempDir, `temp_${Date.now()}_${Math.random().toString(36).substr(2, 9)}.pdf`);
                     let imgData = item.path;
@@ -186,39 +352,63 @@ ipcMain.handle('merge-files', async (event, data) => {
             }
         }
 
-        const payload = JSON.stringify({ items: processedItems, outputPath, resizeToFit: !!resizeToFit, metadata, exportOptions, annotationOverlay });
-
         // Write payload to a temporary file to avoid ENAMETOOLONG OS limits
-        const payloadFilePath = path.join(tempDir, `payload_${Date.now()}_${Math.random().toString(36).substr(2, 5)}.json`);
-        fs.writeFileSync(payloadFilePath, payload, 'utf8');
-
-        return new Promise((resolve) => {
-            const runArgs = isPackaged ? [payloadFilePath] : [enginePath, payloadFilePath];
-            const runCmd = isPackaged ? enginePath : 'python';
-
-            execFile(runCmd, runArgs, { maxBuffer: 1024 * 1024 * 50 }, (error, stdout, stderr) => {
-                try { fs.unlinkSync(payloadFilePath); } catch (e) { }
-                processedItems.filter(i => i.isTemp).forEach(i => { try { fs.unlinkSync(i.path); } catch (e) { } });
-
-                if (stdout) {
-                    try {
-                        return resolve({ ...JSON.parse(stdout.trim()), failedFiles });
-                    } catch (e) {
-                        if (!error) return resolve({ success: false, error: "Engine output error: " + stdout.substring(0, 100) });
-                    }
-                }
+        const payloadFilePath = path.join(tempDir, `payload_${Date.now()}_${Math.random().toString(36).substr(2, 5)}.ndjson`);
+        await writeEnginePayload(payloadFilePath, { items: processedItems, outputPath, resizeToFit: !!resizeToFit, metadata, exportOptions, annotationOverlay });
 
-                if (error) return resolve({ success: false, error: stderr || error.message });
-                resolve({ success: false, error: "Engine produced no output" });
-            });
+        const result = await runEngine(payloadFilePath, (progress) => {
+            const { id, event: kind, ...info } = progress;
+            if (!event.sender.isDestroyed()) event.sender.send('export-progress', info);
         });
+        try { fs.unlinkSync(payloadFilePath); } catch (e) { }
+        processedItems.filter(i => i.isTemp).forEach(i => { try { fs.unlinkSync(i.path); } catch (e) { } });
+        const engineFailed = (result.report && result.report.failedFiles) || [];
+        return { ...result, failedFiles: [...failedFiles, ...engineFailed] };
 
     } catch (err) {
         return { success: false, error: err.message };
+    } finally {
+        try { fs.unlinkSync(cancelFile); } catch (e) { }
+        if (activeCancelFile === cancelFile) activeCancelFile = null;
     }
 });
 
-ipcMain.handle('render-page-view', async (event, { filePath, pageIndex, mode, scale }) => {
+// Pages are rendered by the engine, which keeps documents open and caches renders
+// between calls; the MuPDF JS path is the fallback when the engine is unavailable.
+ipcMain.handle('render-page-view', async (event, { filePath, pageIndex, mode, scale, rotation, clip }) => {
+    try {
+        const result = await runEngineDaemon('render', { payload: { path: filePath, pageIndex, scale, rotation, clip } }, null, RENDER_LANE);
+        if (result.success) {
+            const { data, type, width, height } = result.report;
+            return { success: true, data: Buffer.from(data, 'base64'), type, width, height };
+        }
+        console.error("Engine render failed, falling back to MuPDF JS:", result.error);
+    } catch (e) {
+        console.error("Engine daemon unavailable, falling back to MuPDF JS:", e.message);
+    }
+    return renderPageWithMupdf(filePath, pageIndex, scale);
+});
+
+// With a requestKey, each chunk the engine finishes is forwarded right away on
+// 'thumbnails-chunk'; the response then only holds the pages that were cached.
+ipcMain.handle('render-thumbnails', async (event, { filePath, pages, maxSize, rotation, requestKey }) => {
+    const decode = (thumbnails) => thumbnails.map(({ data, ...info }) => ({ ...info, data: Buffer.from(data, 'base64') }));
+    const onChunk = requestKey ? (progress) => {
+        if (progress.thumbnails && !event.sender.isDestroyed()) {
+            event.sender.send('thumbnails-chunk', { requestKey, type: progress.type, thumbnails: decode(progress.thumbnails) });
+        }
+    } : null;
+    try {
+        const payload = { path: filePath, pages, maxSize, rotation, stream: !!requestKey };
+        const result = await runEngineDaemon('thumbnails', { payload }, onChunk, THUMBNAIL_LANE);
+        if (!result.success) return { success: false, error: result.error };
+        return { success: true, type: result.report.type, thumbnails: decode(result.report.thumbnails) };
+    } catch (e) {
+        return { success: false, error: e.message };
+    }
+});
+
+async function renderPageWithMupdf(filePath, pageIndex, scale) {
     let doc;
     let page;
     try {
@@ -253,6 +443,12 @@ ipcMain.handle('render-page-view', async (event, { filePath, pageIndex, mode, sc
         if (page && page.destroy) page.destroy();
         if (doc && doc.destroy) doc.destroy();
     }
+}
+
+app.on('will-quit', () => {
+    for (const { proc } of Object.values(engineDaemons)) {
+        try { proc.stdin.end(JSON.stringify({ op: 'shutdown' }) + '\n'); } catch (e) { }
+    }
 });
 
 app.on('window-all-closed', () => { if (process.platform !== 'darwin') app.quit(); });
\ No newline at end of file
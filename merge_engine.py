@@ -4,22 +4,1531 @@ import os
 import tempfile
 import io
 import uuid
+import hashlib
+import zlib
 import math
+import base64
+import re
 import shutil
 import time
 import traceback
+import contextlib
+import threading
+import multiprocessing
+import mmap
+import cProfile
+from array import array
+from collections import OrderedDict
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FuturesTimeout
 
 from pypdf import PdfReader, PdfWriter
-from pypdf.generic import NameObject, StreamObject, DictionaryObject, ArrayObject, TextStringObject, ByteStringObject, NumberObject
+from pypdf.generic import NameObject, StreamObject, DictionaryObject, ArrayObject, TextStringObject, ByteStringObject, NumberObject, IndirectObject
+
+try:
+    from PIL import Image, ImageOps
+    has_pil = True
+except ImportError:
+    has_pil = False
 
 try:
     import fitz
-    from PIL import Image
-    has_fitz = True
+    has_fitz = has_pil  # The fitz paths resample images with Pillow
 except ImportError:
     has_fitz = False
 
-def merge_pdfs_hybrid(input_data):
+try:
+    import numpy as np
+    has_numpy = True
+except ImportError:
+    has_numpy = False
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+DEFAULT_MAX_OPEN_SOURCES = 32
+DEFAULT_JPEG_QUALITY = 85
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'combine-plus-cache')
+DEFAULT_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# Raster formats the engine embeds itself; SVG/AVIF are still converted on the Node side
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.tif', '.tiff', '.bmp', '.gif')
+
+PROGRESS_INTERVAL = 0.1  # seconds between throttled per-page progress events
+
+# Groups at or above either threshold are assembled in chunks (exportOptions.streaming='auto')
+DEFAULT_STREAMING_PAGES = 2000
+DEFAULT_STREAMING_BYTES = 1024 * 1024 * 1024
+DEFAULT_STREAM_CHUNK_PAGES = 250
+
+MAX_RUN_PAGES = 500  # longest page run the fitz engine copies between cancel checks
+
+DEFAULT_RENDER_MAX_DOCS = 8
+DEFAULT_RENDER_CACHE_BYTES = 128 * 1024 * 1024
+DEFAULT_THUMBNAIL_SIZE = 256  # pixels along the longest side
+MAX_RENDER_SCALE = 400 / 72  # same zoom cap as the viewer: ~400 DPI
+THUMBNAIL_CHUNK_PAGES = 8  # pages per thumbnail job, and per streamed progress event
+
+DEFAULT_PRINT_SAFE_DPI = 300
+PRINT_SAFE_CHUNK_PAGES = 16  # smallest page chunk handed to a print-safe worker
+
+DEFAULT_ESTIMATE_SAMPLE_PAGES = 64  # pages scanned per source by a dry run; the rest are extrapolated
+MAX_SCANNED_SOURCES = 256
+
+# Per-unit costs (seconds) behind the dry-run time estimate, measured with
+# benchmarks/bench_engine.py on a mid-range laptop; expect +/-50% elsewhere
+ESTIMATE_COSTS = {
+    'page': 0.0003,             # fitz engine page copy
+    'pagePypdf': 0.001,         # pypdf engine page copy
+    'resize': 0.0004,           # resizeToFit, fitz engine
+    'resizePypdf': 0.007,       # resizeToFit, pypdf engine
+    'source': 0.002,            # open + parse one source
+    'imageMegapixel': 0.1,      # decode, resample and JPEG-encode one source megapixel
+    'rasterMegapixel': 0.06,    # print-safe rendering, per output megapixel
+    'annotationPoint': 0.000008,
+    'outputMegabyte': 0.01,
+}
+JPEG_BYTES_PER_PIXEL = {1: 0.12, 3: 0.25}  # typical resampled photo/scan JPEG at the default quality
+RASTER_BYTES_PER_PIXEL = 0.05  # rasterized document pages are mostly paper white
+PAGE_OVERHEAD_BYTES = 250  # page dictionary, xref entry and friends
+OBJECT_OVERHEAD_BYTES = 40  # "n 0 obj" / "endobj" and the xref entry of every copied object
+PART_OVERHEAD_BYTES = 600  # catalog, page tree, info, xref header and trailer of a standalone file
+
+# Image resolutions a split export steps down through, in order, for a page that
+# is over splitMaxBytes on its own
+SPLIT_DPI_STEPS = (150, 120, 96, 72, 60, 50)
+SPLIT_FILL_RATIO = 0.9  # share of splitMaxBytes a part is planned to fill; the rest absorbs prediction error
+
+MANIFEST_VERSION = 1
+# Options that change how fast an export runs, not what it produces
+_MANIFEST_IGNORED_OPTIONS = ('cancelFile', 'workers', 'printSafeWorkers', 'imageThreads', 'profile', 'profileDump',
+                             'maxOpenSources', 'cacheDir', 'cacheMaxBytes', 'imageCache', 'incremental', 'dryRun',
+                             'streaming', 'streamingPages', 'streamingBytes', 'streamChunkPages', 'estimateSamplePages',
+                             'mmapSources', 'splitMaxBytes', 'splitMaxPages')
+
+class ExportCancelled(Exception):
+    """Raised between pages once the caller has asked for the export to stop."""
+
+class MappedSource:
+    """
+    One read-only memory mapping of a source file. fitz parses a zero-copy view of
+    it and every pypdf reader gets its own mmap object over the same pages (pypdf
+    moves a file position around), so the file is paged in from disk at most once
+    however many parsers touch it, and pypdf no longer copies the whole file into
+    memory first.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)  # Raises on empty files
+            self._fileno = os.dup(f.fileno())
+        self.size = len(self._map)
+        self._view = memoryview(self._map)
+        self._streams = []
+
+    def view(self):
+        return self._view
+
+    def stream(self):
+        stream = mmap.mmap(self._fileno, 0, access=mmap.ACCESS_READ)
+        self._streams.append(stream)
+        return stream
+
+    def close(self):
+        """Unmaps the file. Only call once every document parsed from it is closed."""
+        try:
+            self._view.release()
+        except BufferError:
+            pass  # Something still holds a slice; the mapping goes when it does
+        for m in self._streams + [self._map]:
+            try:
+                m.close()
+            except BufferError:
+                pass
+        self._streams = []
+        try:
+            os.close(self._fileno)
+        except OSError:
+            pass
+
+class SourceCache:
+    """
+    Per-export registry of parsed source documents. Each distinct path is opened
+    once and shared by every page that references it; the least recently used
+    handle is closed once more than `max_open` documents are resident. With
+    `mapped`, each file is memory-mapped once and both parsers read from that
+    mapping (see MappedSource); the mapping goes once no document of it is open.
+    Outputs registered with exclude() are never mapped, as Windows refuses to
+    replace a file while a mapping of it is open.
+    """
+
+    def __init__(self, max_open=DEFAULT_MAX_OPEN_SOURCES, profiler=None, mapped=False):
+        self.max_open = max(1, int(max_open))
+        self.profiler = profiler or ExportProfiler()
+        self.mapped = mapped
+        self._docs = OrderedDict()
+        self._maps = {}
+        self._unmapped = set()
+        self.io = {}  # abspath -> {'bytes', 'maps', 'opens': {kind: n}}
+
+    def _get(self, kind, path, opener):
+        abspath = os.path.abspath(path)
+        key = (kind, abspath)
+        doc = self._docs.get(key)
+        if doc is not None:
+            self._docs.move_to_end(key)
+            return doc
+        with self.profiler.stage('readerOpen', source=path):
+            doc = opener(path, self._mapping(abspath))
+        stats = self.io.setdefault(abspath, {'bytes': 0, 'maps': 0, 'opens': {}})
+        stats['opens'][kind] = stats['opens'].get(kind, 0) + 1
+        self._docs[key] = doc
+        while len(self._docs) > self.max_open:
+            (_, evicted_path), evicted = self._docs.popitem(last=False)
+            self._close_doc(evicted)
+            self._unmap_unused(evicted_path)
+        return doc
+
+    @staticmethod
+    def _file_key(path):
+        return os.path.normcase(os.path.realpath(path))
+
+    def _mapping(self, abspath):
+        if not self.mapped or self._file_key(abspath) in self._unmapped:
+            return None
+        source = self._maps.get(abspath)
+        if source is None:
+            try:
+                source = MappedSource(abspath)
+            except (OSError, ValueError):
+                return None  # Empty file or no mmap support here: open it by path
+            self._maps[abspath] = source
+            stats = self.io.setdefault(abspath, {'bytes': 0, 'maps': 0, 'opens': {}})
+            stats['bytes'] += source.size
+            stats['maps'] += 1
+        return source
+
+    def _unmap_unused(self, abspath):
+        if abspath in self._maps and not any(k[1] == abspath for k in self._docs):
+            self._maps.pop(abspath).close()
+
+    def reader(self, path):
+        return self._get('pypdf', path, lambda p, m: PdfReader(m.stream() if m else p, strict=False))
+
+    def fitz_doc(self, path):
+        def open_doc(p, m):
+            if m is None:
+                return fitz.open(p)
+            return fitz.open(stream=m.view(), filetype=os.path.splitext(p)[1][1:].lower() or 'pdf')
+        return self._get('fitz', path, open_doc)
+
+    def release(self, path):
+        """Closes every handle held for `path` (e.g. before the file is deleted)."""
+        abspath = os.path.abspath(path)
+        for key in [k for k in self._docs if k[1] == abspath]:
+            self._close_doc(self._docs.pop(key))
+        self._unmap_unused(abspath)
+
+    def exclude(self, output_path):
+        """
+        Marks `output_path` as written by this export: a source that resolves to it is
+        unmapped now and read without a mapping from then on (pypdf buffers the file).
+        """
+        key = self._file_key(output_path)
+        self._unmapped.add(key)
+        for abspath in [p for p in self._maps if self._file_key(p) == key]:
+            self.release(abspath)
+
+    @staticmethod
+    def _close_doc(doc):
+        try:
+            doc.close()
+        except Exception:
+            pass
+
+    def close(self):
+        while self._docs:
+            _, doc = self._docs.popitem(last=False)
+            self._close_doc(doc)
+        while self._maps:
+            self._maps.popitem()[1].close()
+
+    def io_report(self):
+        """Per-source read accounting for the export report."""
+        sources = {}
+        for abspath, stats in self.io.items():
+            read_bytes = stats['bytes']
+            if not stats['maps']:
+                # Opened by path: pypdf reads the whole file, fitz at most all of it
+                try:
+                    read_bytes = os.path.getsize(abspath) * sum(stats['opens'].values())
+                except OSError:
+                    read_bytes = 0
+            sources[abspath] = {'readBytes': read_bytes, 'maps': stats['maps'], 'opens': dict(stats['opens'])}
+        return sources
+
+class ImageCache:
+    """
+    Content-addressed on-disk cache of transcoded images, shared across exports and
+    engine processes. Entries are keyed by a hash of the source image stream plus the
+    optimization parameters, written atomically, and evicted least-recently-used
+    (by mtime) once the directory grows past `max_bytes`.
+    """
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self._dirty = False
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+        except OSError as e:
+            print(f"Image cache unavailable at {cache_dir}: {e}", file=sys.stderr)
+
+    @staticmethod
+    def make_key(doc, img_info, new_size, target_dpi, trigger_dpi, quality):
+        """Hashes the raw (still encoded) image stream together with everything that shapes the output."""
+        xref, _, width, height, bpc, colorspace, alt_colorspace, _, img_filter = img_info[:9]
+        h = hashlib.sha256()
+        h.update(doc.xref_stream_raw(xref) or b"")
+        for key in ("DecodeParms", "Decode"):
+            h.update(repr(doc.xref_get_key(xref, key)).encode())
+        h.update(repr((width, height, bpc, colorspace, alt_colorspace, img_filter,
+                       tuple(new_size), target_dpi, trigger_dpi, quality)).encode())
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".jpg")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)  # Mark as recently used
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    def put(self, key, data):
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".part")
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            # Atomic publish: concurrent engines either see the whole entry or none
+            os.replace(temp_path, path)
+            self._dirty = True
+        except OSError as e:
+            print(f"Image cache write failed for {key}: {e}", file=sys.stderr)
+
+    def prune(self):
+        """Deletes the least recently used entries until the cache fits in max_bytes."""
+        if not self._dirty:
+            return
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass  # Already evicted by another engine process
+            total -= size
+
+def _windows_memory_counters():
+    """PROCESS_MEMORY_COUNTERS of this process on Windows, or None."""
+    try:
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD),
+                        ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                        ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                        ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        if ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(),
+                                                    ctypes.byref(counters), counters.cb):
+            return counters
+    except Exception:
+        pass
+    return None
+
+def _peak_rss_bytes():
+    """
+    Peak resident set size over the whole life of this process, or None where it
+    cannot be read. Under --serve that spans every request served so far.
+    """
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024  # Linux reports KiB
+    counters = _windows_memory_counters()
+    return counters.PeakWorkingSetSize if counters is not None else None
+
+def _rss_bytes():
+    """Current resident set size of this process, or None where it cannot be read."""
+    try:
+        with open('/proc/self/statm', 'rb') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    counters = _windows_memory_counters()
+    return counters.WorkingSetSize if counters is not None else None
+
+def _process_read_bytes():
+    """
+    Bytes this process has read so far as {'disk': fetched from storage, including
+    mmap page-ins; 'calls': returned by read calls}, with whichever counters this
+    platform has.
+    """
+    counters = {}
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line)
+        counters['disk'] = int(fields['read_bytes'])
+        counters['calls'] = int(fields['rchar'])
+        return counters
+    except (OSError, KeyError, ValueError):
+        pass
+    if resource is not None:
+        counters['disk'] = resource.getrusage(resource.RUSAGE_SELF).ru_inblock * 512
+        return counters
+    try:
+        import ctypes
+
+        class IO_COUNTERS(ctypes.Structure):
+            _fields_ = [(name, ctypes.c_ulonglong) for name in (
+                "ReadOperationCount", "WriteOperationCount", "OtherOperationCount",
+                "ReadTransferCount", "WriteTransferCount", "OtherTransferCount")]
+
+        io_counters = IO_COUNTERS()
+        if ctypes.windll.kernel32.GetProcessIoCounters(ctypes.windll.kernel32.GetCurrentProcess(),
+                                                      ctypes.byref(io_counters)):
+            counters['calls'] = io_counters.ReadTransferCount
+    except Exception:
+        pass
+    return counters
+
+class PageRenderer:
+    """
+    Long-lived page renderer behind the viewer and the page grid. Source documents
+    stay open in a SourceCache LRU and encoded renders are kept in a byte-bounded LRU
+    keyed by (path, mtime, page, scale, rotation, clip, format), so zooming and paging
+    through a large scan never rereads or reparses the file. Editing a file changes
+    its mtime, which reopens the document and bypasses its old renders.
+    """
+
+    def __init__(self, max_docs=DEFAULT_RENDER_MAX_DOCS, max_bytes=DEFAULT_RENDER_CACHE_BYTES):
+        self.sources = SourceCache(max_docs)
+        self.max_bytes = int(max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self._mtimes = {}
+        self._renders = OrderedDict()
+        self._bytes = 0
+        self._pool = None
+        self._pool_size = 0
+
+    def _doc(self, path, mtime):
+        abspath = os.path.abspath(path)
+        if self._mtimes.get(abspath, mtime) != mtime:
+            self.sources.release(path)  # The file changed under us
+        self._mtimes[abspath] = mtime
+        return self.sources.fitz_doc(path)
+
+    def _get(self, key):
+        entry = self._renders.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._renders.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def _put(self, key, entry):
+        if key in self._renders:
+            return
+        self._renders[key] = entry
+        self._bytes += len(entry[2])
+        while self._bytes > self.max_bytes and len(self._renders) > 1:
+            _, evicted = self._renders.popitem(last=False)
+            self._bytes -= len(evicted[2])
+
+    def render(self, path, page_index, scale=1.0, rotation=0, clip=None, fmt='png'):
+        """
+        Renders one page, or the `clip` rectangle of it (page.rect coordinates at
+        scale 1), at `scale` plus an extra `rotation`. Returns (width, height, bytes).
+        """
+        scale = round(min(max(float(scale), 0.01), MAX_RENDER_SCALE), 4)
+        rotation = int(rotation) % 360
+        clip = tuple(round(float(v), 2) for v in clip) if clip else None
+        mtime = os.path.getmtime(path)
+        key = (os.path.abspath(path), mtime, int(page_index), scale, rotation, clip, fmt)
+        entry = self._get(key)
+        if entry is None:
+            page = self._doc(path, mtime)[int(page_index)]
+            pix = page.get_pixmap(matrix=fitz.Matrix(scale, scale).prerotate(rotation),
+                                  clip=fitz.Rect(clip) if clip else None, colorspace=fitz.csRGB, alpha=False)
+            entry = (pix.width, pix.height, pix.tobytes(fmt))
+            self._put(key, entry)
+        return entry
+
+    def thumbnails(self, path, pages=None, max_size=DEFAULT_THUMBNAIL_SIZE, rotation=0, fmt='png',
+                   workers=0, on_chunk=None):
+        """
+        Renders thumbnails no larger than `max_size` pixels for `pages` (default: every
+        page) and returns [(page_index, width, height, bytes)] in page order. Pages not
+        in the render cache are split into chunks rendered on a process pool that is
+        kept for later calls; `on_chunk(done, total, chunk)` is called as each chunk
+        finishes, with that chunk's [(page_index, width, height, bytes)].
+        """
+        mtime = os.path.getmtime(path)
+        abspath = os.path.abspath(path)
+        rotation = int(rotation) % 360
+        page_count = len(self._doc(path, mtime))
+        pages = [int(p) for p in pages] if pages is not None else range(page_count)
+        pages = [p for p in pages if 0 <= p < page_count]
+
+        def key(page_index):
+            return (abspath, mtime, page_index, ('fit', int(max_size)), rotation, None, fmt)
+
+        results = {}
+        missing = []
+        for page_index in pages:
+            entry = self._get(key(page_index))
+            if entry is None:
+                missing.append(page_index)
+            else:
+                results[page_index] = entry
+
+        if missing:
+            pool_size = _resolve_workers(workers, max(1, len(missing) // THUMBNAIL_CHUNK_PAGES))
+            # Small chunks keep every worker busy and let callers show results early
+            chunk = THUMBNAIL_CHUNK_PAGES
+            jobs = [(path, missing[i:i + chunk], max_size, rotation, fmt) for i in range(0, len(missing), chunk)]
+            if pool_size > 1:
+                if self._pool_size < pool_size:
+                    if self._pool is not None:
+                        self._pool.shutdown(wait=False)
+                    self._pool = ProcessPoolExecutor(max_workers=pool_size)
+                    self._pool_size = pool_size
+                rendered = self._pool.map(_thumbnail_job, jobs)
+            else:
+                doc = self._doc(path, mtime)
+                rendered = ([(p, *_render_thumbnail(doc, p, max_size, rotation, fmt)) for p in job[1]] for job in jobs)
+            for chunk_result in rendered:
+                for page_index, width, height, data in chunk_result:
+                    results[page_index] = (width, height, data)
+                    self._put(key(page_index), (width, height, data))
+                if on_chunk is not None:
+                    on_chunk(len(results), len(pages), chunk_result)
+
+        return [(p, *results[p]) for p in pages if p in results]
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+            self._pool_size = 0
+        self.sources.close()
+        self._renders.clear()
+        self._bytes = 0
+
+class ExportProfiler:
+    """
+    Opt-in (exportOptions.profile) accounting of where an export spends its time.
+    Each stage records wall time and call count, overall and broken down per output
+    group and per source file, plus the largest current RSS seen when it finished
+    (rssBytes) and the most RSS one call grew by (rssGrowthBytes). The report's
+    top-level peakRssBytes is the process peak, which under --serve covers every
+    request so far. When disabled every hook is a no-op, so the export path carries
+    no extra cost.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = bool(enabled)
+        self.group = None
+        self.stages = {}
+        self.groups = {}
+        self.sources = {}
+        self.counts = {"pages": 0, "images": 0, "bytesIn": 0, "bytesOut": 0}
+        self._aliases = {}
+        self._lock = threading.Lock()
+
+    def stage(self, name, source=None):
+        """Context manager timing one stage; `source` attributes it to an input file."""
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self._timed(name, source)
+
+    @contextlib.contextmanager
+    def _timed(self, name, source):
+        rss_before = _rss_bytes()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started, source, rss_before)
+
+    def wrap(self, name, fn, source=None):
+        """Returns `fn` timed as stage `name`; used for work submitted to thread pools."""
+        if not self.enabled:
+            return fn
+
+        def timed(*args, **kwargs):
+            with self._timed(name, source):
+                return fn(*args, **kwargs)
+        return timed
+
+    def add(self, name, seconds, source=None, rss_before=None):
+        if not self.enabled:
+            return
+        rss = _rss_bytes()
+        with self._lock:
+            entry = self.stages.setdefault(name, {"seconds": 0.0, "calls": 0, "rssBytes": 0, "rssGrowthBytes": 0})
+            entry["seconds"] += seconds
+            entry["calls"] += 1
+            entry["rssBytes"] = max(entry["rssBytes"], rss or 0)
+            if rss is not None and rss_before is not None:
+                entry["rssGrowthBytes"] = max(entry["rssGrowthBytes"], rss - rss_before)
+            if self.group is not None:
+                group = self.groups.setdefault(self.group, {})
+                group[name] = group.get(name, 0.0) + seconds
+            if source is not None:
+                src = self.sources.setdefault(self._label(source), {})
+                src[name] = src.get(name, 0.0) + seconds
+
+    def alias(self, temp_path, source):
+        """Attributes work on an intermediate file (e.g. an optimized copy) to its source."""
+        if self.enabled:
+            self._aliases[os.path.abspath(temp_path)] = self._label(source)
+
+    def _label(self, path):
+        return self._aliases.get(os.path.abspath(path), os.path.basename(path))
+
+    def count(self, key, n=1):
+        if self.enabled:
+            with self._lock:
+                self.counts[key] += n
+
+    def count_source(self, path):
+        """Adds an input file's size to bytesIn once per export."""
+        if not self.enabled:
+            return
+        src = self.sources.setdefault(self._label(path), {})
+        if "bytes" not in src:
+            try:
+                src["bytes"] = os.path.getsize(path)
+            except OSError:
+                src["bytes"] = 0
+            self.count("bytesIn", src["bytes"])
+
+    def as_dict(self):
+        return {
+            "stages": self.stages,
+            "groups": self.groups,
+            "sources": self.sources,
+            "counts": self.counts,
+            "peakRssBytes": _peak_rss_bytes() or 0,
+        }
+
+def _transcode_image(samples, mode, size, new_size, quality=DEFAULT_JPEG_QUALITY):
+    """Resamples raw pixmap samples with Pillow and returns JPEG bytes (releases the GIL)."""
+    img = Image.frombytes(mode, size, samples)
+    img = img.resize(new_size, Image.Resampling.LANCZOS)
+    out = io.BytesIO()
+    img.save(out, format="JPEG", quality=quality)
+    return out.getvalue()
+
+def _is_image_item(item):
+    return item.get('type') == 'img' or os.path.splitext(item.get('path') or '')[1].lower() in IMAGE_EXTENSIONS
+
+def _exif_orientation(img):
+    """EXIF Orientation of an open Pillow image (1, upright, when absent or unreadable)."""
+    try:
+        return img.getexif().get(0x0112, 1) or 1
+    except Exception:
+        return 1
+
+def _prepare_image(path, fit_width=None, target_dpi=None, trigger_dpi=None, quality=DEFAULT_JPEG_QUALITY):
+    """
+    Decodes one raster image with Pillow and returns (width, height, image_bytes,
+    downsampled). The page keeps the image's pixel size in points, like the old
+    PDFKit conversion. With `target_dpi` set, images above `trigger_dpi` at their
+    printed width (`fit_width` points when pages are resized to fit) are resampled
+    to `target_dpi` first. Images with an EXIF Orientation are turned upright, as
+    the UI shows them, and re-encoded; other untouched JPEG/PNG files are passed
+    through as-is.
+    """
+    with Image.open(path) as img:
+        source_format = img.format
+        oriented = _exif_orientation(img) != 1
+        if oriented:
+            img = ImageOps.exif_transpose(img)
+        width, height = img.size
+        max_px = None
+        if target_dpi:
+            printed_inches = (fit_width or width) / 72.0
+            if width / printed_inches > max(trigger_dpi or 0, target_dpi):
+                max_px = max(1, int(printed_inches * target_dpi))
+
+        if max_px is None and not oriented and source_format in ('JPEG', 'PNG'):
+            with open(path, 'rb') as f:
+                return width, height, f.read(), False
+
+        # Only the first frame of animated / multi-page files is used
+        if img.mode not in ('L', 'LA', 'RGB', 'RGBA'):
+            has_alpha = 'transparency' in img.info or img.mode.endswith('A')
+            img = img.convert('RGBA' if has_alpha else 'RGB')
+
+        downsampled = max_px is not None
+        if downsampled:
+            img = img.resize((max_px, max(1, round(height * max_px / width))), Image.Resampling.LANCZOS)
+
+        out = io.BytesIO()
+        if (downsampled or source_format == 'JPEG') and img.mode in ('L', 'RGB'):
+            img.save(out, format="JPEG", quality=quality)
+        else:
+            img.save(out, format="PNG")
+        return width, height, out.getvalue(), downsampled
+
+def _wants_streaming(items, export_options):
+    """
+    Decides whether a group is assembled in chunks. exportOptions.streaming True/False
+    forces it; 'auto' (the default) switches it on once the group reaches
+    streamingPages pages or its distinct inputs add up to streamingBytes.
+    """
+    setting = export_options.get('streaming', 'auto')
+    if setting != 'auto':
+        return bool(setting)
+    if len(items) >= int(export_options.get('streamingPages', DEFAULT_STREAMING_PAGES)):
+        return True
+    total = 0
+    for path in {item.get('path') for item in items if item.get('path')}:
+        try:
+            total += os.path.getsize(path)
+        except OSError:
+            pass
+    return total >= int(export_options.get('streamingBytes', DEFAULT_STREAMING_BYTES))
+
+# Objects whose identity matters (tree nodes, per-page annotations) are never merged
+_DEDUPE_SKIP_TYPES = ('/Page', '/Pages', '/Catalog', '/Annot', '/StructTreeRoot', '/StructElem', '/Outlines')
+
+def _dedupe_objects(writer):
+    """
+    Collapses identical objects in a PdfWriter (embedded fonts, images, form XObjects,
+    ICC profiles, ...) into one shared object before it is written. Objects are keyed
+    by a SHA-256 of their serialized form, and passes repeat until no more merges
+    happen, so e.g. font dictionaries whose font files were just merged collapse too.
+    Returns (objects_removed, bytes_saved).
+    """
+    stream_digests = {}  # Stream payloads never change between passes
+    removed = 0
+    saved = 0
+
+    def key_of(obj):
+        buf = io.BytesIO()
+        if isinstance(obj, StreamObject):
+            DictionaryObject.write_to_stream(obj, buf)
+            digest = stream_digests.get(id(obj))
+            if digest is None:
+                digest = stream_digests[id(obj)] = hashlib.sha256(obj._data).digest()
+            buf.write(digest)
+            return b"S" + hashlib.sha256(buf.getvalue()).digest(), len(obj._data) + buf.tell()
+        obj.write_to_stream(buf)
+        return b"O" + hashlib.sha256(buf.getvalue()).digest(), buf.tell()
+
+    def remap(obj, mapping):
+        if isinstance(obj, DictionaryObject):
+            entries = obj.items()
+        elif isinstance(obj, ArrayObject):
+            entries = enumerate(obj)
+        else:
+            return
+        for k, v in list(entries):
+            if isinstance(v, IndirectObject):
+                target = mapping.get(v.idnum)
+                if target is not None:
+                    obj[k] = target
+            else:
+                remap(v, mapping)
+
+    while True:
+        canonical = {}
+        mapping = {}
+        for idx, obj in enumerate(writer._objects):
+            if not isinstance(obj, (DictionaryObject, ArrayObject)):
+                continue
+            if isinstance(obj, DictionaryObject) and (
+                    obj.get('/Type') in _DEDUPE_SKIP_TYPES or '/Parent' in obj or '/P' in obj):
+                continue
+            key, size = key_of(obj)
+            first = canonical.get(key)
+            if first is None:
+                canonical[key] = obj.indirect_reference
+                continue
+            mapping[idx + 1] = first
+            writer._objects[idx] = None
+            removed += 1
+            saved += size
+        if not mapping:
+            return removed, saved
+        for obj in writer._objects:
+            remap(obj, mapping)
+
+def _plan_runs(entries, max_run=MAX_RUN_PAGES, max_open=None):
+    """
+    Assembly planner: coalesces resolved pages, given as (source, page_index,
+    rotation, item_no) in output order, into runs of consecutive pages of one source
+    sharing one rotation. Returns [source, first_page, last_page, rotation,
+    last_item_no, final] lists; runs stop at `max_run` pages so cancellation and
+    progress stay responsive during very long copies.
+
+    `final` tells insert_pdf to drop the source's graft map after the run, as the
+    map holds the source document open until the output closes. It is set on a
+    source's last run and, for sources opened by path, on a run after which
+    `max_open` other path sources come before its next one: the SourceCache has
+    evicted it by then, and the reopened document gets a map of its own.
+    """
+    runs = []
+    for source, page_index, rotation, item_no in entries:
+        run = runs[-1] if runs else None
+        if (run is not None and run[0] == source and run[2] + 1 == page_index
+                and run[3] == rotation and run[2] - run[1] + 1 < max_run):
+            run[2] = page_index
+            run[4] = item_no
+        else:
+            runs.append([source, page_index, page_index, rotation, item_no])
+
+    for run_no, run in enumerate(runs):
+        final, others = True, set()
+        for later in runs[run_no + 1:]:
+            if later[0] is run[0] or (isinstance(run[0], str) and later[0] == run[0]):
+                final = False
+                break
+            if isinstance(later[0], str):
+                others.add(later[0])
+                if max_open and isinstance(run[0], str) and len(others) >= max_open:
+                    break
+        run.append(final)
+    return runs
+
+def _scale_fitz_page(doc, page, scale, cache):
+    """
+    fitz counterpart of pypdf's PageObject.scale_by: wraps the page content in a
+    scaling `cm`, scales every page box and annotation rect, and leaves /Rotate alone.
+    The original content streams are untouched, so pages sharing them stay correct;
+    the small wrapper streams are reused per scale factor through `cache`.
+    """
+    xref = page.xref
+    for key in ("MediaBox", "CropBox", "BleedBox", "TrimBox", "ArtBox"):
+        kind, value = doc.xref_get_key(xref, key)
+        if kind == 'array':
+            coords = [float(v) * scale for v in value.strip('[]').split()]
+            doc.xref_set_key(xref, key, "[" + " ".join(f"{v:.4f}" for v in coords) + "]")
+
+    for annot_xref in page.annot_xrefs():
+        annot_xref = annot_xref[0]
+        if ('annot', annot_xref) in cache:
+            continue  # Shared with a page that was already scaled
+        cache[('annot', annot_xref)] = True
+        kind, value = doc.xref_get_key(annot_xref, "Rect")
+        if kind == 'array':
+            coords = [float(v) * scale for v in value.strip('[]').split()]
+            doc.xref_set_key(annot_xref, "Rect", "[" + " ".join(f"{v:.4f}" for v in coords) + "]")
+
+    wrappers = cache.get(scale)
+    if wrappers is None:
+        wrappers = []
+        for data in (f"q {scale:.6f} 0 0 {scale:.6f} 0 0 cm\n".encode(), b"\nQ"):
+            wrapper = doc.get_new_xref()
+            doc.update_object(wrapper, "<<>>")
+            doc.update_stream(wrapper, data)
+            wrappers.append(wrapper)
+        cache[scale] = wrappers
+    contents = [wrappers[0]] + page.get_contents() + [wrappers[1]]
+    doc.xref_set_key(xref, "Contents", "[" + " ".join(f"{x} 0 R" for x in contents) + "]")
+
+_GS_ALPHA_RE = re.compile(r"/(?:ca|CA)\s*([0-9.]+)")
+_GS_BLEND_RE = re.compile(r"/BM\s*(?:\[|/(\w+))")
+_GS_SMASK_RE = re.compile(r"/SMask\s*(?:<<|\d+\s+\d+\s+R)")
+
+def _page_transparency(doc, page, mask_cache):
+    """
+    Decides how `page` of `doc` has to be made print-safe. Returns (None, []) when it
+    uses no transparency, ('vector', opaque_mask_image_xrefs) when transparency is only
+    declared (groups, fully opaque soft masks) and stripping the markers changes
+    nothing visible, and ('raster', []) when alpha, soft masks or blend modes are
+    actually painted. `mask_cache` remembers soft-mask verdicts across pages.
+    """
+    declared = False
+    for xref in [page.xref] + [x[0] for x in page.get_xobjects()]:
+        if doc.xref_get_key(xref, "Group")[0] != 'null':
+            declared = True
+        kind, states = doc.xref_get_key(xref, "Resources/ExtGState")
+        if kind == 'null':
+            continue
+        if kind == 'xref':
+            states = doc.xref_object(int(states.split()[0]), compressed=True)
+        states = re.sub(r"(\d+) 0 R", lambda m: doc.xref_object(int(m.group(1)), compressed=True), states)
+        if _GS_SMASK_RE.search(states):
+            return 'raster', []
+        for match in _GS_BLEND_RE.finditer(states):
+            if match.group(1) not in ('Normal', 'Compatible'):
+                return 'raster', []
+        for match in _GS_ALPHA_RE.finditer(states):
+            try:
+                if float(match.group(1)) < 1.0:
+                    return 'raster', []
+            except ValueError:
+                pass
+
+    opaque_masks = []
+    for img in page.get_images(full=True):
+        xref, smask = img[0], img[1]
+        if smask <= 0:
+            continue
+        if smask not in mask_cache:
+            # A mask that is 255 everywhere hides nothing and can simply be dropped
+            mask_cache[smask] = not fitz.Pixmap(doc, smask).samples.strip(b"\xff")
+        if not mask_cache[smask]:
+            return 'raster', []
+        opaque_masks.append(xref)
+
+    if declared or opaque_masks:
+        return 'vector', opaque_masks
+    return None, []
+
+def flatten_page_raster(doc, page_idx, out, dpi=DEFAULT_PRINT_SAFE_DPI, quality=DEFAULT_JPEG_QUALITY):
+    """Renders a page of `doc` at `dpi` and appends it to `out` as an opaque image page of the same visible size."""
+    page = doc[page_idx]
+    pix = page.get_pixmap(dpi=dpi, colorspace=fitz.csRGB, alpha=False)
+    new_page = out.new_page(width=page.rect.width, height=page.rect.height)
+    new_page.insert_image(new_page.rect, stream=pix.tobytes("jpeg", jpg_quality=quality))
+
+def sanitize_page_transparency(doc, page, opaque_masks):
+    """Removes transparency markers from `page` in place without rasterizing (vector preservation)."""
+    # The /Group attribute triggers 'Transparency used' in preflight even when nothing is see-through
+    for xref in [page.xref] + [x[0] for x in page.get_xobjects()]:
+        if doc.xref_get_key(xref, "Group")[0] != 'null':
+            doc.xref_set_key(xref, "Group", "null")
+    for xref in opaque_masks:
+        doc.xref_set_key(xref, "SMask", "null")
+
+_worker_sources = OrderedDict()
+
+def _worker_source(path, max_open=4):
+    """Print-safe workers keep their last few sources open, so each is parsed once per process."""
+    key = (os.path.abspath(path), os.path.getmtime(path))
+    doc = _worker_sources.pop(key, None)
+    if doc is None:
+        doc = fitz.open(path)
+    _worker_sources[key] = doc
+    while len(_worker_sources) > max_open:
+        _worker_sources.popitem(last=False)[1].close()
+    return doc
+
+def _close_worker_sources():
+    while _worker_sources:
+        _worker_sources.popitem(last=False)[1].close()
+
+def _print_safe_job(job):
+    """
+    Process-pool entry point for print-safe mode: copies `pages` of one source into a
+    new document, sanitizing or rasterizing each page as needed ('raster' policy
+    rasterizes all of them). Returns the PDF bytes and a (page_index, action) pair per
+    copied page, where action is None, 'vector' or 'raster'.
+    """
+    path, pages, policy, dpi, quality = job
+    src = _worker_source(path)
+    out = fitz.open()
+    mask_cache = {}
+    done = []
+    try:
+        for page_idx in pages:
+            if not 0 <= page_idx < len(src):
+                continue
+            out.insert_pdf(src, from_page=page_idx, to_page=page_idx, final=False)
+            page = out[-1]
+            opaque_masks = []
+            if policy == 'raster':
+                action = 'raster'
+            else:
+                try:
+                    action, opaque_masks = _page_transparency(out, page, mask_cache)
+                    # insert_pdf does not copy the page's own /Group, so the copy cannot show
+                    # it: a group declared on the source page still makes this a vector fix
+                    if action is None and src.xref_get_key(src[page_idx].xref, "Group")[0] != 'null':
+                        action = 'vector'
+                except Exception:
+                    action = 'raster'  # Resources we can't read can't be trusted either
+            if action == 'vector':
+                sanitize_page_transparency(out, page, opaque_masks)
+            elif action == 'raster':
+                out.delete_page(-1)
+                flatten_page_raster(src, page_idx, out, dpi, quality)
+            done.append((page_idx, action))
+        return out.tobytes(garbage=1, deflate=True), done
+    finally:
+        out.close()
+
+def _render_thumbnail(doc, page_index, max_size, rotation=0, fmt='png'):
+    """Renders page `page_index` of `doc` so its longest side is at most `max_size` pixels; returns (width, height, bytes)."""
+    page = doc[page_index]
+    rect = page.rect
+    scale = min(max_size / max(rect.width, rect.height, 1), MAX_RENDER_SCALE)
+    pix = page.get_pixmap(matrix=fitz.Matrix(scale, scale).prerotate(rotation), colorspace=fitz.csRGB, alpha=False)
+    return pix.width, pix.height, pix.tobytes(fmt)
+
+def _thumbnail_job(job):
+    """Process-pool entry point for PageRenderer.thumbnails: renders one chunk of pages of one source."""
+    path, pages, max_size, rotation, fmt = job
+    doc = _worker_source(path)
+    return [(page_index, *_render_thumbnail(doc, page_index, max_size, rotation, fmt))
+            for page_index in pages if 0 <= page_index < len(doc)]
+
+_page_scans = OrderedDict()  # (path, mtime, size) -> scanned page metadata, kept across requests
+
+def _stream_length(doc, xref, path="Length"):
+    """Declared length of a stream (or of the stream object at `path`), without reading its data."""
+    kind, value = doc.xref_get_key(xref, path)
+    if kind == 'xref':
+        value = doc.xref_object(int(value.split()[0]), compressed=True)
+    try:
+        return int(value)
+    except ValueError:
+        return 0
+
+def _deflated_length(doc, xref, length, sample_bytes=1024 * 1024):
+    """Likely size of unfiltered stream `xref` once the export deflates it, from compressing a sample."""
+    data = doc.xref_stream_raw(xref)
+    if not data:
+        return length
+    sample = data[:sample_bytes]
+    return int(length * len(zlib.compress(sample, 1)) / len(sample))
+
+def _font_file_bytes(doc, xref):
+    """Size of the font program embedded for font `xref` (0 when it isn't embedded)."""
+    kind, value = doc.xref_get_key(xref, "DescendantFonts")
+    if kind == 'xref':
+        value = doc.xref_object(int(value.split()[0]), compressed=True)
+    if kind in ('array', 'xref'):
+        refs = re.findall(r"(\d+) 0 R", value)
+        if refs:
+            xref = int(refs[0])
+    for key in ("FontFile", "FontFile2", "FontFile3"):
+        length = _stream_length(doc, xref, f"FontDescriptor/{key}/Length")
+        if length:
+            return length
+    return 0
+
+def _resource_objects(doc, page, objects):
+    """
+    Objects a copy of `page` brings along besides its content streams and image data:
+    fonts with their descriptors, widths and programs, form XObjects, patterns,
+    graphics states, soft masks, annotations. Returns [(xref, bytes)], bytes being the
+    object as written. `objects` caches (bytes, referenced xrefs) per xref of `doc`.
+    """
+    contents = set(page.get_contents())
+    images = {img[0] for img in page.get_images(full=True)}
+    refs = []
+    for key in doc.xref_get_keys(page.xref):
+        if key not in ('Parent', 'Contents'):
+            refs += re.findall(r"(\d+) \d+ R", doc.xref_get_key(page.xref, key)[1])
+    parent = page.xref
+    while 'Resources' not in doc.xref_get_keys(parent):  # Inherited from the page tree
+        kind, value = doc.xref_get_key(parent, 'Parent')
+        if kind != 'xref':
+            break
+        parent = int(value.split()[0])
+        kind, value = doc.xref_get_key(parent, 'Resources')
+        if kind != 'null':
+            refs += re.findall(r"(\d+) \d+ R", value)
+            break
+
+    found = OrderedDict()
+    todo = [int(ref) for ref in refs]
+    seen = {page.xref} | contents
+    while todo:
+        xref = todo.pop()
+        if xref in seen or not 0 < xref < doc.xref_length():
+            continue
+        seen.add(xref)
+        if xref not in objects:
+            if doc.xref_get_key(xref, 'Type')[1] in ('/Page', '/Pages', '/Catalog'):
+                objects[xref] = None  # Link targets and back references are not copied along
+            else:
+                text = doc.xref_object(xref, compressed=True)
+                size = len(text) + OBJECT_OVERHEAD_BYTES
+                if doc.xref_is_stream(xref):
+                    size += _stream_length(doc, xref)
+                objects[xref] = (size, [int(ref) for ref in re.findall(r"(\d+) \d+ R", text)])
+        if objects[xref] is None:
+            continue
+        size, children = objects[xref]
+        if xref in images:  # The image data itself is charged from the images list
+            size = OBJECT_OVERHEAD_BYTES
+        found[xref] = size
+        todo += children
+    return list(found.items())
+
+def _scan_page(doc, page_index, transparency=False, objects=None):
+    """
+    Size-relevant metadata of one page: content bytes, images (with their largest
+    placement), fonts and every other object copied along with it (see
+    _resource_objects; `objects` caches them across the pages of `doc`).
+    """
+    page = doc[page_index]
+    images = []
+    page_images = page.get_images(full=True)
+    # get_image_rects decodes the image to identify it; a page showing exactly one
+    # image (the usual scan) gets its placement from the bbox log without decoding
+    fills = [rect for kind, rect in page.get_bboxlog() if kind == 'fill-image'] if len(page_images) == 1 else []
+    for img in page_images:
+        xref, smask, width, height = img[:4]
+        if len(fills) == 1:
+            shown = fitz.Rect(fills[0]).width
+        else:
+            shown = max((rect.width for rect in page.get_image_rects(xref)), default=0.0)
+        components = 1 if 'Gray' in img[5] else 3
+        length = _stream_length(doc, xref)
+        # Unfiltered images come out deflated when fitz writes the output
+        deflated = _deflated_length(doc, xref, length) if not img[8] else length
+        images.append((xref, width, height, length, shown, smask, components, deflated))
+    scan = {
+        'content': sum(_stream_length(doc, xref) for xref in page.get_contents()),
+        'images': images,
+        'fonts': [(font[0], _font_file_bytes(doc, font[0])) for font in page.get_fonts(full=True)],
+        'resources': _resource_objects(doc, page, {} if objects is None else objects),
+        'size': (page.rect.width, page.rect.height),
+    }
+    if transparency:
+        scan['transparency'] = _page_transparency(doc, page, {})[0]
+    return scan
+
+def _scan_source(path, page_indices, sample_pages, transparency=False):
+    """
+    Scans an evenly spaced sample of `page_indices` of one source (all of them when
+    there are at most `sample_pages`). Scans are cached per (path, mtime, size), so
+    estimating again after changing targetDpi or the selection only reads new pages.
+    Returns (scans, sampled_indices, valid_indices).
+    """
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_mtime, st.st_size)
+    entry = _page_scans.pop(key, None)
+    if entry is None:
+        entry = {'pageCount': None, 'pages': {}}
+    _page_scans[key] = entry
+    while len(_page_scans) > MAX_SCANNED_SOURCES:
+        _page_scans.popitem(last=False)
+
+    wanted = list(OrderedDict.fromkeys(page_indices))
+    if entry['pageCount'] is not None:
+        wanted = [p for p in wanted if 0 <= p < entry['pageCount']]
+    step = max(1.0, len(wanted) / max(1, sample_pages))
+    sample = [wanted[int(i * step)] for i in range(min(len(wanted), max(1, sample_pages)))]
+    todo = [p for p in sample if p not in entry['pages'] or (transparency and 'transparency' not in entry['pages'][p])]
+    if todo or entry['pageCount'] is None:
+        doc = fitz.open(path)
+        try:
+            entry['pageCount'] = len(doc)
+            objects = {}
+            for page_index in todo:
+                if 0 <= page_index < len(doc):
+                    entry['pages'][page_index] = _scan_page(doc, page_index, transparency, objects)
+        finally:
+            doc.close()
+    valid = [p for p in wanted if 0 <= p < entry['pageCount']]
+    return entry['pages'], [p for p in sample if p in entry['pages']], valid
+
+def _resampled_image_bytes(image, shown, settings):
+    """
+    Predicted output size of one scanned image (see _scan_page) placed at most `shown`
+    points wide, after the optimize step described by `settings`. Returns
+    (bytes, new_size, visual_dpi); new_size is None when the image is kept as is.
+    """
+    _, width, height, raw, _, smask, components, deflated = image
+    if settings['fitzEngine']:
+        raw = deflated
+    if settings['optimize'] and not smask and shown > 0:
+        visual_dpi = width / shown * 72
+        scale = settings['targetDpi'] / visual_dpi
+        if visual_dpi > settings['triggerDpi'] and scale < 1.0:
+            new_size = (max(1, int(width * scale)), max(1, int(height * scale)))
+            return min(raw, new_size[0] * new_size[1] * JPEG_BYTES_PER_PIXEL[components]), new_size, visual_dpi
+    return raw, None, None
+
+def _overlay_points(overlay):
+    """Rough drawing size of one page's annotation overlay, in points (packed or not) plus a few per node."""
+    return sum(len(node.get('points') or ()) // (2 if isinstance(node.get('points'), array) else 1) + 4
+               for node in (overlay or {}).get('nodes', []))
+
+def _estimate_group(group_items, settings, check_cancel=None):
+    """
+    Dry-run estimate for one output file, from sampled page scans: predicted size,
+    images the optimize step would resample and a processing time built from
+    ESTIMATE_COSTS. Returns a report fragment that folds with _merge_reports.
+    """
+    by_source = OrderedDict()
+    image_items = OrderedDict()
+    for item in group_items:
+        path = item.get('path')
+        if not path or not os.path.exists(path):
+            continue
+        if _is_image_item(item):
+            image_items[path] = True
+        else:
+            by_source.setdefault(path, []).append(int(item.get('originalIndex', 0)))
+
+    fitz_engine = settings['fitzEngine']
+    raster_scale = settings['printSafeDpi'] / 72.0
+    est = {"pages": 0, "sampledPages": 0, "inputBytes": 0, "predictedBytes": 0, "rasterizedPages": 0,
+           "resampledImages": [], "fonts": {"count": 0, "bytes": 0}}
+    seconds = 0.0
+
+    for path, indices in by_source.items():
+        if check_cancel is not None:
+            check_cancel()
+        try:
+            scans, sample, valid = _scan_source(path, indices, settings['samplePages'], settings['printSafe'])
+        except Exception as e:
+            print(f"Estimate scan failed for {path}: {e}", file=sys.stderr)
+            continue
+        valid_set = set(valid)
+        pages = sum(1 for i in indices if i in valid_set)
+        est["pages"] += pages
+        est["sampledPages"] += len(sample)
+        est["inputBytes"] += os.path.getsize(path)
+        seconds += ESTIMATE_COSTS['source']
+        if not sample:
+            continue
+        ratio = len(valid) / len(sample)
+
+        content = 0
+        raster_bytes = 0
+        seen_on = {}  # image xref -> (sampled pages placing it, largest placement, info, first page)
+        fonts = {}
+        for page_index in sample:
+            scan = scans[page_index]
+            if settings['printSafe'] == 'raster' or (settings['printSafe'] and scan.get('transparency') == 'raster'):
+                width, height = scan['size']
+                pixels = (width * raster_scale) * (height * raster_scale)
+                raster_bytes += pixels * RASTER_BYTES_PER_PIXEL
+                seconds += pixels / 1e6 * ESTIMATE_COSTS['rasterMegapixel'] * ratio
+                est["rasterizedPages"] += ratio
+                continue
+            content += scan['content']
+            for image in scan['images']:
+                count, shown, info, first = seen_on.get(image[0], (0, 0.0, image, page_index))
+                seen_on[image[0]] = (count + 1, max(shown, image[4]), info, first)
+            for xref, size in scan['fonts']:
+                fonts[xref] = size
+
+        image_bytes = 0.0
+        for xref, (count, shown, info, page_index) in seen_on.items():
+            _, width, height, raw = info[:4]
+            predicted, new_size, visual_dpi = _resampled_image_bytes(info, shown, settings)
+            if new_size is not None:
+                seconds += width * height / 1e6 * ESTIMATE_COSTS['imageMegapixel'] * (1 if count > 1 else ratio)
+                est["resampledImages"].append({
+                    "source": os.path.basename(path), "page": page_index, "xref": xref,
+                    "pixels": [width, height], "dpi": round(visual_dpi), "newPixels": list(new_size),
+                    "bytes": raw, "predictedBytes": int(predicted),
+                })
+            # Images seen on several sampled pages are shared resources and copied once;
+            # the others stand in for the unsampled pages as well
+            image_bytes += predicted if count > 1 else predicted * ratio
+
+        est["fonts"]["count"] += len(fonts)
+        est["fonts"]["bytes"] += sum(fonts.values())
+        est["predictedBytes"] += int((content + raster_bytes) * ratio + image_bytes + sum(fonts.values())
+                                     + len(valid) * PAGE_OVERHEAD_BYTES)
+        seconds += pages * ESTIMATE_COSTS['page' if fitz_engine else 'pagePypdf']
+        if settings['resizeToFit']:
+            seconds += pages * ESTIMATE_COSTS['resize' if fitz_engine else 'resizePypdf']
+
+    for path in image_items:
+        size = os.path.getsize(path)
+        est["pages"] += 1
+        est["inputBytes"] += size
+        est["predictedBytes"] += size + PAGE_OVERHEAD_BYTES
+        if has_pil:
+            try:
+                with Image.open(path) as img:
+                    seconds += img.width * img.height / 1e6 * ESTIMATE_COSTS['imageMegapixel']
+            except Exception:
+                pass
+
+    overlays = settings['annotationOverlay'] or {}
+    points = sum(_overlay_points(overlays.get(item.get('id')) if item.get('id') else None) for item in group_items)
+    est["predictedBytes"] += points * 12
+    seconds += points * ESTIMATE_COSTS['annotationPoint']
+
+    est["rasterizedPages"] = round(est["rasterizedPages"])
+    seconds += est["predictedBytes"] / (1024 * 1024) * ESTIMATE_COSTS['outputMegabyte']
+    est["estimatedSeconds"] = round(seconds, 2)
+    est["groups"] = [{"output": settings['output'], "pages": est["pages"], "predictedBytes": est["predictedBytes"],
+                      "estimatedSeconds": est["estimatedSeconds"]}]
+    return est
+
+def _split_page_costs(group_items, settings, check_cancel=None):
+    """
+    Byte accounting input for a split export, one entry per item: the bytes the page
+    always adds (overhead, content, a rasterized print-safe page, annotations) and
+    the images and other objects it brings along (fonts, forms, patterns...), keyed
+    by (source, xref) so a shared resource is only charged to the first page of a
+    part that uses it. Missing files get None.
+    """
+    by_source = OrderedDict()
+    for item in group_items:
+        path = item.get('path')
+        if path and os.path.exists(path) and not _is_image_item(item):
+            by_source.setdefault(path, []).append(int(item.get('originalIndex', 0)))
+    scans = {}
+    for path, indices in by_source.items() if has_fitz else ():
+        if check_cancel is not None:
+            check_cancel()
+        try:
+            scans[path] = _scan_source(path, indices, len(indices), settings['printSafe'])[0]
+        except Exception as e:
+            print(f"Split scan failed for {path}: {e}", file=sys.stderr)
+
+    raster_scale = settings['printSafeDpi'] / 72.0
+    overlays = settings['annotationOverlay'] or {}
+    costs = []
+    for item in group_items:
+        path = item.get('path')
+        if not path or not os.path.exists(path):
+            costs.append(None)
+            continue
+        overlay = overlays.get(item.get('id')) if item.get('id') else None
+        cost = {'bytes': PAGE_OVERHEAD_BYTES + _overlay_points(overlay) * 12, 'images': [], 'resources': []}
+        scan = None if _is_image_item(item) else scans.get(path, {}).get(int(item.get('originalIndex', 0)))
+        if _is_image_item(item):
+            size = os.path.getsize(path)
+            header = None
+            if has_pil:
+                try:
+                    with Image.open(path) as img:  # Reads the header only
+                        width, height = img.size
+                        if _exif_orientation(img) in (5, 6, 7, 8):  # Turned upright on export
+                            width, height = height, width
+                        header = (width, height), 1 if img.mode in ('1', 'L', 'LA') else 3
+                except Exception:
+                    pass  # ingest_images reports unreadable images
+            if header is None:
+                cost['bytes'] += size
+            else:
+                (width, height), components = header
+                # The page is the image's pixel width in points, or fitWidth when resized
+                shown = settings['fitWidth'] or width
+                cost['images'] = [((path, 0), (0, width, height, size, shown, 0, components, size))]
+        elif scan is None:
+            pass  # Not scanned (or out of range): counts towards splitMaxPages only
+        elif settings['printSafe'] == 'raster' or (settings['printSafe'] and scan.get('transparency') == 'raster'):
+            width, height = scan['size']
+            cost['bytes'] += int(width * raster_scale * height * raster_scale * RASTER_BYTES_PER_PIXEL)
+        else:
+            cost['bytes'] += scan['content']
+            cost['images'] = [((path, image[0]), image) for image in scan['images']]
+            cost['resources'] = [((path, xref), size) for xref, size in scan['resources']]
+        costs.append(cost)
+    return costs
+
+def _split_cost(cost, charged, settings):
+    """Bytes `cost` adds to a part that already holds the resources in `charged` (updated in place)."""
+    total = cost['bytes']
+    for key, image in cost['images']:
+        if key not in charged:
+            charged.add(key)
+            total += _resampled_image_bytes(image, image[4], settings)[0]
+    for key, size in cost['resources']:
+        if key not in charged:
+            charged.add(key)
+            total += size
+    return total
+
+def _at_dpi(settings, dpi):
+    """`settings` with images downsampled to `dpi` (None keeps the export's own settings)."""
+    if dpi is None:
+        return settings
+    return {**settings, 'optimize': True, 'targetDpi': dpi, 'triggerDpi': dpi}
+
+def _part_bytes(costs, indices, settings):
+    """Predicted size of a part made of the items at `indices`."""
+    charged = set()
+    return int(PART_OVERHEAD_BYTES + sum(_split_cost(costs[i], charged, settings) for i in indices))
+
+def _plan_split(costs, max_bytes, max_pages, settings, dpi_levels=(None,)):
+    """
+    Splits a group into parts in page order, keeping a running byte count per part:
+    a page starts a new part once it would take the part past max_bytes *
+    SPLIT_FILL_RATIO or max_pages. Resources are charged once per part, and again in
+    every part that uses them, as each part is a standalone file with its own
+    PART_OVERHEAD_BYTES. A page over the budget on its own starts a part at the first
+    of `dpi_levels` it fits at (or the one it is smallest at), and the pages after it
+    join that part while they fit at the same resolution, so pages sharing one large
+    image stay together. Returns [(item_indices, predicted_bytes, dpi)].
+
+    Resampled image sizes are typical rather than worst case (JPEG_BYTES_PER_PIXEL),
+    so a part can still come out larger than predicted: export_split checks every
+    part it writes.
+    """
+    budget = max_bytes * SPLIT_FILL_RATIO if max_bytes else None
+    parts = []
+    current, total, charged, level = [], 0, set(), 0
+    for i, cost in enumerate(costs):
+        if cost is None:
+            continue
+        if current:
+            added = set(charged)
+            page_bytes = _split_cost(cost, added, _at_dpi(settings, dpi_levels[level]))
+            if (max_pages and len(current) >= max_pages) or (budget and total + page_bytes > budget):
+                parts.append((current, int(total), dpi_levels[level]))
+                current = []
+        if not current:
+            total, best = PART_OVERHEAD_BYTES, None
+            for lvl, dpi in enumerate(dpi_levels):
+                lvl_added = set()
+                lvl_bytes = _split_cost(cost, lvl_added, _at_dpi(settings, dpi))
+                if best is None or lvl_bytes < best[1]:
+                    best = (lvl, lvl_bytes, lvl_added)
+                if not budget or total + lvl_bytes <= budget:
+                    break
+            level, page_bytes, added = best
+        current.append(i)
+        total += page_bytes
+        charged = added
+    if current:
+        parts.append((current, int(total), dpi_levels[level]))
+    return parts
+
+def _manifest_path(output_path):
+    """Incremental re-export manifest kept next to `output_path`."""
+    folder, name = os.path.split(os.path.abspath(output_path))
+    return os.path.join(folder, f".{name}.manifest.json")
+
+def _hash_default(value):
+    if isinstance(value, array):
+        return value.tobytes().hex()  # Packed points from a streamed payload
+    raise TypeError(f"Cannot hash {type(value).__name__}")
+
+def _options_hash(export_options, meta_data):
+    """Hash of every option that shapes the output as a whole."""
+    options = {k: v for k, v in export_options.items() if k not in _MANIFEST_IGNORED_OPTIONS}
+    return hashlib.sha256(json.dumps([MANIFEST_VERSION, options, meta_data], sort_keys=True,
+                                     default=_hash_default).encode()).hexdigest()
+
+def _page_hashes(group_items, resize_to_fit, overlays):
+    """One hash per item over everything that shapes its page: source file, page, rotation and annotations."""
+    stats = {}
+    hashes = []
+    for item in group_items:
+        path = item.get('path') or ''
+        if path not in stats:
+            try:
+                st = os.stat(path)
+                stats[path] = [os.path.abspath(path), st.st_mtime, st.st_size]
+            except OSError:
+                stats[path] = [path, None, None]
+        overlay = overlays.get(item.get('id')) if overlays and item.get('id') else None
+        page = [stats[path], _is_image_item(item), item.get('originalIndex', 0), item.get('rot', 0),
+                bool(resize_to_fit), overlay.get('nodes') and overlay if overlay else None]
+        hashes.append(hashlib.sha256(json.dumps(page, sort_keys=True, default=_hash_default).encode()).hexdigest())
+    return hashes
+
+def _load_manifest(output_path, options_hash):
+    """The manifest of a previous export, if it still describes the file at `output_path`."""
+    try:
+        with open(_manifest_path(output_path), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        st = os.stat(output_path)
+    except (OSError, ValueError):
+        return None
+    if (manifest.get('version') != MANIFEST_VERSION or manifest.get('options') != options_hash
+            or manifest.get('outputSize') != st.st_size or manifest.get('outputMtime') != st.st_mtime):
+        return None  # Different options, or the output was changed or replaced since
+    return manifest
+
+def _write_manifest(output_path, options_hash, page_hashes):
+    st = os.stat(output_path)
+    manifest = {"version": MANIFEST_VERSION, "options": options_hash, "outputSize": st.st_size,
+                "outputMtime": st.st_mtime, "pages": page_hashes}
+    try:
+        with open(_manifest_path(output_path), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+    except OSError as e:
+        print(f"Could not write export manifest for {output_path}: {e}", file=sys.stderr)
+
+def _remove_manifest(output_path):
+    try:
+        os.remove(_manifest_path(output_path))
+    except OSError:
+        pass
+
+def _resolve_workers(value, job_count):
+    """Maps exportOptions.workers to a pool size (<= 0 means one per CPU core)."""
+    try:
+        workers = int(value)
+    except (ValueError, TypeError):
+        workers = 1
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    return max(1, min(workers, job_count))
+
+def _export_group_job(input_data):
+    """
+    Process-pool entry point for batch mode: exports one group as a standalone merge
+    and always returns a report, so a crash in one group never loses the others.
+    """
+    try:
+        return merge_pdfs_hybrid(input_data) or {"fixes": [], "warnings": [], "errors": []}
+    except Exception as e:
+        print(f"Group export failed for {input_data.get('outputPath')}: {e}\n{traceback.format_exc()}", file=sys.stderr)
+        return {"fixes": [], "warnings": [], "errors": [f"Export failed for {os.path.basename(str(input_data.get('outputPath')))}: {str(e)}"]}
+
+def _merge_reports(report, group_report):
+    """Folds one report into another: lists are concatenated, counters are summed."""
+    for key, values in group_report.items():
+        if key.startswith(('peak', 'rss')) and isinstance(values, (int, float)):
+            report[key] = max(report.get(key, 0), values)  # High-water marks don't add up
+        elif isinstance(values, list):
+            report.setdefault(key, []).extend(values)
+        elif isinstance(values, dict):
+            _merge_reports(report.setdefault(key, {}), values)
+        elif isinstance(values, bool):
+            report[key] = report.get(key, False) or values
+        elif isinstance(values, (int, float)):
+            report[key] = report.get(key, 0) + values
+
+def merge_pdfs_hybrid(input_data, progress=None):
+    """
+    Runs one export. `progress`, when given, is called with a dict describing the
+    current stage (ingest / optimize / flatten / merge / annotate / write / done, or
+    estimate for a dry run), group, page N of M and bytes written so far. Creating
+    the file named by exportOptions.cancelFile stops the export between pages.
+    """
 
     items = input_data.get('items', [])
     raw_output = input_data.get('outputPath')
@@ -41,115 +1550,575 @@ def merge_pdfs_hybrid(input_data):
     target_dpi = export_options.get('targetDpi', 150)
     trigger_dpi = export_options.get('triggerDpi', 300)
     fmt = export_options.get('format', 'pdf')
+    max_open_sources = export_options.get('maxOpenSources', DEFAULT_MAX_OPEN_SOURCES)
+    workers = export_options.get('workers', 1)
+    image_threads = max(1, int(export_options.get('imageThreads', 0) or os.cpu_count() or 1))
+    jpeg_quality = int(export_options.get('jpegQuality', DEFAULT_JPEG_QUALITY))
+    annotation_simplify = float(export_options.get('annotationSimplify', 0) or 0)
+    cancel_file = export_options.get('cancelFile')
+    profile_dump = export_options.get('profileDump', False)
+    dedupe = export_options.get('dedupe', False)
+    print_safe = export_options.get('printSafe', False)  # True / 'auto', or 'raster' to flatten every page
+    print_safe_dpi = int(export_options.get('printSafeDpi', DEFAULT_PRINT_SAFE_DPI))
+    dry_run = export_options.get('dryRun', False)
+    incremental = export_options.get('incremental', False)
+    mmap_sources = export_options.get('mmapSources', True)
+    split_bytes = int(export_options.get('splitMaxBytes', 0) or 0)  # size cap per output file, 0 = off
+    split_pages = int(export_options.get('splitMaxPages', 0) or 0)
     
     report = {"fixes": [], "warnings": [], "errors": []}
+    profiler = ExportProfiler(export_options.get('profile', False) or profile_dump)
+    sources = SourceCache(max_open_sources, profiler, mapped=mmap_sources)
+    started = time.perf_counter()
+    io_started = _process_read_bytes()
+    cprofile = None
+    if profile_dump:
+        cprofile = cProfile.Profile()
+        cprofile.enable()
+
+    status = {"stage": None, "group": None, "page": 0, "pages": len(items), "bytesWritten": 0}
+    last_emit = [0.0]
+
+    def emit(stage, force=True, extra=None, **fields):
+        status.update(fields, stage=stage)
+        if progress is None:
+            return
+        now = time.monotonic()
+        if force or now - last_emit[0] >= PROGRESS_INTERVAL:
+            last_emit[0] = now
+            progress({**status, **(extra or {})})
 
-    def optimize_pdf_fitz(src_path, page_idx, target_dpi, trigger_dpi, group_report):
-        """Downsamples images using PyMuPDF+Pillow and returns path to optimized temp PDF."""
-        doc = fitz.open(src_path)
+    def check_cancel():
+        if cancel_file and os.path.exists(cancel_file):
+            raise ExportCancelled()
+
+    image_cache = None
+    if optimize and has_fitz and export_options.get('imageCache', True):
+        image_cache = ImageCache(
+            export_options.get('cacheDir') or DEFAULT_CACHE_DIR,
+            export_options.get('cacheMaxBytes', DEFAULT_CACHE_MAX_BYTES),
+        )
+
+    def optimize_source_fitz(src_path, page_indices, target_dpi, trigger_dpi, group_report, keep_open=False):
+        """
+        Builds a single optimized copy of `src_path` holding `page_indices` in order and
+        downsamples every distinct image xref exactly once using PyMuPDF+Pillow.
+        Returns (temp_pdf_path, kept_page_indices), or (fitz_doc, kept_page_indices)
+        with `keep_open` so the fitz engine can copy from it without a temp file.
+        """
+        doc = sources.fitz_doc(src_path)
+        kept = [i for i in page_indices if 0 <= i < len(doc)]
         new_doc = fitz.open()
-        new_doc.insert_pdf(doc, from_page=page_idx, to_page=page_idx)
-        page = new_doc[0]
-        
-        for img_info in page.get_images():
-            xref = img_info[0]
-            smask = img_info[1]
-            
-            # CRITICAL FIX: Downscaling an RGB image while leaving its SMask intact causes severe corruption.
-            # Additionally, flattening Alpha channels into JPEGs obscures underlying vector data.
-            # We skip optimizing transparent images entirely to preserve document integrity.
-            if smask > 0:
-                continue
-                
-            pix = fitz.Pixmap(new_doc, xref)
-            if pix.alpha:
-                continue
-                
-            if pix.n - pix.alpha > 3:
-                pix = fitz.Pixmap(fitz.csRGB, pix)
-            
-            rects = page.get_image_rects(xref)
-            if not rects:
-                continue
-            rect = rects[0]
-            
-            visual_dpi = (pix.width / rect.width) * 72
-            
-            scale = target_dpi / visual_dpi
-            if scale < 1.0:
-                new_w = int(pix.width * scale)
-                new_h = int(pix.height * scale)
-                
-                img_data = pix.tobytes("png")
-                img = Image.open(io.BytesIO(img_data))
-                
-                if img.mode in ("RGBA", "P"):
-                    img = img.convert("RGB")
-                    
-                img = img.resize((new_w, new_h), Image.Resampling.LANCZOS)
+        try:
+            # Copy contiguous ascending runs in bulk. The graft map is kept until the last
+            # run, so objects shared by runs (reordered or gapped selections) are copied
+            # and later transcoded once.
+            run_start = prev = None
+            for page_idx in kept + [None]:
+                if prev is not None and page_idx == prev + 1:
+                    prev = page_idx
+                    continue
+                if run_start is not None:
+                    new_doc.insert_pdf(doc, from_page=run_start, to_page=prev, final=page_idx is None)
+                run_start = prev = page_idx
+
+            # An image shared by several pages is judged by its largest placement, so
+            # no page ends up showing it below target_dpi
+            placements = {}
+            for page in new_doc:
+                for img_info in page.get_images():
+                    xref = img_info[0]
+                    smask = img_info[1]
                 
-                out = io.BytesIO()
-                img.save(out, format="JPEG", quality=85)
+                    # CRITICAL FIX: Downscaling an RGB image while leaving its SMask intact causes severe corruption.
+                    # Additionally, flattening Alpha channels into JPEGs obscures underlying vector data.
+                    # We skip optimizing transparent images entirely to preserve document integrity.
+                    if smask > 0:
+                        continue
                 
-                # Replace the image safely using PyMuPDF's built-in method
-                page.replace_image(xref, stream=out.getvalue())
+                    for rect in page.get_image_rects(xref):
+                        if rect.width > 0 and (xref not in placements or rect.width > placements[xref][1]):
+                            placements[xref] = (page.number, rect.width, img_info)
+
+            # Pixmaps are decoded and swapped in on this thread (fitz is not thread-safe);
+            # the Pillow resize + JPEG encode in between runs on a thread pool, with a
+            # bounded number of decoded images in flight.
+            in_flight = deque()
+            scratch = []
+
+            def apply_oldest():
+                xref, cache_key, future = in_flight.popleft()
+                jpeg_bytes = future.result()
+                if image_cache is not None:
+                    image_cache.put(cache_key, jpeg_bytes)
+                replace(xref, jpeg_bytes)
+
+            def replace(xref, jpeg_bytes):
+                # Page.replace_image would leave the new image (and an empty content stream)
+                # on the page as well, so every downsampled image would be stored twice.
+                # Insert it on a scratch page instead and copy it over the old xref: the xref
+                # is shared, so every page placing it picks up the new stream.
+                if not scratch:
+                    scratch.append(new_doc.new_page(width=1, height=1))
+                new_doc.xref_copy(scratch[0].insert_image(scratch[0].rect, stream=jpeg_bytes), xref)
+                profiler.count('images')
                 group_report["fixes"].append(f"Downsampled image (xref {xref}) to {target_dpi} DPI")
-                
-        fd, temp_path = tempfile.mkstemp(suffix=".pdf")
-        os.close(fd)
-        new_doc.save(temp_path, garbage=4, deflate=True)
-        new_doc.close()
-        doc.close()
-        return temp_path
-
-    def flatten_page_raster(src_path, page_idx, dpi=300):
-        """Renders a PDF page to a high-DPI image and returns path to a new, opaque PDF."""
-        doc = fitz.open(src_path)
-        page = doc[page_idx]
-        pix = page.get_pixmap(dpi=dpi, colorspace=fitz.csRGB, alpha=False)
-        img_data = pix.tobytes("jpeg")
-        img_pdf_bytes = doc.convert_to_pdf(img_data)
-        fd, temp_path = tempfile.mkstemp(suffix=".pdf")
-        os.close(fd)
-        with open(temp_path, "wb") as f: f.write(img_pdf_bytes)
-        doc.close()
-        return temp_path
 
-    def sanitize_page_transparency(src_path, page_idx):
-        """Attempts to remove transparency markers without rasterizing (Vector Preservation)."""
-        doc = fitz.open(src_path)
-        page = doc[page_idx]
-        
-        # 1. Strip Transparency Groups from the page dictionary
-        page_dict = page.read_contents() # Ensure stream is loaded
-        if page.xref:
-            # Remove the /Group attribute which often triggers 'Transparency used' even if invisible
-            doc.set_object_property(page.xref, "Group", "null")
-
-        # 2. Surgical Alpha Strip for Images
-        for img in page.get_images():
-            xref = img[0]
-            smask = img[1]
-            if smask > 0:
-                # If there's a soft mask, we try to 'Flatten' just this image
-                pix = fitz.Pixmap(doc, xref)
-                if pix.alpha:
-                    # Create opaque version
-                    pix_opaque = fitz.Pixmap(fitz.csRGB, pix)
-                    page.replace_image(xref, pixmap=pix_opaque)
-        
+            with ThreadPoolExecutor(max_workers=image_threads) as pool:
+                for xref, (_, rect_width, img_info) in placements.items():
+                    pixel_width, pixel_height = img_info[2], img_info[3]
+                    visual_dpi = (pixel_width / rect_width) * 72
+                    if visual_dpi <= trigger_dpi:
+                        continue
+                    scale = target_dpi / visual_dpi
+                    if scale >= 1.0:
+                        continue
+                    new_size = (max(1, int(pixel_width * scale)), max(1, int(pixel_height * scale)))
+
+                    cache_key = None
+                    if image_cache is not None:
+                        cache_key = ImageCache.make_key(new_doc, img_info, new_size, target_dpi, trigger_dpi, jpeg_quality)
+                        cached = image_cache.get(cache_key)
+                        if cached is not None:
+                            replace(xref, cached)
+                            continue
+
+                    pix = fitz.Pixmap(new_doc, xref)
+                    if pix.alpha:
+                        continue
+                    if pix.n not in (1, 3):
+                        pix = fitz.Pixmap(fitz.csRGB, pix)
+
+                    future = pool.submit(profiler.wrap('imageTranscode', _transcode_image, src_path), pix.samples, "L" if pix.n == 1 else "RGB",
+                                         (pix.width, pix.height), new_size, jpeg_quality)
+                    in_flight.append((xref, cache_key, future))
+                    while len(in_flight) > image_threads * 2:
+                        apply_oldest()
+                while in_flight:
+                    apply_oldest()
+            if scratch:
+                new_doc.delete_page(scratch[0].number)  # Leaves the inserted copies unreferenced
+        except BaseException:
+            new_doc.close()
+            raise
+
+        if keep_open:
+            return new_doc, kept
         fd, temp_path = tempfile.mkstemp(suffix=".pdf")
         os.close(fd)
-        doc.save(temp_path, garbage=4, deflate=True)
-        doc.close()
-        return temp_path
+        try:
+            new_doc.save(temp_path, garbage=4, deflate=True)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        finally:
+            new_doc.close()
+        return temp_path, kept
+
+    def make_print_safe(group_items, optimized_pages, group_report, temp_files, keep_open=False):
+        """
+        Print-safe mode: removes transparency from every PDF page of the group, deciding
+        per page whether stripping the markers is enough or the page must be rasterized
+        at print_safe_dpi. Pages go to a process pool in per-source chunks (workers parse
+        each source once) and come back as in-memory documents, reassembled per source.
+        Returns {(path, page_index): (temp_pdf_path, new_index)} like the optimize step,
+        or open fitz documents instead of paths with `keep_open` (the caller closes them).
+        Temp files are added to `temp_files` for the caller to delete.
+        """
+        resolved = OrderedDict()
+        wanted = OrderedDict()
+        for item in group_items:
+            file_path = item.get('path')
+            if not file_path or not os.path.exists(file_path) or _is_image_item(item):
+                continue
+            key = (file_path, int(item.get('originalIndex', 0)))
+            resolved[key] = optimized_pages.get(key, key)
+            wanted.setdefault(resolved[key][0], OrderedDict())[resolved[key][1]] = True
+
+        total = sum(len(indices) for indices in wanted.values())
+        pool_size = _resolve_workers(export_options.get('printSafeWorkers', 0), max(1, total // PRINT_SAFE_CHUNK_PAGES))
+        policy = 'raster' if print_safe == 'raster' else 'auto'
+        jobs = []
+        for src_path, indices in wanted.items():
+            indices = list(indices)
+            chunk = max(PRINT_SAFE_CHUNK_PAGES, -(-len(indices) // pool_size))
+            for i in range(0, len(indices), chunk):
+                jobs.append((src_path, indices[i:i + chunk], policy, print_safe_dpi, jpeg_quality))
+
+        outputs = OrderedDict()
+        new_index = {}
+        actions = {'vector': 0, 'raster': 0}
+        pool = ProcessPoolExecutor(max_workers=pool_size) if pool_size > 1 else None
+        futures = [pool.submit(_print_safe_job, job) for job in jobs] if pool is not None else []
+        try:
+            for job_no, job in enumerate(jobs):
+                check_cancel()
+                emit('flatten', extra={"source": os.path.basename(job[0])})
+                try:
+                    if pool is None:
+                        data, done = _print_safe_job(job)
+                    else:
+                        while True:
+                            check_cancel()
+                            try:
+                                data, done = futures[job_no].result(timeout=PROGRESS_INTERVAL * 2)
+                                break
+                            except FuturesTimeout:
+                                continue
+                except ExportCancelled:
+                    raise
+                except Exception as e:
+                    group_report["errors"].append(f"Print-safe conversion failed for {os.path.basename(job[0])}: {str(e)}")
+                    print(f"Print-safe conversion failed for {job[0]} pages {job[1][0]}-{job[1][-1]}: {e}", file=sys.stderr)
+                    continue
+                out_doc = outputs.get(job[0])
+                if out_doc is None:
+                    out_doc = outputs[job[0]] = fitz.open()
+                chunk_doc = fitz.open("pdf", data)
+                try:
+                    base = len(out_doc)
+                    out_doc.insert_pdf(chunk_doc)
+                finally:
+                    chunk_doc.close()
+                for offset, (page_index, action) in enumerate(done):
+                    new_index[(job[0], page_index)] = base + offset
+                    if action:
+                        actions[action] += 1
+        except BaseException:
+            for out_doc in outputs.values():
+                out_doc.close()
+            raise
+        finally:
+            if pool is not None:
+                for future in futures:
+                    future.cancel()
+                pool.shutdown(wait=True)
+            else:
+                _close_worker_sources()
+
+        holders = {}
+        for src_path, out_doc in outputs.items():
+            if keep_open:
+                holders[src_path] = out_doc
+                continue
+            fd, temp_path = tempfile.mkstemp(suffix=".pdf")
+            os.close(fd)
+            temp_files.append(temp_path)
+            try:
+                out_doc.save(temp_path, garbage=1, deflate=True)
+            finally:
+                out_doc.close()
+            profiler.alias(temp_path, src_path)
+            holders[src_path] = temp_path
+
+        if actions['raster']:
+            group_report["fixes"].append(f"Flattened transparency on {actions['raster']} pages by rasterizing at {print_safe_dpi} DPI")
+        if actions['vector']:
+            group_report["fixes"].append(f"Removed transparency groups and opaque soft masks from {actions['vector']} pages (kept as vectors)")
+        return {key: (holders[src], new_index[(src, index)]) for key, (src, index) in resolved.items()
+                if (src, index) in new_index}
+
+    def ingest_images(image_paths, group_report, as_fitz=False):
+        """
+        Embeds raster image items as pages of one in-memory PDF, without temp files.
+        Pillow decoding and optional downsampling run on a thread pool.
+        Returns {path: (reader, page_index)}; with `as_fitz` the readers are the open
+        fitz document itself (the caller closes it).
+        """
+        fit_width = A4_WIDTH if resize_to_fit else None
+        opt_dpi = target_dpi if optimize else None
+        pages = {}
+        img_doc = fitz.open() if has_fitz else None
+        handed_over = False
+
+        try:
+            with ThreadPoolExecutor(max_workers=image_threads) as pool:
+                futures = [(path, pool.submit(_prepare_image, path, fit_width, opt_dpi, trigger_dpi, jpeg_quality))
+                           for path in image_paths]
+                for path, future in futures:
+                    check_cancel()
+                    try:
+                        width, height, data, downsampled = future.result()
+                        if img_doc is not None:
+                            # fitz is not thread-safe, so pages are assembled here
+                            page = img_doc.new_page(width=width, height=height)
+                            page.insert_image(page.rect, stream=data)
+                            pages[path] = page.number
+                        else:
+                            buf = io.BytesIO()
+                            with Image.open(io.BytesIO(data)) as img:
+                                img.save(buf, format="PDF", resolution=72.0 * img.width / width)
+                            pages[path] = (PdfReader(buf, strict=False), 0)
+                        profiler.count('images')
+                        if downsampled:
+                            group_report["fixes"].append(f"Downsampled image {os.path.basename(path)} to {target_dpi} DPI")
+                    except Exception as e:
+                        group_report.setdefault("failedFiles", []).append(os.path.basename(path))
+                        print(f"Image import failed for {path}: {e}", file=sys.stderr)
+
+            if img_doc is not None and as_fitz:
+                handed_over = bool(pages)  # The caller closes it with the other fitz documents
+                return {path: (img_doc, page_no) for path, page_no in pages.items()}
+            if img_doc is not None and len(img_doc):
+                reader = PdfReader(io.BytesIO(img_doc.tobytes(garbage=1, deflate=True)), strict=False)
+                pages = {path: (reader, page_no) for path, page_no in pages.items()}
+            return pages
+        finally:
+            if img_doc is not None and not handed_over:
+                img_doc.close()
 
     def process_group(group_items, group_output_path):
+        sources.exclude(group_output_path)
         writer = PdfWriter()
         temp_files_to_delete = []
+        profiler.group = os.path.basename(group_output_path)
+        doc_id = uuid.uuid4().hex.encode('ascii')
+        chunks_written = 0
+
+        def flush_chunk(last_item_no):
+            """
+            Streaming mode: writes the pages gathered so far to the output (the first
+            chunk creates it, later ones are appended with an incremental save), then
+            starts a fresh writer and closes sources no later page needs.
+            """
+            nonlocal writer, chunks_written
+            if chunks_written and not writer.pages:
+                return
+            if dedupe:
+                dedupe_writer()
+            if chunks_written == 0:
+                writer._ID = ArrayObject([ByteStringObject(doc_id), ByteStringObject(doc_id)])
+                with profiler.stage('write'), open(group_output_path, 'wb') as f:
+                    writer.write(f)
+            else:
+                buf = io.BytesIO()
+                with profiler.stage('write'):
+                    writer.write(buf)
+                with profiler.stage('append'):
+                    out_doc = fitz.open(group_output_path)
+                    chunk_doc = fitz.open("pdf", buf.getbuffer())
+                    try:
+                        out_doc.insert_pdf(chunk_doc)
+                        out_doc.save(group_output_path, incremental=True, deflate=True, encryption=fitz.PDF_ENCRYPT_KEEP)
+                    finally:
+                        chunk_doc.close()
+                        out_doc.close()
+            chunks_written += 1
+            writer = PdfWriter()
+            for path in [p for p, last in last_use.items() if last <= last_item_no]:
+                sources.release(path)
+                del last_use[path]
+
+        dedupe_totals = [0, 0, 0]  # objects removed, bytes saved (summed over streamed chunks), object-stream savings
+
+        def dedupe_writer():
+            with profiler.stage('dedupe'):
+                removed, saved = _dedupe_objects(writer)
+            dedupe_totals[0] += removed
+            dedupe_totals[1] += saved
+
+        def export_group_fitz(group_items, group_output_path, image_pages, optimized_pages):
+            """
+            fitz-native engine: copies every page into one in-memory document with
+            insert_pdf, applies rotation with set_rotation and resizeToFit in place,
+            burns in annotations and saves once. Consecutive pages of one source are
+            planned into runs (see _plan_runs) and copied in bulk; per-page work is
+            only done for runs that are rotated or when pages are resized.
+            """
+            doc = fitz.open()
+            scale_cache = {}
+            try:
+                merge_started = time.perf_counter()
+                planned = []
+                exists = {}
+                for item_no, item in enumerate(group_items):
+                    file_path = item.get('path')
+                    page_index = int(item.get('originalIndex', 0))
+
+                    try:
+                        rotation = int(item.get('rot', 0))
+                    except (ValueError, TypeError):
+                        rotation = 0
+
+                    if not file_path:
+                        continue
+                    if file_path not in exists:
+                        exists[file_path] = os.path.exists(file_path)
+                    if not exists[file_path]:
+                        continue
+
+                    profiler.count_source(file_path)
+                    if _is_image_item(item):
+                        if file_path not in image_pages:
+                            continue  # Import failure was already reported
+                        source, page_index = image_pages[file_path]
+                    else:
+                        source, page_index = optimized_pages.get((file_path, page_index), (file_path, page_index))
+                    planned.append((source, page_index, rotation % 360, item_no))
+
+                first_page = status["page"]
+                for source, first, last, rotation, last_item_no, final in _plan_runs(planned, max_open=sources.max_open):
+                    check_cancel()
+                    emit('merge', force=False, page=first_page + last_item_no + 1)
+                    try:
+                        src = sources.fitz_doc(source) if isinstance(source, str) else source
+                        first, last = max(first, 0), min(last, len(src) - 1)
+                        if first > last:
+                            continue
+
+                        start = len(doc)
+                        doc.insert_pdf(src, from_page=first, to_page=last, final=final)  # Shared resources are copied once per source
+                        profiler.count('pages', last - first + 1)
+
+                        if rotation == 0 and not resize_to_fit:
+                            continue
+                        for page_no in range(start, len(doc)):
+                            page = doc[page_no]
+                            if rotation != 0:
+                                page.set_rotation((page.rotation + rotation) % 360)
+
+                            if resize_to_fit:
+                                box = page.mediabox
+                                visual_width = box.height if page.rotation % 180 else box.width
+                                if visual_width > 0 and abs(visual_width - A4_WIDTH) > 1.0:
+                                    _scale_fitz_page(doc, page, A4_WIDTH / visual_width, scale_cache)
+                    except Exception as e:
+                        report["errors"].append(f"Merge error: {str(e)}")
+                        print(f"Error merging {source} pages {first}-{last}: {e}", file=sys.stderr)
+                profiler.add('merge', time.perf_counter() - merge_started)
+                if not len(doc):
+                    report["warnings"].append(f"No pages could be exported to {os.path.basename(group_output_path)}")
+
+                report["fixes"].append("Created 'StructTreeRoot' for document structure (1)")
+                metadata = {"producer": "Combine+ Exporter"}
+                if meta_data.get('title'): metadata["title"] = meta_data['title']
+                if meta_data.get('author'): metadata["author"] = meta_data['author']
+                doc.set_metadata(metadata)
+
+                check_cancel()
+                if annotation_overlay and _has_annotations(annotation_overlay, group_items):
+                    emit('annotate')
+                    try:
+                        with profiler.stage('annotate'):
+                            _draw_annotation_overlay(doc, annotation_overlay, group_items, annotation_simplify)
+                    except Exception as e:
+                        report["errors"].append(f"Annotation overlay failed: {str(e)}")
+                        print(f"Vector annotation overlay failed: {e}\n{traceback.format_exc()}", file=sys.stderr)
+
+                emit('write')
+                try:
+                    with profiler.stage('save'):
+                        if len(doc):
+                            doc.save(group_output_path, garbage=1, deflate=True)
+                        else:
+                            # fitz refuses to save a document without pages; write the
+                            # same empty PDF the pypdf writer produces
+                            with open(group_output_path, 'wb') as f:
+                                PdfWriter().write(f)
+                except BaseException:
+                    # Never leave a truncated output behind
+                    if os.path.exists(group_output_path):
+                        try:
+                            os.remove(group_output_path)
+                        except OSError:
+                            pass
+                    raise
+            finally:
+                doc.close()
+
+            output_size = os.path.getsize(group_output_path)
+            profiler.count('bytesOut', output_size)
+            emit('write', bytesWritten=status["bytesWritten"] + output_size)
+
+        fitz_docs_to_close = []
 
         try:
-            for item in group_items:
+            # The fitz engine assembles, annotates and saves one in-memory document;
+            # streamed and deduplicated exports (and engine='pypdf') use the pypdf writer
+            streaming = has_fitz and _wants_streaming(group_items, export_options)
+            fitz_engine = (has_fitz and not streaming and not dedupe
+                           and export_options.get('engine', 'auto') in ('auto', 'fitz'))
+
+            # 0. INGEST raster images directly instead of via Node-side temp PDFs
+            image_pages = {}
+            image_paths = list(OrderedDict.fromkeys(
+                item.get('path') for item in group_items
+                if _is_image_item(item) and item.get('path') and os.path.exists(item.get('path'))
+            ))
+            if image_paths:
+                if has_pil:
+                    emit('ingest')
+                    for path in image_paths:
+                        profiler.count_source(path)
+                    with profiler.stage('ingest'):
+                        image_pages = ingest_images(image_paths, report, as_fitz=fitz_engine)
+                    if fitz_engine and image_pages:
+                        fitz_docs_to_close.append(next(iter(image_pages.values()))[0])
+                else:
+                    report["warnings"].append("Pillow is not installed. Image pages were skipped.")
+
+            # 1. OPTIMIZE with PyMuPDF, once per source document rather than per page
+            optimized_pages = {}
+            if optimize and has_fitz:
+                wanted = OrderedDict()
+                for item in group_items:
+                    file_path = item.get('path')
+                    if not file_path or not os.path.exists(file_path) or _is_image_item(item):
+                        continue
+                    page_list = wanted.setdefault(file_path, [])
+                    page_index = int(item.get('originalIndex', 0))
+                    if page_index not in page_list:
+                        page_list.append(page_index)
+
+                for src_path, page_indices in wanted.items():
+                    check_cancel()
+                    emit('optimize', extra={"source": os.path.basename(src_path)})
+                    try:
+                        if fitz_engine and not print_safe:
+                            with profiler.stage('optimize', source=src_path):
+                                opt_doc, kept = optimize_source_fitz(src_path, page_indices, target_dpi, trigger_dpi, report, keep_open=True)
+                            fitz_docs_to_close.append(opt_doc)
+                            for new_index, page_index in enumerate(kept):
+                                optimized_pages[(src_path, page_index)] = (opt_doc, new_index)
+                            continue
+                        with profiler.stage('optimize', source=src_path):
+                            opt_path, kept = optimize_source_fitz(src_path, page_indices, target_dpi, trigger_dpi, report)
+                        profiler.alias(opt_path, src_path)
+                        temp_files_to_delete.append(opt_path)
+                        for new_index, page_index in enumerate(kept):
+                            optimized_pages[(src_path, page_index)] = (opt_path, new_index)
+                    except Exception as e:
+                        print(f"Fitz optimization failed for {src_path}: {e}", file=sys.stderr)
+
+            # PRINT-SAFE: strip or flatten transparency, on top of any optimized copies
+            if print_safe and has_fitz:
+                check_cancel()
+                with profiler.stage('flatten'):
+                    safe_pages = make_print_safe(group_items, optimized_pages, report, temp_files_to_delete, keep_open=fitz_engine)
+                if fitz_engine:
+                    fitz_docs_to_close.extend({id(doc): doc for doc, _ in safe_pages.values()}.values())
+                optimized_pages = {**optimized_pages, **safe_pages}
+
+            if fitz_engine:
+                export_group_fitz(group_items, group_output_path, image_pages, optimized_pages)
+                return
+
+            # 2. Very large groups are assembled in chunks that go to disk as they fill,
+            # so memory stays flat regardless of the total page count
+            chunk_pages = max(1, int(export_options.get('streamChunkPages', DEFAULT_STREAM_CHUNK_PAGES)))
+            last_use = {}
+            if streaming:
+                for item_no, item in enumerate(group_items):
+                    if item.get('path') and not _is_image_item(item):
+                        key = (item['path'], int(item.get('originalIndex', 0)))
+                        last_use[optimized_pages.get(key, key)[0]] = item_no
+
+            merge_started = time.perf_counter()
+            for item_no, item in enumerate(group_items):
+                check_cancel()
+                if streaming and len(writer.pages) >= chunk_pages:
+                    flush_chunk(item_no - 1)
+                emit('merge', force=False, page=status["page"] + 1)
                 file_path = item.get('path')
                 page_index = int(item.get('originalIndex', 0))
                 
@@ -161,24 +2130,25 @@ def merge_pdfs_hybrid(input_data):
                 if not file_path or not os.path.exists(file_path):
                     continue
 
-                # 1. OPTIMIZE with PyMuPDF
-                if optimize and has_fitz:
-                    try:
-                        file_path = optimize_pdf_fitz(file_path, page_index, target_dpi, trigger_dpi, report)
-                        temp_files_to_delete.append(file_path)
-                        page_index = 0
-                    except Exception as e:
-                        print(f"Fitz optimization failed for {file_path}: {e}", file=sys.stderr)
-
+                profiler.count_source(file_path)
+                reader = None
+                if _is_image_item(item):
+                    if file_path not in image_pages:
+                        continue  # Import failure was already reported
+                    reader, page_index = image_pages[file_path]
+                else:
+                    file_path, page_index = optimized_pages.get((file_path, page_index), (file_path, page_index))
 
                 # 3. Add to PyPDF Writer for Final Export
                 try:
-                    reader = PdfReader(file_path, strict=False)
+                    if reader is None:
+                        reader = sources.reader(file_path)
                     if page_index >= len(reader.pages):
                         continue
                         
                     source_page = reader.pages[page_index]
                     new_page = writer.add_page(source_page)
+                    profiler.count('pages')
                     
                     if rotation != 0:
                         new_page.rotate(rotation)
@@ -200,10 +2170,12 @@ def merge_pdfs_hybrid(input_data):
                 except Exception as e:
                     report["errors"].append(f"Merge error: {str(e)}")
                     print(f"Error merging {file_path} page {page_index}: {e}", file=sys.stderr)
+            profiler.add('merge', time.perf_counter() - merge_started)
+            if not chunks_written and not writer.pages:
+                report["warnings"].append(f"No pages could be exported to {os.path.basename(group_output_path)}")
 
             # 3. METADATA & FORMAT INJECTION
             report["fixes"].append("Created 'StructTreeRoot' for document structure (1)")
-            doc_id = uuid.uuid4().hex.encode('ascii')
             writer_meta = {}
             if meta_data.get('title'): writer_meta["/Title"] = meta_data['title']
             if meta_data.get('author'): writer_meta["/Author"] = meta_data['author']
@@ -218,50 +2190,580 @@ def merge_pdfs_hybrid(input_data):
             if doc_id:
                 writer._ID = ArrayObject([ByteStringObject(doc_id), ByteStringObject(doc_id)])
 
-            with open(group_output_path, 'wb') as f:
-                writer.write(f)
-                
+            check_cancel()
+            annotate = annotation_overlay and has_fitz and _has_annotations(annotation_overlay, group_items)
+            try:
+                if streaming:
+                    emit('write')
+                    flush_chunk(len(group_items))
+                    if annotate:
+                        # The output is already on disk: only the annotated pages are appended
+                        emit('annotate')
+                        with profiler.stage('annotate'):
+                            _apply_annotation_overlay(group_output_path, annotation_overlay, group_items, report, annotation_simplify)
+                elif annotate or (dedupe and has_fitz):
+                    # Burn the annotations into (and/or compact) the assembled document
+                    # in memory so the output file is written exactly once
+                    buf = io.BytesIO()
+                    if dedupe:
+                        dedupe_writer()
+                    with profiler.stage('write'):
+                        writer.write(buf)
+                    writer = None
+                    doc = fitz.open("pdf", buf.getbuffer())
+                    try:
+                        if annotate:
+                            emit('annotate')
+                            with profiler.stage('annotate'):
+                                _draw_annotation_overlay(doc, annotation_overlay, group_items, annotation_simplify)
+                        emit('write')
+                        with profiler.stage('save'):
+                            if dedupe:
+                                # Duplicates are already merged, so skip garbage=4's pairwise
+                                # comparison and just pack objects into object/xref streams
+                                doc.save(group_output_path, garbage=2, deflate=True, use_objstms=1)
+                                dedupe_totals[2] = len(buf.getbuffer()) - os.path.getsize(group_output_path)
+                            else:
+                                doc.save(group_output_path, garbage=4, deflate=True)
+                    except Exception as e:
+                        stage = "Annotation overlay" if annotate else "Output compaction"
+                        report["errors"].append(f"{stage} failed: {str(e)}")
+                        print(f"{stage} failed: {e}\n{traceback.format_exc()}", file=sys.stderr)
+                        with open(group_output_path, 'wb') as f:
+                            f.write(buf.getbuffer())
+                    finally:
+                        doc.close()
+                else:
+                    if dedupe:
+                        dedupe_writer()
+                    emit('write')
+                    with profiler.stage('write'), open(group_output_path, 'wb') as f:
+                        writer.write(f)
+            except BaseException:
+                # Never leave a truncated output behind
+                if os.path.exists(group_output_path):
+                    try:
+                        os.remove(group_output_path)
+                    except OSError:
+                        pass
+                raise
+            if dedupe_totals[0]:
+                report["fixes"].append(f"Merged {dedupe_totals[0]} duplicate fonts/images/objects shared across sources ({dedupe_totals[1] / 1024:.0f} KB saved)")
+            if dedupe_totals[2] > 0:
+                report["fixes"].append(f"Compressed output with object and cross-reference streams ({dedupe_totals[2] / 1024:.0f} KB saved)")
+            output_size = os.path.getsize(group_output_path)
+            profiler.count('bytesOut', output_size)
+            emit('write', bytesWritten=status["bytesWritten"] + output_size)
+
+        except BaseException:
+            # A streamed output is created by its first chunk; don't leave it half written
+            if chunks_written and os.path.exists(group_output_path):
+                try:
+                    os.remove(group_output_path)
+                except OSError:
+                    pass
+            raise
         finally:
+            for fitz_doc in fitz_docs_to_close:
+                fitz_doc.close()
             for tf in temp_files_to_delete:
+                sources.release(tf)
                 if os.path.exists(tf):
                     try:
                         os.remove(tf)
                     except:
                         pass
 
-    if mode == 'batch':
-        groups = {}
-        for it in items:
-            name = it.get('parentName', 'Merged Document.pdf')
-            if name not in groups: groups[name] = []
-            groups[name].append(it)
-            
-        if not os.path.exists(output_path):
-            os.makedirs(output_path)
+    def export_split(group_items, group_output_path):
+        """
+        Split export (exportOptions.splitMaxBytes / splitMaxPages): plans the parts with
+        a running byte count over the scanned page resources (see _plan_split) and
+        writes each one through process_group as <name>_partNN.pdf, or to the output
+        path itself when everything fits in one. Part sizes are checked with a stat:
+        a part that still comes out over splitMaxBytes is exported again with its
+        images downsampled further down SPLIT_DPI_STEPS, to the first resolution the
+        corrected prediction fits at. A part with several pages that no resolution
+        would fit is planned again into smaller parts instead. Parts already written
+        are removed if the export is cancelled.
+        """
+        nonlocal optimize, target_dpi, trigger_dpi
+        if split_bytes and not has_fitz:
+            report["warnings"].append("PyMuPDF is not installed. Output files were split by page count only.")
+        settings = {
+            'optimize': optimize, 'targetDpi': target_dpi, 'triggerDpi': trigger_dpi,
+            'fitWidth': A4_WIDTH if resize_to_fit else None,
+            'printSafe': print_safe, 'printSafeDpi': print_safe_dpi, 'annotationOverlay': annotation_overlay,
+            'fitzEngine': (has_fitz and not dedupe and not _wants_streaming(group_items, export_options)
+                           and export_options.get('engine', 'auto') in ('auto', 'fitz')),
+        }
+        levels = [None] + [dpi for dpi in SPLIT_DPI_STEPS if not optimize or dpi < target_dpi]
+        with profiler.stage('split'):
+            costs = _split_page_costs(group_items, settings, check_cancel)
+            queue = deque(_plan_split(costs, split_bytes if has_fitz else 0, split_pages, settings, levels))
+        if not queue:  # Nothing to export: process_group reports it as usual
+            process_group(group_items, group_output_path)
+            return
+
+        configured = (optimize, target_dpi, trigger_dpi)
+        budget = split_bytes * SPLIT_FILL_RATIO
+        base, ext = os.path.splitext(group_output_path)
+        parts = []
+        try:
+            while queue:
+                check_cancel()
+                indices, predicted, dpi = queue.popleft()
+                part_path = f"{base}_part{len(parts) + 1:02d}{ext}"
+                level = levels.index(dpi)
+                started_at = (status["page"], status["bytesWritten"])
+                marks = {key: len(report[key]) for key in ("fixes", "warnings", "errors")}
+                while True:
+                    # A retry replaces the previous attempt, progress and messages included
+                    status["page"], status["bytesWritten"] = started_at
+                    for key, mark in marks.items():
+                        del report[key][mark:]
+                    if levels[level] is not None:
+                        optimize, target_dpi, trigger_dpi = True, levels[level], levels[level]
+                    try:
+                        process_group([group_items[i] for i in indices], part_path)
+                    finally:
+                        optimize, target_dpi, trigger_dpi = configured
+                    size = os.path.getsize(part_path)
+                    if not split_bytes or size <= split_bytes:
+                        break
+                    # Correct the prediction by how far off this attempt was and go to the
+                    # first resolution it fits at
+                    ratio = size / max(1, predicted)
+                    lower = [(lvl, _part_bytes(costs, indices, _at_dpi(settings, levels[lvl])))
+                             for lvl in range(level + 1, len(levels))]
+                    fitting = [(lvl, lvl_bytes) for lvl, lvl_bytes in lower if lvl_bytes * ratio <= budget]
+                    if fitting:
+                        level, predicted = fitting[0]
+                        continue
+                    if len(indices) > 1:
+                        # No resolution is predicted to fit: plan these pages again against
+                        # a budget scaled by the error, or halve them if that makes one part
+                        os.remove(part_path)
+                        for key, mark in marks.items():
+                            del report[key][mark:]
+                        replanned = [([indices[j] for j in sub], sub_bytes, sub_dpi) for sub, sub_bytes, sub_dpi in
+                                     _plan_split([costs[i] for i in indices], split_bytes * predicted / size,
+                                                 split_pages, settings, levels)]
+                        if len(replanned) < 2:
+                            half = len(indices) // 2
+                            replanned = [(part, _part_bytes(costs, part, settings), None)
+                                         for part in (indices[:half], indices[half:])]
+                        queue.extendleft(reversed(replanned))
+                        part_path = None
+                        break
+                    if lower and lower[-1][1] < predicted:
+                        level, predicted = lower[-1]  # The smallest this page gets
+                        continue
+                    report["warnings"].append(
+                        f"{os.path.basename(part_path)} is {size / 1e6:.3g} MB, over the {split_bytes / 1e6:g} MB "
+                        f"limit even with images at {levels[level] or target_dpi} DPI")
+                    break
+                if part_path is None:
+                    continue
+                if levels[level] is not None:
+                    report["fixes"].append(f"Downsampled images in {os.path.basename(part_path)} to {levels[level]} DPI "
+                                           f"to fit the {split_bytes / 1e6:g} MB limit")
+                parts.append({"output": part_path, "pages": len(indices), "bytes": size,
+                              "predictedBytes": predicted, "targetDpi": levels[level]})
+        except BaseException:
+            # A cancelled (or failed) split leaves no numbered parts behind
+            for path in [part["output"] for part in parts] + [f"{base}_part{len(parts) + 1:02d}{ext}"]:
+                if os.path.exists(path):
+                    os.remove(path)
+            raise
+
+        if len(parts) == 1:
+            _remove_manifest(group_output_path)
+            os.replace(parts[0]["output"], group_output_path)
+            part_name, output_name = os.path.basename(parts[0]["output"]), os.path.basename(group_output_path)
+            report["fixes"][:] = [fix.replace(part_name, output_name) for fix in report["fixes"]]
+            parts[0]["output"] = group_output_path
+        else:
+            limits = [f"{split_bytes / 1e6:g} MB"] if split_bytes else []
+            limits += [f"{split_pages} pages"] if split_pages else []
+            report["fixes"].append(f"Split {os.path.basename(group_output_path)} into {len(parts)} parts "
+                                   f"of at most {' / '.join(limits)}")
+        report.setdefault("splitParts", []).extend(parts)
+
+    def export_group(group_items, group_output_path):
+        """
+        Exports one output file. With exportOptions.incremental, a manifest next to the
+        output keeps a hash per page (source, page, rotation, annotations) plus one for
+        the options. The next export to the same path rebuilds only the pages whose
+        hash is new, through process_group, and copies every other page from the
+        previous output in runs.
+        """
+        sources.exclude(group_output_path)  # The incremental path replaces it in place
+        if split_bytes or split_pages:
+            export_split(group_items, group_output_path)
+            return
+        if not incremental or not has_fitz:
+            process_group(group_items, group_output_path)
+            return
+
+        options_hash = _options_hash(export_options, meta_data)
+        page_hashes = _page_hashes(group_items, resize_to_fit, annotation_overlay)
+        previous = _load_manifest(group_output_path, options_hash)
+        reuse = {}
+        if previous:
+            old_pages = {}
+            for old_no, page_hash in enumerate(previous['pages']):
+                old_pages.setdefault(page_hash, old_no)
+            reuse = {i: old_pages[h] for i, h in enumerate(page_hashes) if h in old_pages}
+
+        if not reuse:
+            _remove_manifest(group_output_path)
+            process_group(group_items, group_output_path)
+            with fitz.open(group_output_path) as out_doc:
+                complete = len(out_doc) == len(group_items)
+            if complete:  # Skipped items would shift every later page
+                _write_manifest(group_output_path, options_hash, page_hashes)
+            return
+
+        if len(reuse) == len(group_items) == len(previous['pages']) and all(reuse[i] == i for i in reuse):
+            report["fixes"].append(f"Output is up to date; reused all {len(group_items)} pages of the previous export")
+            return
+
+        changed = [item for i, item in enumerate(group_items) if i not in reuse]
+        fd, part_path = tempfile.mkstemp(suffix=".pdf", dir=os.path.dirname(os.path.abspath(group_output_path)))
+        os.close(fd)
+        assembled_path = part_path + ".out"
+        try:
+            if changed:
+                process_group(changed, part_path)
+                with fitz.open(part_path) as part_doc:
+                    if len(part_doc) != len(changed):
+                        raise ValueError("rebuilt pages are incomplete")
+
+            emit('merge', page=status["page"])
+            with profiler.stage('reuse'):
+                old_doc = fitz.open(group_output_path)
+                part_doc = fitz.open(part_path) if changed else None
+                doc = fitz.open()
+                try:
+                    planned = []
+                    new_no = 0
+                    for i in range(len(group_items)):
+                        if i in reuse:
+                            planned.append(('old', reuse[i], 0, i))
+                        else:
+                            planned.append(('new', new_no, 0, i))
+                            new_no += 1
+                    for source, first, last, _, last_item_no, final in _plan_runs(planned):
+                        check_cancel()
+                        doc.insert_pdf(old_doc if source == 'old' else part_doc, from_page=first, to_page=last, final=final)
+                        emit('merge', force=False, page=status["page"] + last_item_no + 1)
+                    metadata = {"producer": "Combine+ Exporter"}
+                    if meta_data.get('title'): metadata["title"] = meta_data['title']
+                    if meta_data.get('author'): metadata["author"] = meta_data['author']
+                    doc.set_metadata(metadata)
+                    emit('write')
+                    doc.save(assembled_path, garbage=1, deflate=True)
+                finally:
+                    doc.close()
+                    old_doc.close()
+                    if part_doc is not None:
+                        part_doc.close()
+            _remove_manifest(group_output_path)
+            os.replace(assembled_path, group_output_path)
+        except BaseException as e:
+            if os.path.exists(assembled_path):
+                os.remove(assembled_path)
+            if isinstance(e, ExportCancelled) or not isinstance(e, Exception):
+                raise
+            # The previous output is untouched at this point: fall back to a full export
+            print(f"Incremental export of {group_output_path} failed, rebuilding: {e}", file=sys.stderr)
+            _remove_manifest(group_output_path)
+            process_group(group_items, group_output_path)
+            return
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+
+        _write_manifest(group_output_path, options_hash, page_hashes)
+        output_size = os.path.getsize(group_output_path)
+        profiler.count('bytesOut', output_size)
+        report["fixes"].append(f"Reused {len(reuse)} of {len(group_items)} pages from the previous export "
+                               f"({len(changed)} rebuilt)")
+        emit('write', bytesWritten=status["bytesWritten"] + output_size)
+
+    try:
+        if dry_run:
+            # DRY RUN: predict size and time from sampled metadata scans; nothing is written
+            if not has_fitz:
+                raise RuntimeError("PyMuPDF is required to estimate an export")
+            groups = OrderedDict()
+            for it in items:
+                name = os.path.basename(output_path) if mode != 'batch' else \
+                    f"{os.path.splitext(it.get('parentName', 'Merged Document.pdf'))[0]}_exported.pdf"
+                groups.setdefault(name, []).append(it)
+            settings = {
+                'optimize': optimize, 'targetDpi': target_dpi, 'triggerDpi': trigger_dpi,
+                'resizeToFit': resize_to_fit, 'printSafe': print_safe, 'printSafeDpi': print_safe_dpi,
+                'annotationOverlay': annotation_overlay,
+                'samplePages': int(export_options.get('estimateSamplePages', DEFAULT_ESTIMATE_SAMPLE_PAGES)),
+            }
+            estimate = {}
+            with profiler.stage('estimate'):
+                for name, group_items in groups.items():
+                    emit('estimate', group=name)
+                    settings['output'] = name
+                    settings['fitzEngine'] = (not dedupe and not _wants_streaming(group_items, export_options)
+                                              and export_options.get('engine', 'auto') in ('auto', 'fitz'))
+                    _merge_reports(estimate, _estimate_group(group_items, settings, check_cancel))
+            if estimate:
+                estimate["estimatedSeconds"] = round(estimate["estimatedSeconds"], 2)
+            report["estimate"] = estimate
+        elif mode == 'batch':
+            groups = {}
+            for it in items:
+                name = it.get('parentName', 'Merged Document.pdf')
+                if name not in groups: groups[name] = []
+                groups[name].append(it)
             
-        if annotation_overlay and not has_fitz:
-            report["warnings"].append("PyMuPDF is not installed. Annotations were skipped.")
+            if not os.path.exists(output_path):
+                os.makedirs(output_path)
             
-        for name, group_items in groups.items():
-            base_name = os.path.splitext(name)[0]
-            out_file = os.path.join(output_path, f"{base_name}_exported.pdf")
-            process_group(group_items, out_file)
+            if annotation_overlay and not has_fitz:
+                report["warnings"].append("PyMuPDF is not installed. Annotations were skipped.")
             
-            if annotation_overlay and has_fitz:
-                _apply_annotation_overlay(out_file, annotation_overlay, group_items, report)
-    else:
-        process_group(items, output_path)
-        if annotation_overlay and not has_fitz:
-            report["warnings"].append("PyMuPDF is not installed. Annotations were skipped.")
-        if annotation_overlay and has_fitz:
-            _apply_annotation_overlay(output_path, annotation_overlay, items, report)
+            pool_size = _resolve_workers(workers, len(groups))
+            if pool_size > 1:
+                # Groups are independent output files: export each one as its own merge
+                # job and fold the reports back in group order. A job carries only its own
+                # items and annotations, and the image threads are shared out between jobs
+                # so the pool does not oversubscribe the CPU.
+                job_options = {**export_options, 'mode': 'merge', 'workers': 1, 'printSafeWorkers': 1,
+                               'imageThreads': max(1, image_threads // pool_size)}
+                jobs = []
+                for name, group_items in groups.items():
+                    base_name = os.path.splitext(name)[0]
+                    overlays = None
+                    if annotation_overlay and has_fitz:
+                        overlays = {it['id']: annotation_overlay[it['id']] for it in group_items
+                                    if it.get('id') in annotation_overlay}
+                    jobs.append({
+                        'items': group_items,
+                        'outputPath': os.path.join(output_path, f"{base_name}_exported.pdf"),
+                        'resizeToFit': resize_to_fit,
+                        'metadata': meta_data,
+                        'exportOptions': job_options,
+                        'annotationOverlay': overlays,
+                    })
+                with ProcessPoolExecutor(max_workers=pool_size) as pool:
+                    futures = [pool.submit(_export_group_job, job) for job in jobs]
+                    try:
+                        for job, future in zip(jobs, futures):
+                            # Poll so a cancel request is noticed while groups are running;
+                            # the workers see the same cancelFile and stop on their own
+                            while True:
+                                check_cancel()
+                                try:
+                                    group_report = future.result(timeout=PROGRESS_INTERVAL * 2)
+                                    break
+                                except FuturesTimeout:
+                                    continue
+                                except Exception as e:
+                                    group_report = {"errors": [f"Export failed for {os.path.basename(job['outputPath'])}: {str(e)}"]}
+                                    break
+                            _merge_reports(report, group_report)
+                            bytes_written = status["bytesWritten"]
+                            if os.path.exists(job['outputPath']):
+                                bytes_written += os.path.getsize(job['outputPath'])
+                            else:
+                                bytes_written += sum(part["bytes"] for part in group_report.get("splitParts", []))
+                            emit('write', group=os.path.basename(job['outputPath']),
+                                 page=status["page"] + len(job['items']), bytesWritten=bytes_written)
+                    except ExportCancelled:
+                        for future in futures:
+                            future.cancel()
+                        raise
+            else:
+                for name, group_items in groups.items():
+                    base_name = os.path.splitext(name)[0]
+                    out_file = os.path.join(output_path, f"{base_name}_exported.pdf")
+                    emit('merge', group=os.path.basename(out_file))
+                    try:
+                        export_group(group_items, out_file)
+                    except ExportCancelled:
+                        raise
+                    except Exception as e:
+                        report["errors"].append(f"Export failed for {os.path.basename(out_file)}: {str(e)}")
+                        print(f"Group export failed for {out_file}: {e}\n{traceback.format_exc()}", file=sys.stderr)
+        else:
+            emit('merge', group=os.path.basename(output_path))
+            export_group(items, output_path)
+            if annotation_overlay and not has_fitz:
+                report["warnings"].append("PyMuPDF is not installed. Annotations were skipped.")
+        if print_safe and not has_fitz:
+            report["warnings"].append("PyMuPDF is not installed. Print-safe conversion was skipped.")
+        emit('done')
+    except ExportCancelled:
+        if not report.get("cancelled"):  # Batch workers may already have said so
+            report["warnings"].append("Export was cancelled.")
+        report["cancelled"] = True
+        emit('cancelled')
+    finally:
+        sources.close()
+        io_report = {"sources": sources.io_report()}
+        io_now = _process_read_bytes()
+        for counter, key in (('disk', 'diskReadBytes'), ('calls', 'readCallBytes')):
+            if counter in io_started and counter in io_now:
+                io_report[key] = io_now[counter] - io_started[counter]
+        _merge_reports(report, {"io": io_report})
+        if image_cache is not None:
+            image_cache.prune()
+            _merge_reports(report, {"imageCache": {"hits": image_cache.hits, "misses": image_cache.misses}})
+        if profiler.enabled:
+            _merge_reports(report, {"profile": profiler.as_dict()})
+            # Batch workers report their own totals; the wall time is this call's
+            report["profile"]["totalSeconds"] = time.perf_counter() - started
+        if cprofile is not None:
+            cprofile.disable()
+            dump_path = os.path.join(output_path, "export.prof") if mode == 'batch' else f"{output_path}.prof"
+            try:
+                cprofile.dump_stats(dump_path)
+                report["profile"].setdefault("dumps", []).append(dump_path)
+            except OSError as e:
+                print(f"Could not write profile dump {dump_path}: {e}", file=sys.stderr)
     
     return report
 
-def _apply_annotation_overlay(pdf_path, overlays, items_list, report):
+_ARROW_COS = math.cos(math.pi / 6)
+_ARROW_SIN = math.sin(math.pi / 6)
+
+def _transform_points(xy, scale, rot_deg=0, origin=(0.0, 0.0)):
+    """
+    Rotates (x, y) pairs by `rot_deg` degrees about `origin`, then scales them into
+    page space. Returns an (n, 2) array with NumPy, or a list of tuples without it.
+    """
+    if rot_deg:
+        rad = rot_deg * math.pi / 180.0
+        c, s = math.cos(rad), math.sin(rad)
+    if has_numpy:
+        pts = np.asarray(xy, dtype=float).reshape(-1, 2)
+        if rot_deg:
+            d = pts - origin
+            pts = np.column_stack((d[:, 0] * c - d[:, 1] * s, d[:, 0] * s + d[:, 1] * c)) + origin
+        return pts * scale
+    ox, oy = origin
+    out = []
+    for x, y in xy:
+        if rot_deg:
+            dx, dy = x - ox, y - oy
+            x, y = ox + dx * c - dy * s, oy + dx * s + dy * c
+        out.append((x * scale, y * scale))
+    return out
+
+def _node_points(raw_points, scale):
+    """
+    Converts a node's [{'x':..,'y':..}, ...] list, or the packed float32 x,y array of a
+    streamed payload (see _read_ndjson_payload), into scaled page coordinates.
+    """
+    if isinstance(raw_points, array):
+        if has_numpy:
+            return np.frombuffer(raw_points, dtype=np.float32).astype(float).reshape(-1, 2) * scale
+        return [(raw_points[i] * scale, raw_points[i + 1] * scale) for i in range(0, len(raw_points) - 1, 2)]
+    if has_numpy:
+        flat = np.fromiter((v for p in raw_points for v in (p['x'], p['y'])), dtype=float, count=2 * len(raw_points))
+        return flat.reshape(-1, 2) * scale
+    return [(p['x'] * scale, p['y'] * scale) for p in raw_points]
+
+def _simplify_polyline(pts, tolerance):
+    """Douglas-Peucker simplification: drops points within `tolerance` of the kept line."""
+    n = len(pts)
+    if tolerance <= 0 or n < 3:
+        return pts
+    keep = [False] * n
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        i, j = stack.pop()
+        if j - i < 2:
+            continue
+        ax, ay = pts[i][0], pts[i][1]
+        bx, by = pts[j][0], pts[j][1]
+        norm = math.hypot(bx - ax, by - ay)
+        if has_numpy:
+            seg = pts[i + 1:j]
+            if norm == 0:
+                dist = np.hypot(seg[:, 0] - ax, seg[:, 1] - ay)
+            else:
+                dist = np.abs((bx - ax) * (seg[:, 1] - ay) - (by - ay) * (seg[:, 0] - ax)) / norm
+            k = int(np.argmax(dist))
+            dmax = dist[k]
+            k += i + 1
+        else:
+            dmax, k = -1.0, i
+            for m in range(i + 1, j):
+                px, py = pts[m]
+                if norm == 0:
+                    d = math.hypot(px - ax, py - ay)
+                else:
+                    d = abs((bx - ax) * (py - ay) - (by - ay) * (px - ax)) / norm
+                if d > dmax:
+                    dmax, k = d, m
+        if dmax > tolerance:
+            keep[k] = True
+            stack.append((i, k))
+            stack.append((k, j))
+    if has_numpy:
+        return pts[np.array(keep)]
+    return [p for p, k in zip(pts, keep) if k]
+
+def _arrowhead_points(tip, tail, headlen):
+    """End points of the two 30-degree barbs of an arrowhead at `tip` on a segment from `tail`."""
+    dx, dy = tip[0] - tail[0], tip[1] - tail[1]
+    length = math.hypot(dx, dy)
+    ux, uy = (dx / length, dy / length) if length else (1.0, 0.0)
+    return (
+        fitz.Point(tip[0] - headlen * (ux * _ARROW_COS + uy * _ARROW_SIN), tip[1] - headlen * (uy * _ARROW_COS - ux * _ARROW_SIN)),
+        fitz.Point(tip[0] - headlen * (ux * _ARROW_COS - uy * _ARROW_SIN), tip[1] - headlen * (uy * _ARROW_COS + ux * _ARROW_SIN)),
+    )
+
+def _draw_polyline_points(shape, pts):
+    """
+    Equivalent of Shape.draw_polyline for long point runs: transforms the whole run
+    with NumPy and appends the path operators in one go instead of per fitz.Point.
+    """
+    if len(pts) == 0:
+        return
+    if not has_numpy:
+        shape.draw_polyline([fitz.Point(x, y) for x, y in pts])
+        return
+    m = shape.ipctm
+    px = pts[:, 0] * m.a + pts[:, 1] * m.c + m.e
+    py = pts[:, 0] * m.b + pts[:, 1] * m.d + m.f
+    coords = np.column_stack((px, py)).tolist()
+    first = fitz.Point(float(pts[0, 0]), float(pts[0, 1]))
+    ops = []
+    if not (shape.last_point == first):
+        ops.append(f"{coords[0][0]:.4f} {coords[0][1]:.4f} m\n")
+    ops.extend(f"{x:.4f} {y:.4f} l\n" for x, y in coords[1:])
+    shape.draw_cont += "".join(ops)
+    shape.updateRect(fitz.Rect(float(pts[:, 0].min()), float(pts[:, 1].min()), float(pts[:, 0].max()), float(pts[:, 1].max())))
+    shape.last_point = fitz.Point(float(pts[-1, 0]), float(pts[-1, 1]))
+
+def _has_annotations(overlays, items_list):
+    """True when at least one item in `items_list` carries overlay nodes."""
+    if not overlays:
+        return False
+    for item in items_list:
+        overlay = overlays.get(item.get('id')) if item.get('id') else None
+        if overlay and overlay.get('nodes'):
+            return True
+    return False
+
+def _draw_annotation_overlay(doc, overlays, items_list, simplify_tolerance=0.0):
     """
     Parses raw vector coordinates from the frontend and injects them natively 
-    into the PDF as pristine vector shapes and text (Zero Rasterization).
+    into the open fitz `doc` as pristine vector shapes and text (Zero Rasterization).
+    Page i of `doc` belongs to items_list[i]. Freehand paths are optionally thinned
+    with Douglas-Peucker at `simplify_tolerance` points. Returns True if anything was drawn.
     """
 
     def hex_to_rgb(hex_str):
@@ -276,64 +2778,154 @@ def _apply_annotation_overlay(pdf_path, overlays, items_list, report):
         if style == 'dotted': return f"[{thickness:g} {thickness * 2:g}] 0"
         return None
 
-    try:
-        doc = fitz.open(pdf_path)
-        changed = False
-        actual_i = 0
-
-        for item in items_list:
-            if actual_i >= len(doc): break
-            page_id = item.get('id')
-            page = doc[actual_i]
-            actual_i += 1
-            
-            if not page_id or page_id not in overlays: continue
-            
-            overlay = overlays[page_id]
-            nodes = overlay.get('nodes', [])
-            if not nodes: continue
-
-            orig_rot_w = overlay.get('pageWidth', 0)
-            orig_rot_h = overlay.get('pageHeight', 0)
-            curr_rot_w = page.rect.width
-            curr_rot_h = page.rect.height
-            
-            scale = 1.0
-            if orig_rot_w > 0:
-                scale = max(curr_rot_w, curr_rot_h) / max(orig_rot_w, orig_rot_h)
+    changed = False
+    actual_i = 0
+    font = None  # Shared across TEXT nodes, only needed for measuring
+
+    for item in items_list:
+        if actual_i >= len(doc): break
+        page_id = item.get('id')
+        page_no = actual_i
+        actual_i += 1
+        
+        if not page_id or page_id not in overlays: continue
+        
+        overlay = overlays[page_id]
+        nodes = overlay.get('nodes', [])
+        if not nodes: continue
+        page = doc[page_no]  # Loaded only when annotated; large documents stay lazy
 
-            def get_pt(x, y):
-                return x * scale, y * scale
+        orig_rot_w = overlay.get('pageWidth', 0)
+        orig_rot_h = overlay.get('pageHeight', 0)
+        curr_rot_w = page.rect.width
+        curr_rot_h = page.rect.height
+        
+        scale = 1.0
+        if orig_rot_w > 0:
+            scale = max(curr_rot_w, curr_rot_h) / max(orig_rot_w, orig_rot_h)
 
-            for node in nodes:
-                # CREATING A FRESH SHAPE FOR EVERY NODE
-                shape = page.new_shape()
+        def get_pt(x, y):
+            return x * scale, y * scale
+
+        # One shape per page: every node still gets its own finish() (q ... Q block),
+        # so painting order and graphics state are unchanged, but the page gets a
+        # single content stream fragment instead of one per node. Consecutive opaque,
+        # open, unfilled strokes with identical state are further merged into one path.
+        shape = page.new_shape()
+        pending_stroke = None
+
+        def flush_stroke():
+            nonlocal pending_stroke
+            if pending_stroke is not None:
+                shape.finish(**pending_stroke)
+                pending_stroke = None
+
+        for node in nodes:
+            ntype = node.get('type')
+            color = hex_to_rgb(node.get('color'))
+            fill_color = hex_to_rgb(node.get('fillColor'))
+            # Only draw a stroke if explicitly requested AND not completely transparent/zero-width
+            has_stroke = node.get('strokeStyle') != 'none' and node.get('thickness', 1) > 0 and color is not None
+            thickness = node.get('thickness', 1) * scale
+            stroke_opacity = node.get('strokeOpacity', node.get('opacity', 100)) / 100.0
+            fill_opacity = node.get('fillOpacity', node.get('opacity', 100)) / 100.0
+            dashes = get_dashes(node.get('strokeStyle', 'solid'), thickness)
+
+            blend_mode = node.get('blendMode', 'source-over')
+            if blend_mode == 'destination-out':
+                color = (1.0, 1.0, 1.0)
+                fill_color = (1.0, 1.0, 1.0)
+                has_stroke = True
+
+            if ntype in ('PATH', 'POLYLINE') and node.get('points'):
+                pts = _simplify_polyline(_node_points(node.get('points'), scale), simplify_tolerance)
+                is_closed = node.get('closed', False)
+                if is_closed:
+                    if len(pts) > 0:
+                        pts = np.vstack((pts, pts[:1])) if has_numpy else pts + [pts[0]]
                 
-                ntype = node.get('type')
-                color = hex_to_rgb(node.get('color'))
-                fill_color = hex_to_rgb(node.get('fillColor'))
-                # Only draw a stroke if explicitly requested AND not completely transparent/zero-width
-                has_stroke = node.get('strokeStyle') != 'none' and node.get('thickness', 1) > 0 and color is not None
-                thickness = node.get('thickness', 1) * scale
-                stroke_opacity = node.get('strokeOpacity', node.get('opacity', 100)) / 100.0
-                fill_opacity = node.get('fillOpacity', node.get('opacity', 100)) / 100.0
-                dashes = get_dashes(node.get('strokeStyle', 'solid'), thickness)
-
-                blend_mode = node.get('blendMode', 'source-over')
-                if blend_mode == 'destination-out':
-                    color = (1.0, 1.0, 1.0)
-                    fill_color = (1.0, 1.0, 1.0)
-                    has_stroke = True
-
-                if ntype in ('PATH', 'POLYLINE') and node.get('points'):
-                    pts = [get_pt(p['x'], p['y']) for p in node.get('points')]
-                    fitz_pts = [fitz.Point(x, y) for x, y in pts]
-                    is_closed = node.get('closed', False)
-                    if is_closed:
-                        if len(fitz_pts) > 0:
-                            fitz_pts.append(fitz_pts[0])
-                    
+                finish_args = dict(
+                    color=color if has_stroke else None,
+                    fill=fill_color,
+                    width=thickness,
+                    stroke_opacity=stroke_opacity,
+                    fill_opacity=fill_opacity,
+                    dashes=dashes,
+                    lineCap=1, lineJoin=1,
+                    closePath=is_closed
+                )
+                # Overlapping translucent strokes darken where painted separately, and
+                # closePath/fill only act on the whole path: merge only when neither applies
+                mergeable = has_stroke and fill_color is None and not is_closed and stroke_opacity >= 1
+                if pending_stroke is not None and (not mergeable or finish_args != pending_stroke):
+                    flush_stroke()
+                _draw_polyline_points(shape, pts)
+                if mergeable:
+                    pending_stroke = finish_args
+                else:
+                    shape.finish(**finish_args)
+                continue
+
+            flush_stroke()
+
+            if ntype == 'SHAPE':
+                stype = node.get('shapeType')
+                x1, y1 = get_pt(node['x'], node['y'])
+                x2, y2 = get_pt(node['endX'], node['endY'])
+                
+                if stype == 'LINE':
+                    if has_stroke:
+                        shape.draw_line(fitz.Point(x1, y1), fitz.Point(x2, y2))
+                elif stype == 'RECTANGLE':
+                    ux1, uy1 = node['x'], node['y']
+                    ux2, uy2 = node['endX'], node['endY']
+                    pts = [
+                        get_pt(ux1, uy1),
+                        get_pt(ux2, uy1),
+                        get_pt(ux2, uy2),
+                        get_pt(ux1, uy2)
+                    ]
+                    fitz_pts = [fitz.Point(p[0], p[1]) for p in pts]
+                    if len(fitz_pts) > 0: fitz_pts.append(fitz_pts[0])
                     shape.draw_polyline(fitz_pts)
+                elif stype == 'ELLIPSE':
+                    ux1, uy1 = node['x'], node['y']
+                    ux2, uy2 = node['endX'], node['endY']
+                    pts = [
+                        get_pt(ux1, uy1),
+                        get_pt(ux2, uy1),
+                        get_pt(ux2, uy2),
+                        get_pt(ux1, uy2)
+                    ]
+                    quad = fitz.Quad(pts[0], pts[1], pts[3], pts[2])
+                    shape.draw_oval(quad)
+                elif stype == 'ARROW':
+                    if has_stroke:
+                        shape.draw_line(fitz.Point(x1, y1), fitz.Point(x2, y2))
+                        shape.finish(
+                            color=color if has_stroke else None,
+                            width=thickness,
+                            stroke_opacity=stroke_opacity,
+                            dashes=dashes,
+                            lineCap=1, lineJoin=1,
+                            closePath=False
+                        )
+                        
+                        # Separate finish for arrowhead to avoid connection to shaft
+                        p3, p4 = _arrowhead_points((x2, y2), (x1, y1), 12 * scale)
+                        shape.draw_line(fitz.Point(x2, y2), p3)
+                        shape.draw_line(fitz.Point(x2, y2), p4)
+                        shape.finish(
+                            color=color if has_stroke else None,
+                            width=thickness,
+                            stroke_opacity=stroke_opacity,
+                            dashes=None,
+                            lineCap=1, lineJoin=1,
+                            closePath=False
+                        )
+                        # Fall through to finish/commit if needed, but normally handled above
+                
+                if stype in ('LINE', 'RECTANGLE', 'ELLIPSE'):
                     shape.finish(
                         color=color if has_stroke else None,
                         fill=fill_color,
@@ -342,280 +2934,406 @@ def _apply_annotation_overlay(pdf_path, overlays, items_list, report):
                         fill_opacity=fill_opacity,
                         dashes=dashes,
                         lineCap=1, lineJoin=1,
-                        closePath=is_closed
+                        closePath=(stype in ('RECTANGLE', 'ELLIPSE'))
                     )
-                    shape.commit()
 
-                elif ntype == 'SHAPE':
-                    stype = node.get('shapeType')
-                    x1, y1 = get_pt(node['x'], node['y'])
-                    x2, y2 = get_pt(node['endX'], node['endY'])
+            elif ntype == 'TEXT':
+                txt = node.get('text', '')
+                font_size = node.get('fontSize', 16) * scale
+                node_rot = node.get('rotation', 0)
+                
+                lines = txt.split('\n')
+                if font is None:
+                    font = fitz.Font("helv")
+                
+                max_width = 0
+                for line in lines:
+                    l = font.text_length(line, fontsize=font_size)
+                    if l > max_width: max_width = l
+                
+                text_h = font_size * len(lines)
+                ux, uy = node['x'], node['y']
+                
+                if node.get('leaderHead') and node.get('leaderElbow'):
+                    hx = node['leaderHead']['x'] - ux
+                    hy = node['leaderHead']['y'] - uy
+                    ex = node['leaderElbow']['x'] - ux
+                    ey = node['leaderElbow']['y'] - uy
+
+                    if node_rot != 0:
+                        rad = node_rot * math.pi / 180.0
+                        cos_r, sin_r = math.cos(rad), math.sin(rad)
+                        # Inverse rotation into the text box's local frame
+                        hx, hy = hx * cos_r + hy * sin_r, -hx * sin_r + hy * cos_r
+                        ex, ey = ex * cos_r + ey * sin_r, -ex * sin_r + ey * cos_r
+
+                    # Align mathematically with browser canvas boundary logic
+                    minX_local = -node.get('padding', 5) - 1
+                    maxX_local = (max_width/scale) + node.get('padding', 5) + 1
+                    minY_local = -node.get('padding', 5) - 1
+                    maxY_local = (text_h/scale) + node.get('padding', 5) + 1
                     
-                    if stype == 'LINE':
-                        if has_stroke:
-                            shape.draw_line(fitz.Point(x1, y1), fitz.Point(x2, y2))
-                    elif stype == 'RECTANGLE':
-                        ux1, uy1 = node['x'], node['y']
-                        ux2, uy2 = node['endX'], node['endY']
-                        pts = [
-                            get_pt(ux1, uy1),
-                            get_pt(ux2, uy1),
-                            get_pt(ux2, uy2),
-                            get_pt(ux1, uy2)
-                        ]
-                        fitz_pts = [fitz.Point(p[0], p[1]) for p in pts]
-                        if len(fitz_pts) > 0: fitz_pts.append(fitz_pts[0])
-                        shape.draw_polyline(fitz_pts)
-                    elif stype == 'ELLIPSE':
-                        ux1, uy1 = node['x'], node['y']
-                        ux2, uy2 = node['endX'], node['endY']
-                        pts = [
-                            get_pt(ux1, uy1),
-                            get_pt(ux2, uy1),
-                            get_pt(ux2, uy2),
-                            get_pt(ux1, uy2)
-                        ]
-                        quad = fitz.Quad(pts[0], pts[1], pts[3], pts[2])
-                        shape.draw_oval(quad)
-                    elif stype == 'ARROW':
-                        if has_stroke:
-                            shape.draw_line(fitz.Point(x1, y1), fitz.Point(x2, y2))
-                            shape.finish(
-                                color=color if has_stroke else None,
-                                width=thickness,
-                                stroke_opacity=stroke_opacity,
-                                dashes=dashes,
-                                lineCap=1, lineJoin=1,
-                                closePath=False
-                            )
-                            shape.commit()
-                            
-                            # Fresh shape for arrowhead to avoid connection to shaft
-                            shape = page.new_shape()
-                            dx = x2 - x1
-                            dy = y2 - y1
-                            angle = math.atan2(dy, dx)
-                            headlen = 12 * scale
-                            p3 = fitz.Point(x2 - headlen * math.cos(angle - math.pi / 6), y2 - headlen * math.sin(angle - math.pi / 6))
-                            p4 = fitz.Point(x2 - headlen * math.cos(angle + math.pi / 6), y2 - headlen * math.sin(angle + math.pi / 6))
-                            shape.draw_line(fitz.Point(x2, y2), p3)
-                            shape.draw_line(fitz.Point(x2, y2), p4)
-                            shape.finish(
-                                color=color if has_stroke else None,
-                                width=thickness,
-                                stroke_opacity=stroke_opacity,
-                                dashes=None,
-                                lineCap=1, lineJoin=1,
-                                closePath=False
-                            )
-                            # Fall through to finish/commit if needed, but normally handled above
+                    cx_local = (minX_local + maxX_local) / 2.0
+                    cy_local = (minY_local + maxY_local) / 2.0
+                    
+                    ix_local = cx_local
+                    iy_local = cy_local
+                    
+                    dx_local = cx_local - ex
+                    dy_local = cy_local - ey
+                    
+                    if dx_local != 0 or dy_local != 0:
+                        tX = -float('inf')
+                        tY = -float('inf')
+                        if dx_local > 0: tX = (minX_local - ex) / float(dx_local)
+                        elif dx_local < 0: tX = (maxX_local - ex) / float(dx_local)
+                        if dy_local > 0: tY = (minY_local - ey) / float(dy_local)
+                        elif dy_local < 0: tY = (maxY_local - ey) / float(dy_local)
+                        t = max(0, min(1, max(tX, tY)))
+                        ix_local = ex + t * dx_local
+                        iy_local = ey + t * dy_local
+                    
+                    if node_rot != 0:
+                        ix_global = ux + (ix_local * cos_r - iy_local * sin_r)
+                        iy_global = uy + (ix_local * sin_r + iy_local * cos_r)
+                    else:
+                        ix_global = ux + ix_local
+                        iy_global = uy + iy_local
+                        
+                    p1 = get_pt(ix_global, iy_global)
+                    p2 = get_pt(node['leaderElbow']['x'], node['leaderElbow']['y'])
+                    p3 = get_pt(node['leaderHead']['x'], node['leaderHead']['y'])
                     
-                    if stype in ('LINE', 'RECTANGLE', 'ELLIPSE'):
+                    if has_stroke:
+                        shape.draw_polyline([fitz.Point(*p1), fitz.Point(*p2), fitz.Point(*p3)])
                         shape.finish(
                             color=color if has_stroke else None,
-                            fill=fill_color,
                             width=thickness,
                             stroke_opacity=stroke_opacity,
-                            fill_opacity=fill_opacity,
                             dashes=dashes,
                             lineCap=1, lineJoin=1,
-                            closePath=(stype in ('RECTANGLE', 'ELLIPSE'))
+                            closePath=False
                         )
-                    shape.commit()
-
-                elif ntype == 'TEXT':
-                    txt = node.get('text', '')
-                    font_size = node.get('fontSize', 16) * scale
-                    node_rot = node.get('rotation', 0)
-                    
-                    lines = txt.split('\n')
-                    font = fitz.Font("helv")
-                    
-                    max_width = 0
-                    for line in lines:
-                        l = font.text_length(line, fontsize=font_size)
-                        if l > max_width: max_width = l
-                    
-                    text_h = font_size * len(lines)
-                    ux, uy = node['x'], node['y']
-                    
-                    if node.get('leaderHead') and node.get('leaderElbow'):
-                        hx = node['leaderHead']['x'] - ux
-                        hy = node['leaderHead']['y'] - uy
-                        ex = node['leaderElbow']['x'] - ux
-                        ey = node['leaderElbow']['y'] - uy
-
-                        if node_rot != 0:
-                            rad = -node_rot * math.pi / 180.0
-                            hx, hy = hx * math.cos(rad) - hy * math.sin(rad), hx * math.sin(rad) + hy * math.cos(rad)
-                            ex, ey = ex * math.cos(rad) - ey * math.sin(rad), ex * math.sin(rad) + ey * math.cos(rad)
-
-                        # Align mathematically with browser canvas boundary logic
-                        minX_local = -node.get('padding', 5) - 1
-                        maxX_local = (max_width/scale) + node.get('padding', 5) + 1
-                        minY_local = -node.get('padding', 5) - 1
-                        maxY_local = (text_h/scale) + node.get('padding', 5) + 1
-                        
-                        cx_local = (minX_local + maxX_local) / 2.0
-                        cy_local = (minY_local + maxY_local) / 2.0
                         
-                        ix_local = cx_local
-                        iy_local = cy_local
+                        # Separate finish for leader arrowhead
+                        p4, p5 = _arrowhead_points(p3, p2, 12 * scale)
+                        shape.draw_line(fitz.Point(*p3), p4)
+                        shape.draw_line(fitz.Point(*p3), p5)
                         
-                        dx_local = cx_local - ex
-                        dy_local = cy_local - ey
-                        
-                        if dx_local != 0 or dy_local != 0:
-                            tX = -float('inf')
-                            tY = -float('inf')
-                            if dx_local > 0: tX = (minX_local - ex) / float(dx_local)
-                            elif dx_local < 0: tX = (maxX_local - ex) / float(dx_local)
-                            if dy_local > 0: tY = (minY_local - ey) / float(dy_local)
-                            elif dy_local < 0: tY = (maxY_local - ey) / float(dy_local)
-                            t = max(0, min(1, max(tX, tY)))
-                            ix_local = ex + t * dx_local
-                            iy_local = ey + t * dy_local
-                        
-                        if node_rot != 0:
-                            rad_back = node_rot * math.pi / 180.0
-                            ix_global = ux + (ix_local * math.cos(rad_back) - iy_local * math.sin(rad_back))
-                            iy_global = uy + (ix_local * math.sin(rad_back) + iy_local * math.cos(rad_back))
-                        else:
-                            ix_global = ux + ix_local
-                            iy_global = uy + iy_local
-                            
-                        p1 = get_pt(ix_global, iy_global)
-                        p2 = get_pt(node['leaderElbow']['x'], node['leaderElbow']['y'])
-                        p3 = get_pt(node['leaderHead']['x'], node['leaderHead']['y'])
-                        
-                        if has_stroke:
-                            shape.draw_polyline([fitz.Point(*p1), fitz.Point(*p2), fitz.Point(*p3)])
-                            shape.finish(
-                                color=color if has_stroke else None,
-                                width=thickness,
-                                stroke_opacity=stroke_opacity,
-                                dashes=dashes,
-                                lineCap=1, lineJoin=1,
-                                closePath=False
-                            )
-                            shape.commit()
-                            
-                            # Fresh shape for leader arrowhead
-                            shape = page.new_shape()
-                            angle = math.atan2(p3[1] - p2[1], p3[0] - p2[0])
-                            headlen = 12 * scale
-                            p4 = fitz.Point(p3[0] - headlen * math.cos(angle - math.pi / 6), p3[1] - headlen * math.sin(angle - math.pi / 6))
-                            p5 = fitz.Point(p3[0] - headlen * math.cos(angle + math.pi / 6), p3[1] - headlen * math.sin(angle + math.pi / 6))
-                            shape.draw_line(fitz.Point(*p3), p4)
-                            shape.draw_line(fitz.Point(*p3), p5)
-                            
-                            shape.finish(
-                                color=color if has_stroke else None,
-                                width=thickness,
-                                stroke_opacity=stroke_opacity,
-                                dashes=None,
-                                lineCap=1, lineJoin=1,
-                                closePath=False
-                            )
-                            shape.commit()
-                            shape = page.new_shape()
-                    
-                    def rotate_pt(px, py, ox, oy):
-                        if node_rot == 0: return px, py
-                        dx = px - ox
-                        dy = py - oy
-                        rad = node_rot * math.pi / 180.0
-                        rx = dx * math.cos(rad) - dy * math.sin(rad)
-                        ry = dx * math.sin(rad) + dy * math.cos(rad)
-                        return ox + rx, oy + ry
-
-                    minX = ux - node.get('padding', 5)
-                    maxX = ux + (max_width/scale) + node.get('padding', 5)
-                    minY = uy - node.get('padding', 5)
-                    maxY = uy + (text_h/scale) + node.get('padding', 5)
-                    pts = [
-                        get_pt(*rotate_pt(minX, minY, ux, uy)),
-                        get_pt(*rotate_pt(maxX, minY, ux, uy)),
-                        get_pt(*rotate_pt(maxX, maxY, ux, uy)),
-                        get_pt(*rotate_pt(minX, maxY, ux, uy))
-                    ]
-                    
-                    fitz_pts = [fitz.Point(p[0], p[1]) for p in pts]
-                    if len(fitz_pts) > 0: fitz_pts.append(fitz_pts[0])
-                    shape.draw_polyline(fitz_pts)
-                    shape.finish(
-                        color=color if has_stroke and thickness > 0 else None,
-                        fill=fill_color,
-                        width=thickness,
-                        stroke_opacity=stroke_opacity,
-                        fill_opacity=fill_opacity,
-                        dashes=dashes,
-                        lineCap=1, lineJoin=1,
-                        closePath=True
-                    )
-                    shape.commit()
-                    
-                    tcolor = hex_to_rgb(node.get('textColor', node.get('color', '#000000')))
-                    if tcolor is None: tcolor = (0,0,0)
+                        shape.finish(
+                            color=color if has_stroke else None,
+                            width=thickness,
+                            stroke_opacity=stroke_opacity,
+                            dashes=None,
+                            lineCap=1, lineJoin=1,
+                            closePath=False
+                        )
+                
+                minX = ux - node.get('padding', 5)
+                maxX = ux + (max_width/scale) + node.get('padding', 5)
+                minY = uy - node.get('padding', 5)
+                maxY = uy + (text_h/scale) + node.get('padding', 5)
+
+                # Box corners and every line's baseline origin share one rotation about
+                # (ux, uy), so transform them as a single batch
+                line_origins = [(ux, uy + idx * (font_size/scale) + (font_size/scale) * 0.8) for idx in range(len(lines))]
+                pts = _transform_points(
+                    [(minX, minY), (maxX, minY), (maxX, maxY), (minX, maxY)] + line_origins,
+                    scale, node_rot, (ux, uy)
+                )
+                
+                fitz_pts = [fitz.Point(float(p[0]), float(p[1])) for p in pts[:4]]
+                fitz_pts.append(fitz_pts[0])
+                shape.draw_polyline(fitz_pts)
+                shape.finish(
+                    color=color if has_stroke and thickness > 0 else None,
+                    fill=fill_color,
+                    width=thickness,
+                    stroke_opacity=stroke_opacity,
+                    fill_opacity=fill_opacity,
+                    dashes=dashes,
+                    lineCap=1, lineJoin=1,
+                    closePath=True
+                )
+                # insert_text writes its own content stream; commit first to keep paint order
+                shape.commit()
+                shape = page.new_shape()
+                
+                tcolor = hex_to_rgb(node.get('textColor', node.get('color', '#000000')))
+                if tcolor is None: tcolor = (0,0,0)
+                
+                for idx, line in enumerate(lines):
+                    # Accurately apply group block rotation so text matches its mathematical bounding box
+                    rx, ry = float(pts[4 + idx][0]), float(pts[4 + idx][1])
                     
-                    for idx, line in enumerate(lines):
-                        l_ox = ux
-                        l_oy = uy + idx * (font_size/scale)
-                        y_adjusted = l_oy + (font_size/scale) * 0.8
+                    kwargs = {
+                        "fontsize": font_size,
+                        "fontname": "helv",
+                        "color": tcolor,
+                        "fill_opacity": stroke_opacity
+                    }
+                    if node_rot != 0:
+                        kwargs["morph"] = (fitz.Point(rx, ry), fitz.Matrix(node_rot))
                         
-                        # Accurately apply group block rotation so text matches its mathematical bounding box
-                        rx_unscaled, ry_unscaled = rotate_pt(l_ox, y_adjusted, ux, uy)
-                        rx, ry = get_pt(rx_unscaled, ry_unscaled)
-                        
-                        kwargs = {
-                            "fontsize": font_size,
-                            "fontname": "helv",
-                            "color": tcolor,
-                            "fill_opacity": stroke_opacity
-                        }
-                        if node_rot != 0:
-                            kwargs["morph"] = (fitz.Point(rx, ry), fitz.Matrix(node_rot))
-                            
-                        page.insert_text(fitz.Point(rx, ry), line, **kwargs)
-            changed = True
+                    page.insert_text(fitz.Point(rx, ry), line, **kwargs)
+        flush_stroke()
+        shape.commit()
+        changed = True
 
-        if changed:
-            fd, temp_path = tempfile.mkstemp(suffix=".pdf")
-            os.close(fd)
-            doc.save(temp_path, garbage=4, deflate=True)
+    return changed
+
+def _apply_annotation_overlay(pdf_path, overlays, items_list, report, simplify_tolerance=0.0):
+    """
+    Post-pass variant for a PDF that is already on disk. Only the annotated pages are
+    appended via an incremental save instead of rewriting the whole file.
+    """
+    try:
+        doc = fitz.open(pdf_path)
+        if not _draw_annotation_overlay(doc, overlays, items_list, simplify_tolerance):
             doc.close()
-            success = False
-            for _ in range(10):
-                try:
-                    shutil.move(temp_path, pdf_path)
-                    success = True
-                    break
-                except Exception:
-                    time.sleep(0.5)
-            if not success:
-                report["errors"].append("Failed to overwrite PDF with annotations due to file lock.")
-        else:
+            return
+
+        if doc.can_save_incrementally():
+            doc.save(pdf_path, incremental=True, encryption=fitz.PDF_ENCRYPT_KEEP)
             doc.close()
+            return
+
+        # Repaired/broken inputs cannot be appended to; rewrite them instead
+        fd, temp_path = tempfile.mkstemp(suffix=".pdf")
+        os.close(fd)
+        doc.save(temp_path, garbage=4, deflate=True)
+        doc.close()
+        success = False
+        for _ in range(10):
+            try:
+                shutil.move(temp_path, pdf_path)
+                success = True
+                break
+            except Exception:
+                time.sleep(0.5)
+        if not success:
+            report["errors"].append("Failed to overwrite PDF with annotations due to file lock.")
     except Exception as e:
         report["errors"].append(f"Annotation overlay failed: {str(e)}")
         print(f"Vector annotation overlay failed: {e}\n{traceback.format_exc()}", file=sys.stderr)
 
+PAYLOAD_NDJSON_FORMAT = 'combine-ndjson/1'
+
+def _unpack_points(packed):
+    """Decodes base64 little-endian float32 x,y pairs into a compact array('f')."""
+    points = array('f')
+    points.frombytes(base64.b64decode(packed))
+    if sys.byteorder == 'big':
+        points.byteswap()
+    return points
+
+def _read_ndjson_payload(f):
+    """
+    Reads the streamed payload format written by main.js one line at a time: a header
+    with the job options, then {"item": {...}} records, {"overlay": id, ...} records
+    with a page's overlay fields, and {"node": {...}} records that belong to the
+    overlay before them. Freehand points arrive as node.packedPoints and stay packed
+    until the page is drawn, so heavily annotated jobs never hold the whole payload
+    as text or as per-point dicts.
+    """
+    data = json.loads(f.readline())
+    if data.pop('format', None) != PAYLOAD_NDJSON_FORMAT:
+        raise ValueError("Unrecognised payload format")
+    items = data['items'] = []
+    overlays = {}
+    overlay = None
+    for line_no, line in enumerate(f, 2):
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        if 'item' in record:
+            items.append(record['item'])
+        elif 'node' in record:
+            if overlay is None:
+                raise ValueError(f"Payload line {line_no}: annotation node before any overlay")
+            node = record['node']
+            packed = node.pop('packedPoints', None)
+            if packed is not None:
+                node['points'] = _unpack_points(packed)
+            overlay['nodes'].append(node)
+        elif 'overlay' in record:
+            overlay = {key: value for key, value in record.items() if key != 'overlay'}
+            overlay['nodes'] = []
+            overlays[record['overlay']] = overlay
+    data['annotationOverlay'] = overlays or None
+    return data
+
+def _load_payload(input_str):
+    """Accepts a path to a JSON (or streamed .ndjson) payload file, or the JSON text itself."""
+    # Handle file paths directly to bypass OS command line length limits
+    if os.path.isfile(input_str):
+        with open(input_str, 'r', encoding='utf-8') as f:
+            if input_str.lower().endswith('.ndjson'):
+                return _read_ndjson_payload(f)
+            return json.load(f)
+    return json.loads(input_str)
+
+def _record_parse_time(rep, seconds):
+    """Adds the payload parse stage to a profiled report (parsing happens before the export starts)."""
+    if isinstance(rep, dict) and "profile" in rep:
+        rep["profile"]["stages"]["payloadParse"] = {"seconds": seconds, "calls": 1, "rssBytes": _rss_bytes() or 0,
+                                                    "rssGrowthBytes": 0}
+
+_renderer = None
+
+def _page_renderer():
+    """The process-wide PageRenderer, so its caches live as long as the server."""
+    global _renderer
+    if _renderer is None:
+        _renderer = PageRenderer()
+    return _renderer
+
+def _render_format(payload):
+    fmt = payload.get('format', 'png')
+    if fmt not in ('png', 'jpeg'):
+        raise ValueError(f"Unsupported render format: {fmt}")
+    return fmt
+
+def render_page(payload, progress=None):
+    """
+    Server op 'render': {path, pageIndex, scale, rotation, clip, format} -> one page or
+    tile as a base64 PNG/JPEG, served from the renderer's caches where possible.
+    """
+    renderer = _page_renderer()
+    fmt = _render_format(payload)
+    width, height, data = renderer.render(payload['path'], payload.get('pageIndex', 0), payload.get('scale', 1.0),
+                                          payload.get('rotation', 0), payload.get('clip'), fmt)
+    return {"width": width, "height": height, "type": fmt, "data": base64.b64encode(data).decode('ascii'),
+            "cache": {"hits": renderer.hits, "misses": renderer.misses}}
+
+def render_thumbnails(payload, progress=None):
+    """
+    Server op 'thumbnails': {path, pages, maxSize, rotation, format, workers, stream} ->
+    base64 thumbnails for the listed pages (default: the whole document), rendered in
+    parallel. With `stream`, each rendered chunk is sent early in its progress event
+    ("thumbnails") and the response only carries the pages served from the cache.
+    """
+    renderer = _page_renderer()
+    fmt = _render_format(payload)
+    stream = payload.get('stream', False)
+    streamed = set()
+
+    def encode(page_index, width, height, data):
+        return {"pageIndex": page_index, "width": width, "height": height,
+                "data": base64.b64encode(data).decode('ascii')}
+
+    def on_chunk(done, total, chunk):
+        if progress is None:
+            return
+        event = {"stage": "thumbnails", "page": done, "pages": total}
+        if stream:
+            event["type"] = fmt
+            event["thumbnails"] = [encode(*thumb) for thumb in chunk]
+            streamed.update(thumb[0] for thumb in chunk)
+        progress(event)
+
+    thumbs = renderer.thumbnails(payload['path'], payload.get('pages'), payload.get('maxSize', DEFAULT_THUMBNAIL_SIZE),
+                                 payload.get('rotation', 0), fmt, payload.get('workers', 0), on_chunk)
+    return {"type": fmt, "thumbnails": [encode(*thumb) for thumb in thumbs if thumb[0] not in streamed],
+            "cache": {"hits": renderer.hits, "misses": renderer.misses}}
+
+def estimate_export(payload, progress=None):
+    """Server op 'estimate': a dry run of the merge payload (see exportOptions.dryRun)."""
+    return merge_pdfs_hybrid({**payload, 'exportOptions': {**payload.get('exportOptions', {}), 'dryRun': True}}, progress)
+
+# Operations understood by the long-lived server. Each handler takes the request
+# payload dict plus a progress callback and returns a JSON-serialisable report.
+_SERVER_OPS = {
+    'merge': merge_pdfs_hybrid,
+    'estimate': estimate_export,
+    'render': render_page,
+    'thumbnails': render_thumbnails,
+}
+
+def serve(in_stream=None, out_stream=None):
+    """
+    Long-lived engine mode (`merge_engine.py --serve`). Reads newline-delimited JSON
+    requests from stdin and answers each with a single JSON line on stdout, so
+    pypdf/fitz/PIL are imported once per process instead of once per export.
+
+    Request:  {"id": 7, "op": "merge", "payload": {...}}  (or "payloadPath": "...")
+              {"id": 8, "op": "render" / "thumbnails", "payload": {"path": ..., ...}}
+              {"id": 9, "op": "ping"} / {"id": 10, "op": "shutdown"}
+    Response: {"id": 7, "success": true, "report": {...}}
+              {"id": 7, "success": false, "error": "..."}
+    Progress: {"id": 7, "event": "progress", "stage": "merge", "page": 12, ...}
+              (zero or more, always before the request's final response)
+
+    Requests are handled strictly in arrival order; the id lets the caller queue
+    several exports and match up the answers.
+    """
+    in_stream = in_stream or sys.stdin
+    out_stream = out_stream or sys.stdout
+
+    def respond(msg):
+        out_stream.write(json.dumps(msg) + "\n")
+        out_stream.flush()
+
+    for line in in_stream:
+        line = line.strip()
+        if not line:
+            continue
+        req_id = None
+        try:
+            req = json.loads(line)
+            req_id = req.get('id')
+            op = req.get('op', 'merge')
+            if op == 'shutdown':
+                respond({"id": req_id, "success": True})
+                break
+            if op == 'ping':
+                respond({"id": req_id, "success": True, "pid": os.getpid()})
+                continue
+            handler = _SERVER_OPS.get(op)
+            if handler is None:
+                raise ValueError(f"Unknown op: {op}")
+
+            parse_started = time.perf_counter()
+            if 'payloadPath' in req:
+                data = _load_payload(req['payloadPath'])
+            else:
+                data = req.get('payload', {})
+            parse_seconds = time.perf_counter() - parse_started
+
+            def on_progress(event, req_id=req_id):
+                respond({"id": req_id, "event": "progress", **event})
+
+            # Stray prints from the engine must never corrupt the response channel
+            with contextlib.redirect_stdout(sys.stderr):
+                rep = handler(data, on_progress)
+            _record_parse_time(rep, parse_seconds)
+            respond({"id": req_id, "success": True, "report": rep})
+        except Exception as e:
+            print(f"Engine request {req_id} failed: {e}\n{traceback.format_exc()}", file=sys.stderr)
+            respond({"id": req_id, "success": False, "error": str(e)})
+
+    if _renderer is not None:
+        _renderer.close()
+
 if __name__ == "__main__":
+    # Required for the process pool in the PyInstaller --onefile build
+    multiprocessing.freeze_support()
+
+    if len(sys.argv) > 1 and sys.argv[1] == '--serve':
+        serve()
+        sys.exit(0)
+
     try:
         if len(sys.argv) < 2:
             print(json.dumps({"success": False, "error": "No input data provided"}))
             sys.exit(1)
 
-        input_str = sys.argv[1]
-        
-        # Handle file paths directly to bypass OS command line length limits
-        if os.path.isfile(input_str):
-            with open(input_str, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-        else:
-            data = json.loads(input_str)
+        parse_started = time.perf_counter()
+        data = _load_payload(sys.argv[1])
+        parse_seconds = time.perf_counter() - parse_started
             
         rep = merge_pdfs_hybrid(data)
+        _record_parse_time(rep, parse_seconds)
         
         print(json.dumps({"success": True, "report": rep}))
         
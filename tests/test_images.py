@@ -0,0 +1,43 @@
+"""Raster image items are embedded the way the UI shows them."""
+import os
+import sys
+
+import pytest
+
+fitz = pytest.importorskip("fitz")
+Image = pytest.importorskip("PIL.Image")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import merge_engine  # noqa: E402
+
+ORIENTATION = 0x0112
+
+@pytest.fixture
+def oriented_jpeg(tmp_path):
+    """A 400x200 JPEG stored sideways, red on the left and blue on the right, tagged
+    Orientation=6 (turn 90 degrees clockwise to display): upright it is 200x400, red on top."""
+    img = Image.new("RGB", (400, 200), (0, 0, 255))
+    img.paste((255, 0, 0), (0, 0, 200, 200))
+    exif = Image.Exif()
+    exif[ORIENTATION] = 6
+    path = str(tmp_path / "portrait.jpg")
+    img.save(path, format="JPEG", exif=exif)
+    return path
+
+@pytest.mark.parametrize("engine", ['fitz', 'pypdf'])
+def test_exif_orientation_is_applied(tmp_path, oriented_jpeg, engine):
+    out = str(tmp_path / "out.pdf")
+    report = merge_engine.merge_pdfs_hybrid({
+        'items': [{'path': oriented_jpeg, 'type': 'img', 'originalIndex': 0, 'rot': 0, 'id': 'p'}],
+        'outputPath': out,
+        'exportOptions': {'engine': engine},
+    })
+    assert not report['errors'], report['errors']
+    with fitz.open(out) as doc:
+        page = doc[0]
+        assert (round(page.rect.width), round(page.rect.height)) == (200, 400)
+        pix = page.get_pixmap(colorspace=fitz.csRGB, alpha=False)
+        top, bottom = pix.pixel(100, 50), pix.pixel(100, 350)
+    assert top[0] > 200 and top[2] < 60, top
+    assert bottom[2] > 200 and bottom[0] < 60, bottom
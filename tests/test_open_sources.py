@@ -0,0 +1,67 @@
+"""
+exportOptions.maxOpenSources bounds the source files an export holds open, on the
+fitz engine as well as the pypdf fallback.
+"""
+import os
+import sys
+
+import pytest
+
+fitz = pytest.importorskip("fitz")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import merge_engine  # noqa: E402
+
+FD_DIR = '/proc/self/fd'
+SOURCES = 60
+MAX_OPEN = 4
+
+pytestmark = pytest.mark.skipif(not os.path.isdir(FD_DIR), reason="needs /proc/self/fd")
+
+@pytest.fixture(scope="module")
+def sources(tmp_path_factory):
+    folder = tmp_path_factory.mktemp("sources")
+    paths = []
+    for i in range(SOURCES):
+        path = str(folder / f"source_{i}.pdf")
+        doc = fitz.open()
+        doc.new_page().insert_text((50, 50), f"Source {i}")
+        doc.save(path)
+        doc.close()
+        paths.append(path)
+    return paths
+
+def peak_open_files(items, output_path, engine):
+    baseline = len(os.listdir(FD_DIR))
+    peak = [baseline]
+
+    def progress(event):
+        peak[0] = max(peak[0], len(os.listdir(FD_DIR)))
+
+    report = merge_engine.merge_pdfs_hybrid({
+        'items': items,
+        'outputPath': output_path,
+        'exportOptions': {'engine': engine, 'maxOpenSources': MAX_OPEN, 'mmapSources': False},
+    }, progress)
+    assert not report['errors'], report['errors']
+    with fitz.open(output_path) as doc:
+        assert len(doc) == len(items)
+    return peak[0] - baseline
+
+@pytest.mark.parametrize("engine", ['fitz', 'pypdf'])
+def test_open_sources_stay_bounded(tmp_path, sources, engine):
+    items = [{'path': path, 'originalIndex': 0, 'rot': 0, 'id': str(i)} for i, path in enumerate(sources)]
+    assert peak_open_files(items, str(tmp_path / "out.pdf"), engine) <= 2 * MAX_OPEN
+
+def test_interleaved_sources_stay_bounded(tmp_path, sources):
+    # Every source comes back after all the others: each is evicted in between
+    items = [{'path': path, 'originalIndex': 0, 'rot': 0, 'id': f"{n}-{i}"}
+             for n in range(2) for i, path in enumerate(sources)]
+    assert peak_open_files(items, str(tmp_path / "out.pdf"), 'fitz') <= 2 * MAX_OPEN
+
+def test_runs_drop_graft_maps():
+    entries = [('a', 0, 0, 0), ('b', 0, 0, 1), ('a', 1, 0, 2), ('c', 0, 0, 3), ('d', 0, 0, 4), ('a', 2, 0, 5)]
+    finals = [run[5] for run in merge_engine._plan_runs(entries, max_open=2)]
+    # a is kept for its next run, then dropped as c and d evict it; b, d and the last a end
+    assert finals == [False, True, True, True, True, True]
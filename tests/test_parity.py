@@ -0,0 +1,86 @@
+"""
+Parity between the fitz-native engine and the pypdf fallback: both engines export
+the fixtures of benchmarks/parity_check.py and must agree on page count, page boxes,
+rotation, rendered pixels and (within SIZE_TOLERANCE) output size.
+"""
+import os
+import sys
+
+import pytest
+
+fitz = pytest.importorskip("fitz")
+pytest.importorskip("PIL")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+import merge_engine  # noqa: E402
+import parity_check  # noqa: E402
+
+ENGINES = ('fitz', 'pypdf')
+BOX_TOLERANCE = 0.5  # points
+SIZE_TOLERANCE = 0.10  # fitz output may be this much larger or smaller than pypdf's
+PIXEL_DPI = 36
+PIXEL_TOLERANCE = 1.0  # mean absolute difference per channel
+
+@pytest.fixture(scope="module")
+def fixtures(tmp_path_factory):
+    work_dir = str(tmp_path_factory.mktemp("parity"))
+    paths = parity_check.build_fixtures(work_dir)
+    items = parity_check.build_items(paths)
+    return work_dir, items, parity_check.build_overlay(items)
+
+def export(fixtures, name, options, fit, annotate, engine):
+    work_dir, items, overlay = fixtures
+    out = os.path.join(work_dir, f"{name}_{engine}.pdf")
+    report = merge_engine.merge_pdfs_hybrid({
+        'items': items,
+        'outputPath': out,
+        'resizeToFit': fit,
+        'exportOptions': {**options, 'engine': engine},
+        'annotationOverlay': overlay if annotate else None,
+    })
+    assert not report.get('errors'), report['errors']
+    return out
+
+@pytest.fixture(scope="module", params=parity_check.CASES, ids=[case[0] for case in parity_check.CASES])
+def outputs(request, fixtures):
+    name, options, fit, annotate = request.param
+    return {engine: export(fixtures, name, options, fit, annotate, engine) for engine in ENGINES}
+
+def assert_rect_close(a, b, what):
+    assert all(abs(x - y) <= BOX_TOLERANCE for x, y in zip(a, b)), f"{what}: {a} != {b}"
+
+def test_page_count(outputs, fixtures):
+    counts = {}
+    for engine, path in outputs.items():
+        with fitz.open(path) as doc:
+            counts[engine] = len(doc)
+    assert counts['fitz'] == counts['pypdf'] == len(fixtures[1])
+
+def test_page_boxes_and_rotation(outputs):
+    with fitz.open(outputs['fitz']) as a, fitz.open(outputs['pypdf']) as b:
+        for i in range(min(len(a), len(b))):
+            assert a[i].rotation == b[i].rotation, f"page {i}: rotation"
+            assert_rect_close(a[i].mediabox, b[i].mediabox, f"page {i}: mediabox")
+            assert_rect_close(a[i].cropbox, b[i].cropbox, f"page {i}: cropbox")
+            assert_rect_close(a[i].rect, b[i].rect, f"page {i}: displayed size")
+
+def test_output_size(outputs):
+    fitz_size, pypdf_size = (os.path.getsize(outputs[engine]) for engine in ENGINES)
+    assert abs(fitz_size - pypdf_size) <= pypdf_size * SIZE_TOLERANCE, (fitz_size, pypdf_size)
+
+def test_pixels(outputs):
+    assert parity_check.compare(outputs['fitz'], outputs['pypdf'], PIXEL_DPI, PIXEL_TOLERANCE) == []
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_no_surviving_page_writes_empty_output(tmp_path, engine):
+    out = str(tmp_path / "empty.pdf")
+    report = merge_engine.merge_pdfs_hybrid({
+        'items': [{'path': str(tmp_path / "missing.pdf"), 'originalIndex': 0, 'rot': 0, 'id': 'x'}],
+        'outputPath': out,
+        'exportOptions': {'engine': engine},
+    })
+    assert any("No pages could be exported" in w for w in report['warnings'])
+    with open(out, 'rb') as f:
+        assert f.read(5) == b'%PDF-'
@@ -0,0 +1,38 @@
+"""Print-safe export (exportOptions.printSafe) removes transparency markers."""
+import os
+import sys
+
+import pytest
+
+fitz = pytest.importorskip("fitz")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import merge_engine  # noqa: E402
+
+@pytest.fixture
+def grouped_pdf(tmp_path):
+    """Two pages of plain text, the first with a page-level transparency group."""
+    path = str(tmp_path / "grouped.pdf")
+    doc = fitz.open()
+    for i in range(2):
+        doc.new_page().insert_text((50, 50), f"Page {i}")
+    doc.xref_set_key(doc[0].xref, "Group", "<</Type/Group/S/Transparency/CS/DeviceRGB>>")
+    doc.save(path)
+    doc.close()
+    return path
+
+@pytest.mark.parametrize("engine", ['fitz', 'pypdf'])
+def test_page_transparency_group_is_a_vector_fix(tmp_path, grouped_pdf, engine):
+    out = str(tmp_path / "out.pdf")
+    report = merge_engine.merge_pdfs_hybrid({
+        'items': [{'path': grouped_pdf, 'originalIndex': i, 'rot': 0, 'id': str(i)} for i in range(2)],
+        'outputPath': out,
+        'exportOptions': {'engine': engine, 'printSafe': True},
+    })
+    assert not report['errors'], report['errors']
+    assert any(fix.startswith("Removed transparency groups") and "from 1 pages" in fix for fix in report['fixes']), report['fixes']
+    assert not any(fix.startswith("Flattened transparency") for fix in report['fixes'])
+    with fitz.open(out) as doc:
+        assert len(doc) == 2
+        assert all(doc.xref_get_key(page.xref, "Group")[0] == 'null' for page in doc)
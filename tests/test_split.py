@@ -0,0 +1,76 @@
+"""
+exportOptions.splitMaxBytes: every part of a split export stays under the limit, and
+the planned sizes account for everything a page brings along into a standalone part.
+"""
+import os
+import random
+import sys
+
+import pytest
+
+fitz = pytest.importorskip("fitz")
+Image = pytest.importorskip("PIL.Image")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import merge_engine  # noqa: E402
+
+PAGES = 12
+MAX_BYTES = 250000
+
+@pytest.fixture(scope="module")
+def sources(tmp_path_factory):
+    """A source whose pages each place their own vector drawing as a form XObject, and a photo over the limit."""
+    folder = tmp_path_factory.mktemp("split")
+    rng = random.Random(1)
+    drawings = fitz.open()
+    for _ in range(PAGES):
+        page = drawings.new_page()
+        for _ in range(500):
+            x, y = rng.uniform(0, 595), rng.uniform(0, 842)
+            page.draw_line((x, y), (x + rng.uniform(-40, 40), y + rng.uniform(-40, 40)), color=(rng.random(), 0, 0))
+    forms = fitz.open()
+    for i in range(PAGES):
+        forms.new_page().show_pdf_page(fitz.Rect(0, 0, 595, 842), drawings, i)
+    forms_path = str(folder / "forms.pdf")
+    forms.save(forms_path, garbage=3, deflate=True)
+    forms.close()
+    drawings.close()
+
+    noise = bytes(rng.randrange(256) for _ in range(150 * 200))
+    photo = Image.frombytes("L", (150, 200), noise).resize((1200, 1600), Image.BICUBIC).convert("RGB")
+    photo_path = str(folder / "photo.jpg")
+    photo.save(photo_path, format="JPEG", quality=90)
+    return forms_path, photo_path
+
+def split(tmp_path, items, engine):
+    out = str(tmp_path / "out.pdf")
+    report = merge_engine.merge_pdfs_hybrid({
+        'items': items,
+        'outputPath': out,
+        'exportOptions': {'engine': engine, 'splitMaxBytes': MAX_BYTES},
+    })
+    assert not report['errors'], report['errors']
+    assert not report['warnings'], report['warnings']
+    return report['splitParts']
+
+@pytest.mark.parametrize("engine", ['fitz', 'pypdf'])
+def test_parts_stay_under_the_limit(tmp_path, sources, engine):
+    forms_path, photo_path = sources
+    items = [{'path': forms_path, 'originalIndex': i, 'rot': 0, 'id': f"f{i}"} for i in range(PAGES)]
+    items.append({'path': photo_path, 'type': 'img', 'originalIndex': 0, 'rot': 0, 'id': 'p'})
+    parts = split(tmp_path, items, engine)
+    assert len(parts) > 1
+    for part in parts:
+        assert os.path.getsize(part['output']) <= MAX_BYTES, part
+    pages = 0
+    for part in parts:
+        with fitz.open(part['output']) as doc:
+            pages += len(doc)
+    assert pages == len(items)
+
+def test_form_xobjects_are_predicted(tmp_path, sources):
+    # Each page's drawing lives in a form XObject: the plan must charge it to the part
+    items = [{'path': sources[0], 'originalIndex': i, 'rot': 0, 'id': f"f{i}"} for i in range(PAGES)]
+    for part in split(tmp_path, items, 'fitz'):
+        assert abs(part['bytes'] - part['predictedBytes']) <= part['bytes'] * 0.1, part
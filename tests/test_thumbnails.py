@@ -0,0 +1,38 @@
+"""The engine's thumbnail op, as used by the page grid."""
+import os
+import sys
+
+import pytest
+
+fitz = pytest.importorskip("fitz")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import merge_engine  # noqa: E402
+
+PAGES = 3 * merge_engine.THUMBNAIL_CHUNK_PAGES
+
+@pytest.fixture
+def document(tmp_path):
+    path = str(tmp_path / "pages.pdf")
+    doc = fitz.open()
+    for i in range(PAGES):
+        doc.new_page().insert_text((50, 50), f"Page {i}")
+    doc.save(path)
+    doc.close()
+    return path
+
+def test_streamed_thumbnails_arrive_once_per_page(document):
+    events = []
+    report = merge_engine.render_thumbnails({'path': document, 'maxSize': 64, 'stream': True, 'workers': 1},
+                                            events.append)
+    streamed = [thumb['pageIndex'] for event in events for thumb in event.get('thumbnails', [])]
+    assert len(events) == PAGES // merge_engine.THUMBNAIL_CHUNK_PAGES
+    assert report['thumbnails'] == []
+    assert sorted(streamed) == list(range(PAGES))
+
+    # A second request is served from the cache and answered in the response
+    events.clear()
+    report = merge_engine.render_thumbnails({'path': document, 'maxSize': 64, 'stream': True}, events.append)
+    assert events == []
+    assert [thumb['pageIndex'] for thumb in report['thumbnails']] == list(range(PAGES))